@@ -0,0 +1,293 @@
+#include "batch.h"
+#include "syslog.h"
+#include "cstr.h"
+
+#include <stddef.h>
+#include <stdlib.h>
+#include <string.h>
+
+// Macros
+#define INITIAL_BATCH_BYTES     4096
+#define INITIAL_BATCH_MSGS      64
+#define INITIAL_BATCH_SD        256
+#define MAX_BATCH_BYTES         ((size_t) -1 / 2)
+
+
+// Supporting functions
+syslog_batch_msg * current_msg(syslog_batch *batch) {
+    return &batch->msgs[batch->msg_count];
+}
+
+int batch_error(syslog_batch *batch, int error) {
+    batch->error = error;
+    return 1;
+}
+
+int grow_array(void **array, size_t *capacity, size_t needed, size_t item_size) {
+    size_t next_capacity = *capacity;
+    void *grown;
+
+    if (needed <= next_capacity) {
+        return 0;
+    }
+
+    while (next_capacity < needed) {
+        next_capacity *= 2;
+    }
+
+    grown = realloc(*array, next_capacity * item_size);
+
+    if (grown == NULL) {
+        return SLERR_UNABLE_TO_ALLOCATE;
+    }
+
+    *array = grown;
+    *capacity = next_capacity;
+    return 0;
+}
+
+int store_span(syslog_batch *batch, syslog_span *span, const char *data, size_t length) {
+    span->offset = batch->bytes->position;
+    span->size = length;
+
+    return cstr_buff_append(batch->bytes, data, length);
+}
+
+void rebase_span(syslog_span *span, size_t start) {
+    if (span->offset >= start) {
+        span->offset -= start;
+    }
+}
+
+
+// Parser callbacks; app_data is swapped for the batch by uslg_batch_exec
+int on_batch_msg_begin(syslog_parser *parser) {
+    syslog_batch *batch = (syslog_batch *) parser->app_data;
+    syslog_batch_msg *msg;
+
+    if (grow_array((void **) &batch->msgs, &batch->msg_capacity,
+                   batch->msg_count + 1, sizeof(syslog_batch_msg))) {
+        return batch_error(batch, SLERR_UNABLE_TO_ALLOCATE);
+    }
+
+    msg = current_msg(batch);
+    memset(msg, 0, sizeof(*msg));
+    msg->bytes_start = batch->bytes->position;
+    msg->sd_first = batch->sd_count;
+
+    batch->in_progress = true;
+    return 0;
+}
+
+int on_batch_sd(syslog_parser *parser, unsigned char kind, const char *data, size_t length) {
+    syslog_batch *batch = (syslog_batch *) parser->app_data;
+    syslog_batch_sd *entry;
+
+    if (grow_array((void **) &batch->sd, &batch->sd_capacity,
+                   batch->sd_count + 1, sizeof(syslog_batch_sd))) {
+        return batch_error(batch, SLERR_UNABLE_TO_ALLOCATE);
+    }
+
+    entry = &batch->sd[batch->sd_count];
+    entry->kind = kind;
+
+    if (store_span(batch, &entry->value, data, length)) {
+        return batch_error(batch, SLERR_BUFFER_OVERFLOW);
+    }
+
+    batch->sd_count++;
+    current_msg(batch)->sd_count++;
+    return 0;
+}
+
+int on_batch_sd_element(syslog_parser *parser, const char *data, size_t length) {
+    return on_batch_sd(parser, SD_ELEMENT, data, length);
+}
+
+int on_batch_sd_field(syslog_parser *parser, const char *data, size_t length) {
+    return on_batch_sd(parser, SD_FIELD, data, length);
+}
+
+int on_batch_sd_value(syslog_parser *parser, const char *data, size_t length) {
+    return on_batch_sd(parser, SD_VALUE, data, length);
+}
+
+int on_batch_msg_head_complete(syslog_parser *parser) {
+    syslog_batch *batch = (syslog_batch *) parser->app_data;
+    syslog_batch_msg *msg = current_msg(batch);
+    const syslog_msg_head *head = parser->msg_head;
+    int error = 0;
+
+    msg->priority = head->priority;
+    msg->version = head->version;
+    msg->decoded_timestamp = head->decoded_timestamp;
+
+    error |= store_span(batch, &msg->timestamp, head->timestamp.bytes, head->timestamp.size);
+    error |= store_span(batch, &msg->hostname, head->hostname.bytes, head->hostname.size);
+    error |= store_span(batch, &msg->appname, head->appname.bytes, head->appname.size);
+    error |= store_span(batch, &msg->processid, head->processid.bytes, head->processid.size);
+    error |= store_span(batch, &msg->messageid, head->messageid.bytes, head->messageid.size);
+
+    // Message parts are appended right after the head
+    msg->message.offset = batch->bytes->position;
+    msg->message.size = 0;
+
+    return error ? batch_error(batch, SLERR_BUFFER_OVERFLOW) : 0;
+}
+
+int on_batch_msg_part(syslog_parser *parser, const char *data, size_t length) {
+    syslog_batch *batch = (syslog_batch *) parser->app_data;
+
+    if (cstr_buff_append(batch->bytes, data, length)) {
+        return batch_error(batch, SLERR_BUFFER_OVERFLOW);
+    }
+
+    current_msg(batch)->message.size += length;
+    return 0;
+}
+
+int on_batch_msg_complete(syslog_parser *parser) {
+    syslog_batch *batch = (syslog_batch *) parser->app_data;
+
+    current_msg(batch)->message_length = parser->message_length;
+    batch->msg_count++;
+    batch->in_progress = false;
+    return 0;
+}
+
+int on_batch_msg_body(syslog_parser *parser, const char *data, size_t length) {
+    const int error = on_batch_msg_part(parser, data, length);
+    return error ? error : on_batch_msg_complete(parser);
+}
+
+const syslog_parser_settings batch_settings = {
+    on_batch_msg_begin,
+    on_batch_sd_element,
+    on_batch_sd_field,
+    on_batch_sd_value,
+    on_batch_msg_head_complete,
+    on_batch_msg_part,
+    on_batch_msg_complete,
+    on_batch_msg_body
+};
+
+
+// Exported Functions
+
+syslog_batch * uslg_batch_new(void) {
+    syslog_batch *batch = (syslog_batch *) malloc(sizeof(syslog_batch));
+
+    if (batch == NULL) {
+        return NULL;
+    }
+
+    memset(batch, 0, sizeof(*batch));
+
+    batch->bytes = cstr_buff_new_growable(INITIAL_BATCH_BYTES, MAX_BATCH_BYTES);
+    batch->msgs = (syslog_batch_msg *) malloc(INITIAL_BATCH_MSGS * sizeof(syslog_batch_msg));
+    batch->sd = (syslog_batch_sd *) malloc(INITIAL_BATCH_SD * sizeof(syslog_batch_sd));
+
+    if (batch->bytes == NULL || batch->msgs == NULL || batch->sd == NULL) {
+        uslg_batch_free(batch);
+        return NULL;
+    }
+
+    batch->msg_capacity = INITIAL_BATCH_MSGS;
+    batch->sd_capacity = INITIAL_BATCH_SD;
+    return batch;
+}
+
+void uslg_batch_free(syslog_batch *batch) {
+    if (batch == NULL) {
+        return;
+    }
+
+    cstr_buff_free(batch->bytes);
+    free(batch->msgs);
+    free(batch->sd);
+    free(batch);
+}
+
+void uslg_batch_reset(syslog_batch *batch) {
+    cstr_buff_reset(batch->bytes);
+    batch->msg_count = 0;
+    batch->sd_count = 0;
+    batch->in_progress = false;
+    batch->error = 0;
+}
+
+/**
+* Drops every finished message from the batch. A message that is still
+* being read is moved to the front of the batch so that it can be finished
+* by the next call to uslg_batch_exec.
+*/
+void uslg_batch_clear(syslog_batch *batch) {
+    syslog_batch_msg *msg;
+    size_t sd_index;
+
+    if (!batch->in_progress) {
+        uslg_batch_reset(batch);
+        return;
+    }
+
+    msg = current_msg(batch);
+
+    memmove(batch->bytes->data->bytes,
+            batch->bytes->data->bytes + msg->bytes_start,
+            batch->bytes->position - msg->bytes_start);
+    batch->bytes->position -= msg->bytes_start;
+
+    memmove(batch->sd,
+            batch->sd + msg->sd_first,
+            msg->sd_count * sizeof(syslog_batch_sd));
+    batch->sd_count = msg->sd_count;
+
+    for (sd_index = 0; sd_index < batch->sd_count; sd_index++) {
+        rebase_span(&batch->sd[sd_index].value, msg->bytes_start);
+    }
+
+    rebase_span(&msg->timestamp, msg->bytes_start);
+    rebase_span(&msg->hostname, msg->bytes_start);
+    rebase_span(&msg->appname, msg->bytes_start);
+    rebase_span(&msg->processid, msg->bytes_start);
+    rebase_span(&msg->messageid, msg->bytes_start);
+    rebase_span(&msg->message, msg->bytes_start);
+
+    msg->bytes_start = 0;
+    msg->sd_first = 0;
+
+    memmove(batch->msgs, msg, sizeof(*msg));
+    batch->msg_count = 0;
+}
+
+/**
+* Parses data into the batch without calling back into the application.
+* Nothing here touches the parser's app_data beyond swapping it for the
+* duration of the call, so this may be run without holding any interpreter
+* lock. On error the batch is left as it was before the failing message.
+*/
+int uslg_batch_exec(syslog_parser *parser, syslog_batch *batch, const char *data, size_t length) {
+    void *app_data = parser->app_data;
+    int error;
+
+    parser->app_data = batch;
+    error = uslg_parser_exec(parser, &batch_settings, data, length);
+    parser->app_data = app_data;
+
+    if (error) {
+        if (batch->error) {
+            // Report the cause rather than the callback failure
+            error = batch->error;
+            batch->error = 0;
+        }
+
+        if (batch->in_progress) {
+            // The parser has reset so the message will never finish
+            batch->bytes->position = current_msg(batch)->bytes_start;
+            batch->sd_count = current_msg(batch)->sd_first;
+            batch->in_progress = false;
+        }
+    }
+
+    return error;
+}
@@ -0,0 +1,96 @@
+#ifndef batch_h
+#define batch_h
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include "cstr.h"
+#include "syslog.h"
+#include <stdint.h>
+#include <stdbool.h>
+#include <sys/types.h>
+
+
+// Typedefs
+typedef struct syslog_span syslog_span;
+typedef struct syslog_batch_sd syslog_batch_sd;
+typedef struct syslog_batch_msg syslog_batch_msg;
+typedef struct syslog_batch syslog_batch;
+
+
+// Enumerations
+enum batch_sd_kind {
+    SD_ELEMENT = 0,
+    SD_FIELD = 1,
+    SD_VALUE = 2
+};
+
+
+// Structs
+
+// Spans are offsets into the batch byte store since the store may move as
+// it grows
+struct syslog_span {
+    size_t offset;
+    size_t size;
+};
+
+struct syslog_batch_sd {
+    unsigned char kind;
+    syslog_span value;
+};
+
+struct syslog_batch_msg {
+    uint16_t priority;
+    uint16_t version;
+
+    syslog_span timestamp;
+    syslog_span hostname;
+    syslog_span appname;
+    syslog_span processid;
+    syslog_span messageid;
+    syslog_span message;
+
+    syslog_timestamp decoded_timestamp;
+
+    // SDATA entries belonging to this message, in the order they were read
+    size_t sd_first;
+    size_t sd_count;
+
+    size_t message_length;
+
+    // Where this message's bytes begin in the store
+    size_t bytes_start;
+};
+
+struct syslog_batch {
+    // Every field, SDATA and body byte of the batched messages
+    cstr_buff *bytes;
+
+    // Finished messages followed by the one being read, if any
+    syslog_batch_msg *msgs;
+    size_t msg_count;
+    size_t msg_capacity;
+    bool in_progress;
+
+    syslog_batch_sd *sd;
+    size_t sd_count;
+    size_t sd_capacity;
+
+    int error;
+};
+
+// Functions
+syslog_batch * uslg_batch_new(void);
+void uslg_batch_free(syslog_batch *batch);
+
+void uslg_batch_reset(syslog_batch *batch);
+void uslg_batch_clear(syslog_batch *batch);
+
+int uslg_batch_exec(syslog_parser *parser, syslog_batch *batch, const char *data, size_t length);
+
+#ifdef __cplusplus
+}
+#endif
+#endif
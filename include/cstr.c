@@ -27,11 +27,23 @@ void cstr_free(cstr *cstr) {
     }
 }
 
+int cstr_resize(cstr *cstr, size_t size) {
+    char *bytes = realloc(cstr->bytes, sizeof(char) * size);
+
+    if (bytes == NULL) {
+        return CSTR_BUFFER_OVERFLOW;
+    }
+
+    cstr->bytes = bytes;
+    cstr->size = size;
+    return 0;
+}
+
 cstr * cstr_copy_from_cstr(cstr *src, size_t size) {
     return cstr_copy_from_char(src->bytes, size);
 }
 
-cstr * cstr_copy_from_char(char *string, size_t size) {
+cstr * cstr_copy_from_char(const char *string, size_t size) {
     cstr *copy = cstr_new(size);
 
     if (copy != NULL) {
@@ -42,17 +54,24 @@ cstr * cstr_copy_from_char(char *string, size_t size) {
 }
 
 cstr_buff * cstr_buff_new(size_t size) {
+    return cstr_buff_new_growable(size, size);
+}
+
+cstr_buff * cstr_buff_new_growable(size_t size, size_t limit) {
     // Allocate a new cstr_buff struct
     cstr_buff *buffer = (cstr_buff *) malloc(sizeof(cstr_buff));
 
     if (buffer != NULL) {
         buffer->data = cstr_new(size);
 
-        if (buffer->data != NULL) {
+        if (buffer->data != NULL && buffer->data->bytes != NULL) {
             buffer->position = 0;
+            buffer->initial_size = size;
+            buffer->limit = limit > size ? limit : size;
         } else {
             // Allocating the actual char buffer failed
             // so release the newly allocated struct
+            cstr_free(buffer->data);
             free(buffer);
             buffer = NULL;
         }
@@ -62,6 +81,10 @@ cstr_buff * cstr_buff_new(size_t size) {
 }
 
 void cstr_buff_free(cstr_buff *buffer) {
+    if (buffer == NULL) {
+        return;
+    }
+
     if (buffer->data != NULL) {
         cstr_free(buffer->data);
     }
@@ -73,17 +96,64 @@ void cstr_buff_reset(cstr_buff *buffer) {
     buffer->position = 0;
 }
 
+/**
+* Resets the buffer and gives back any memory it grew into past its
+* initial size.
+*/
+void cstr_buff_trim(cstr_buff *buffer) {
+    buffer->position = 0;
+
+    if (buffer->data->size > buffer->initial_size) {
+        // A failed shrink leaves the larger allocation in place
+        cstr_resize(buffer->data, buffer->initial_size);
+    }
+}
+
+/**
+* Makes sure there is room for length more bytes, doubling the buffer up to
+* its limit when there is not. Growing may move the buffer's bytes.
+*/
+int cstr_buff_reserve(cstr_buff *buffer, size_t length) {
+    size_t needed = buffer->position + length + 1;
+    size_t next_size = buffer->data->size;
+
+    if (needed <= next_size) {
+        return 0;
+    }
+
+    if (needed < buffer->position || needed > buffer->limit) {
+        return CSTR_BUFFER_OVERFLOW;
+    }
+
+    while (next_size < needed) {
+        next_size = next_size * 2 > next_size ? next_size * 2 : needed;
+    }
+
+    if (next_size > buffer->limit) {
+        next_size = buffer->limit;
+    }
+
+    return cstr_resize(buffer->data, next_size);
+}
+
 int cstr_buff_put(cstr_buff *buffer, char src) {
-    int retval = 0;
-    int next_position = buffer->position + 1;
+    int retval = cstr_buff_reserve(buffer, 1);
 
-    if (next_position > 0 && next_position < buffer->data->size) {
+    if (!retval) {
         buffer->data->bytes[buffer->position] = src;
-        buffer->position = next_position;
-    } else {
-        retval = CSTR_BUFFER_OVERFLOW;
+        buffer->position++;
     }
 
     return retval;
 }
 
+int cstr_buff_append(cstr_buff *buffer, const char *src, size_t length) {
+    int retval = cstr_buff_reserve(buffer, length);
+
+    if (!retval) {
+        memcpy(buffer->data->bytes + buffer->position, src, length);
+        buffer->position += length;
+    }
+
+    return retval;
+}
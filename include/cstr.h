@@ -22,6 +22,8 @@ typedef struct {
 typedef struct {
     cstr *data;
     size_t position;
+    size_t initial_size;    // Size the buffer starts at and is trimmed back to
+    size_t limit;           // Size the buffer may grow to
 } cstr_buff;
 
 
@@ -30,16 +32,22 @@ typedef struct {
 // String
 cstr * cstr_new(size_t size);
 void cstr_free(cstr *cstr);
+int cstr_resize(cstr *cstr, size_t size);
 
 cstr * cstr_copy_from_cstr(cstr *src, size_t size);
-cstr * cstr_copy_from_char(char *src, size_t size);
+cstr * cstr_copy_from_char(const char *src, size_t size);
 
 // Buffer
 cstr_buff * cstr_buff_new(size_t size);
+cstr_buff * cstr_buff_new_growable(size_t size, size_t limit);
 void cstr_buff_free(cstr_buff *buffer);
 void cstr_buff_reset(cstr_buff *buffer);
+void cstr_buff_trim(cstr_buff *buffer);
+
+int cstr_buff_reserve(cstr_buff *buffer, size_t length);
 
 int cstr_buff_put(cstr_buff *buffer, char src);
+int cstr_buff_append(cstr_buff *buffer, const char *src, size_t length);
 
 #ifdef __cplusplus
 }
@@ -14,6 +14,9 @@
 #define RFC3164_MAX_BYTES       1024
 #define RFC5424_MAX_BYTES       2048
 #define MAX_BUFFER_SIZE         (RFC5424_MAX_BYTES * 32)
+#define HEAD_ARENA_SIZE         RFC5424_MAX_BYTES
+#define INITIAL_BUFFER_SIZE     256
+#define HEAD_FIELD_COUNT        5
 
 #define IS_WS(c)            (c ==' ' || c == '\t' || c == '\r' || c == '\n')
 #define LOWER(c)            (unsigned char)(c | 0x20)
@@ -21,6 +24,11 @@
 #define IS_NUM(c)           ((c) >= '0' && (c) <= '9')
 #define IS_ALPHANUM(c)      (IS_ALPHA(c) || IS_NUM(c))
 
+// Word-at-a-time scanning; true when any byte in the word is below n
+#define WORD_ONES               ((uint64_t) 0x0101010101010101ULL)
+#define WORD_HIGHS              ((uint64_t) 0x8080808080808080ULL)
+#define HAS_BYTE_BELOW(w, n)    (((w) - WORD_ONES * (n)) & ~(w) & WORD_HIGHS)
+
 // Typedefs
 typedef enum {
     ts_before,
@@ -47,6 +55,7 @@ typedef enum {
     s_sd_field,
     s_sd_value_start,
     s_sd_value,
+    s_sd_value_escaped,
     s_sd_value_end,
     s_sd_end,
 
@@ -54,46 +63,143 @@ typedef enum {
     s_message
 } syslog_state;
 
+// Byte classes the transition table is indexed by
+typedef enum {
+    c_ot,   // Anything not listed below
+    c_dg,   // 0-9
+    c_al,   // A-Z and a-z
+    c_bl,   // Space and tab
+    c_cr,   // \r
+    c_lf,   // \n
+    c_lt,   // <
+    c_gt,   // >
+    c_lb,   // [
+    c_rb,   // ]
+    c_ds,   // -
+    c_qt,   // "
+    CHAR_CLASS_COUNT
+} char_class;
+
+// What the parser does with a byte given its state and class. Every action
+// consumes the byte it is dispatched on, or in the case of the token and
+// message actions, the run of bytes starting with it. Zero is the error
+// action so anything left out of the table is rejected.
 typedef enum {
-    pa_advance,
-    pa_rehash,
-    pa_none
+    pa_error = 0,
+    pa_skip,
+    pa_cr,
+    pa_msg_begin,
+    pa_octet_digit,
+    pa_octet_end,
+    pa_priority_open,
+    pa_priority_digit,
+    pa_priority_close,
+    pa_version_digit,
+    pa_version_end,
+    pa_token,
+    pa_sd_open,
+    pa_sd_field,
+    pa_sd_close,
+    pa_sd_value_open,
+    pa_sd_value_escaped,
+    pa_head_end,
+    pa_head_message,
+    pa_message
 } parser_action;
 
 
-// Supporting functions
-void free_msg_head_fields(syslog_msg_head *head) {
-    if (head->timestamp != NULL) {
-        cstr_free(head->timestamp);
-        head->timestamp = NULL;
-    }
-
-    if (head->hostname != NULL) {
-        cstr_free(head->hostname);
-        head->hostname = NULL;
-    }
+// Tables
+static const unsigned char char_classes[256] = {
+    /*   0 -  15 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_bl, c_lf, c_ot, c_ot, c_cr, c_ot, c_ot,
+    /*  16 -  31 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /*  32 -  47 */  c_bl, c_ot, c_qt, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ds, c_ot, c_ot,
+    /*  48 -  63 */  c_dg, c_dg, c_dg, c_dg, c_dg, c_dg, c_dg, c_dg, c_dg, c_dg, c_ot, c_ot, c_lt, c_ot, c_gt, c_ot,
+    /*  64 -  79 */  c_ot, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al,
+    /*  80 -  95 */  c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_lb, c_ot, c_rb, c_ot, c_ot,
+    /*  96 - 111 */  c_ot, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al,
+    /* 112 - 127 */  c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_al, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 128 - 143 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 144 - 159 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 160 - 175 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 176 - 191 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 192 - 207 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 208 - 223 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 224 - 239 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot,
+    /* 240 - 255 */  c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot, c_ot
+};
+
+// Rows for states that skip blanks before reading a token and those that
+// take every byte as it comes
+#define SKIP_BLANKS(a)  { a, a, a, pa_skip, pa_cr, a, a, a, a, a, a, a }
+#define EVERY_CLASS(a)  { a, a, a, a, a, a, a, a, a, a, a, a }
+
+// Indexed by state, then token state, then byte class
+static const unsigned char transitions[][2][CHAR_CLASS_COUNT] = {
+    [s_msg_start] = {
+        SKIP_BLANKS(pa_msg_begin),
+        SKIP_BLANKS(pa_msg_begin)
+    },
+    [s_octet_count] = {
+        { [c_dg] = pa_octet_digit, [c_bl] = pa_octet_end, [c_cr] = pa_octet_end, [c_lf] = pa_octet_end },
+        { [c_dg] = pa_octet_digit, [c_bl] = pa_octet_end, [c_cr] = pa_octet_end, [c_lf] = pa_octet_end }
+    },
+    [s_priority_start] = {
+        { [c_bl] = pa_skip, [c_cr] = pa_cr, [c_lt] = pa_priority_open },
+        { [c_lt] = pa_priority_open }
+    },
+    [s_priority] = {
+        { [c_bl] = pa_skip, [c_cr] = pa_cr, [c_dg] = pa_priority_digit, [c_gt] = pa_priority_close },
+        { [c_dg] = pa_priority_digit, [c_gt] = pa_priority_close }
+    },
+    [s_version] = {
+        { pa_version_end, pa_version_digit, pa_version_end, pa_skip, pa_cr, pa_version_end,
+          pa_version_end, pa_version_end, pa_version_end, pa_version_end, pa_version_end, pa_version_end },
+        { pa_version_end, pa_version_digit, pa_version_end, pa_version_end, pa_version_end, pa_version_end,
+          pa_version_end, pa_version_end, pa_version_end, pa_version_end, pa_version_end, pa_version_end }
+    },
+    [s_timestamp] = { SKIP_BLANKS(pa_token), EVERY_CLASS(pa_token) },
+    [s_hostname] = { SKIP_BLANKS(pa_token), EVERY_CLASS(pa_token) },
+    [s_appname] = { SKIP_BLANKS(pa_token), EVERY_CLASS(pa_token) },
+    [s_processid] = { SKIP_BLANKS(pa_token), EVERY_CLASS(pa_token) },
+    [s_messageid] = { SKIP_BLANKS(pa_token), EVERY_CLASS(pa_token) },
+    [s_sd_start] = {
+        { pa_head_message, pa_head_message, pa_head_message, pa_skip, pa_cr, pa_head_message,
+          pa_head_message, pa_head_message, pa_sd_open, pa_head_message, pa_head_end, pa_head_message },
+        { pa_head_message, pa_head_message, pa_head_message, pa_head_message, pa_head_message, pa_head_message,
+          pa_head_message, pa_head_message, pa_sd_open, pa_head_message, pa_head_end, pa_head_message }
+    },
+    [s_sd_element] = { SKIP_BLANKS(pa_token), EVERY_CLASS(pa_token) },
+    [s_sd_field_start] = {
+        { [c_bl] = pa_skip, [c_cr] = pa_cr, [c_dg] = pa_sd_field, [c_al] = pa_sd_field, [c_rb] = pa_sd_close },
+        { [c_dg] = pa_sd_field, [c_al] = pa_sd_field, [c_rb] = pa_sd_close }
+    },
+    [s_sd_field] = { EVERY_CLASS(pa_token), EVERY_CLASS(pa_token) },
+    [s_sd_value_start] = {
+        { [c_bl] = pa_skip, [c_cr] = pa_cr, [c_qt] = pa_sd_value_open },
+        { [c_qt] = pa_sd_value_open }
+    },
+    [s_sd_value] = { EVERY_CLASS(pa_token), EVERY_CLASS(pa_token) },
+    [s_sd_value_escaped] = { EVERY_CLASS(pa_sd_value_escaped), EVERY_CLASS(pa_sd_value_escaped) },
+    [s_message] = { SKIP_BLANKS(pa_message), EVERY_CLASS(pa_message) }
+};
+
+// The error reported when a state has no transition for a byte
+static const unsigned char state_errors[] = {
+    [s_msg_start] = SLERR_BAD_PRIORITY_START,
+    [s_octet_count] = SLERR_BAD_OCTET_COUNT,
+    [s_priority_start] = SLERR_BAD_PRIORITY_START,
+    [s_priority] = SLERR_BAD_PRIORITY,
+    [s_version] = SLERR_BAD_VERSION,
+    [s_sd_start] = SLERR_BAD_SD_START,
+    [s_sd_field_start] = SLERR_BAD_SD_FIELD,
+    [s_sd_value_start] = SLERR_BAD_SD_VALUE,
+    [s_message] = SLERR_BAD_STATE
+};
 
-    if (head->appname != NULL) {
-        cstr_free(head->appname);
-        head->appname = NULL;
-    }
-
-    if (head->processid != NULL) {
-        cstr_free(head->processid);
-        head->processid = NULL;
-    }
-
-    if (head->messageid != NULL) {
-        cstr_free(head->messageid);
-        head->messageid = NULL;
-    }
-}
 
+// Supporting functions
 void reset_msg_head(syslog_msg_head *head) {
-    free_msg_head_fields(head);
-
-    head->priority = 0;
-    head->version = 0;
+    memset(head, 0, sizeof(*head));
 }
 
 void on_cb(syslog_parser *parser, syslog_cb cb) {
@@ -104,14 +210,75 @@ void on_cb(syslog_parser *parser, syslog_cb cb) {
     }
 }
 
-void on_data_cb(syslog_parser *parser, syslog_data_cb cb) {
-    const int error = cb(parser, parser->buffer->data->bytes, parser->buffer->position);
+void on_data_cb(syslog_parser *parser, syslog_data_cb cb, const char *data, size_t length) {
+    const int error = cb(parser, data, length);
 
     if (error) {
         parser->error = SLERR_USER_ERROR;
     }
+}
 
-    cstr_buff_reset(parser->buffer);
+/**
+* Counts header bytes against the message. Octet counted messages may not
+* have a head longer than the count itself.
+*/
+void count_octets(syslog_parser *parser, size_t octets) {
+    if (parser->flags & F_COUNT_OCTETS) {
+        if (octets > parser->octets_remaining) {
+            parser->error = SLERR_BAD_OCTET_COUNT;
+            return;
+        }
+
+        parser->octets_remaining -= octets;
+    } else {
+        parser->message_length += octets;
+    }
+}
+
+/**
+* Finds the first whitespace byte in a run of bytes. Every whitespace byte
+* sorts below '!' so the run is tested a word at a time and only the words
+* that may hold whitespace are inspected byte by byte. Returns NULL if the
+* run holds no whitespace.
+*/
+const char * find_ws(const char *data, size_t length) {
+    const char *end = data + length;
+    uint64_t word;
+    size_t w_index;
+
+    while ((size_t) (end - data) >= sizeof(word)) {
+        memcpy(&word, data, sizeof(word));
+
+        if (HAS_BYTE_BELOW(word, '!')) {
+            for (w_index = 0; w_index < sizeof(word); w_index++) {
+                if (IS_WS(data[w_index])) {
+                    return data + w_index;
+                }
+            }
+        }
+
+        data += sizeof(word);
+    }
+
+    for (; data < end; data++) {
+        if (IS_WS(*data)) {
+            return data;
+        }
+    }
+
+    return NULL;
+}
+
+/**
+* Finds the byte that interrupts an SDATA value, either the closing quote or
+* an escape that has to be handled before the value can continue. Returns
+* NULL if the run holds neither.
+*/
+const char * find_sd_value_end(const char *data, size_t length) {
+    const char *quote = memchr(data, '"', length);
+    const char *escape = memchr(data, '\\', quote != NULL ? (size_t) (quote - data) : length);
+
+    return escape != NULL ? escape : quote;
 }
 
 #if DEBUG_OUTPUT
@@ -149,6 +316,8 @@ char * get_state_name(syslog_state state) {
             return "sd_value_start";
         case s_sd_value:
             return "sd_value";
+        case s_sd_value_escaped:
+            return "sd_value_escaped";
         case s_sd_end:
             return "sd_end";
         case s_message:
@@ -179,443 +348,724 @@ void set_state(syslog_parser *parser, syslog_state next_state) {
     set_token_state(parser, ts_before);
 }
 
-void set_str_field(syslog_parser *parser) {
-    const cstr_buff *buffer = parser->buffer;
-
-    cstr *value = cstr_copy_from_cstr(buffer->data, buffer->position);
+/**
+* True when the token being read is wanted. SDATA tokens are always wanted
+* since the SDATA section is never entered when it isn't.
+*/
+bool field_wanted(const syslog_parser *parser) {
+    return parser->state < s_timestamp || parser->state > s_messageid ||
+        (parser->fields & (1 << (parser->state - s_timestamp)));
+}
 
-    if (value == NULL) {
-        parser->error = SLERR_UNABLE_TO_ALLOCATE;
+/**
+* Moves on to the next field of the head. When none of the fields left in
+* the head are wanted the head ends here and everything after it is read as
+* the message body.
+*/
+void field_end(syslog_parser *parser, const syslog_parser_settings *settings, syslog_state next_state) {
+    if (parser->fields >> (next_state - s_timestamp)) {
+        set_state(parser, next_state);
     } else {
-        switch (parser->state) {
-            case s_timestamp:
-                parser->msg_head->timestamp = value;
-                break;
-
-            case s_hostname:
-                parser->msg_head->hostname = value;
-                break;
+        set_state(parser, s_message);
+        on_cb(parser, settings->on_msg_head_complete);
+    }
+}
 
-            case s_appname:
-                parser->msg_head->appname = value;
-                break;
+bool has_prefix(const cstr *field, const cstr *prefix) {
+    return field->size >= prefix->size &&
+        memcmp(field->bytes, prefix->bytes, prefix->size) == 0;
+}
 
-            case s_processid:
-                parser->msg_head->processid = value;
-                break;
+/**
+* Runs the filter checks that can be made once the given head field has been
+* read. A message that fails is read past from here on without any more
+* callbacks. When no checks are left on_msg_begin is finally called, which
+* lets a filtered parser drop messages before the application has seen any
+* of them. Returns true when the message carries on.
+*/
+bool filter_msg(syslog_parser *parser, const syslog_parser_settings *settings, syslog_state read_state) {
+    const syslog_filter *filter = parser->filter;
+    const syslog_msg_head *head = parser->msg_head;
+    syslog_state last_check = s_priority;
+    bool pass;
+
+    if (filter == NULL) {
+        return true;
+    }
 
-            case s_messageid:
-                parser->msg_head->messageid = value;
-                break;
+    switch (read_state) {
+        case s_priority: {
+            const unsigned int facility = head->priority >> 3;
 
-            default:
-                cstr_free(value);
+            pass = (head->priority & 7) <= filter->max_severity &&
+                facility < 32 && (filter->facilities >> facility) & 1;
+            break;
         }
 
-        cstr_buff_reset(parser->buffer);
+        case s_hostname:
+            pass = has_prefix(&head->hostname, &filter->hostname_prefix);
+            break;
+
+        case s_appname:
+            pass = has_prefix(&head->appname, &filter->appname_prefix);
+            break;
+
+        default:
+            pass = true;
+    }
+
+    if (!pass) {
+        parser->flags |= F_DISCARD;
+        parser->discarded++;
+
+        set_state(parser, s_message);
+        set_token_state(parser, ts_read);
+        return false;
+    }
+
+    if (filter->appname_prefix.size > 0) {
+        last_check = s_appname;
+    } else if (filter->hostname_prefix.size > 0) {
+        last_check = s_hostname;
     }
+
+    if (read_state == last_check) {
+        on_cb(parser, settings->on_msg_begin);
+    }
+
+    return true;
 }
 
 /**
-* Reads the message portion of a syslog message. This function returns an int
-* value representing the number of bytes read from the buffer.
+* Sets a header field as a span over the token bytes. Nothing is copied here;
+* spans that would outlive the bytes they point at are pinned into the head
+* arena by pin_msg_head.
 */
-int read_message(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length) {
-    bool msg_complete = false;
-    int read;
+void set_str_field(syslog_parser *parser, const char *data, size_t length) {
+    cstr *field;
 
-    if (parser->flags & F_COUNT_OCTETS) {
-        // If we're counting octets then the message ends when we run out of octets
-        read = parser->octets_remaining >= length ? length : parser->octets_remaining;
-        parser->octets_remaining -= read;
-        msg_complete = parser->octets_remaining == 0;
-    } else {
-        int d_index;
+    if (!field_wanted(parser)) {
+        return;
+    }
 
-        // If we're not counting octets then the \n character is EOF for the message
-        for (d_index = 0; d_index < length; d_index++) {
-            if (data[d_index] == '\n') {
-                msg_complete = true;
-                break;
-            }
-        }
+    switch (parser->state) {
+        case s_timestamp:
+            field = &parser->msg_head->timestamp;
+            break;
 
-        // We've read index + 1 number of bytes
-        read = d_index + 1;
-        parser->message_length += read;
+        case s_hostname:
+            field = &parser->msg_head->hostname;
+            break;
+
+        case s_appname:
+            field = &parser->msg_head->appname;
+            break;
+
+        case s_processid:
+            field = &parser->msg_head->processid;
+            break;
+
+        case s_messageid:
+            field = &parser->msg_head->messageid;
+            break;
+
+        default:
+            return;
     }
 
-    if (read > 0) {
-        // If we read something we need to pass it along
-        const int error = settings->on_msg_part(parser, data, read);
+    field->bytes = (char *) data;
+    field->size = length;
+}
 
-        if (error) {
-            parser->error = SLERR_USER_ERROR;
+/**
+* Copies every header field that still points outside of the head arena into
+* it. This has to happen before the bytes a span points at go away, either
+* because the token came out of the parser buffer or because the chunk being
+* parsed is about to be handed back to the caller. The arena is grown once
+* for all of the copies and fields already living in it are moved along
+* with it.
+*/
+void pin_msg_head(syslog_parser *parser) {
+    cstr *fields[] = {
+        &parser->msg_head->timestamp,
+        &parser->msg_head->hostname,
+        &parser->msg_head->appname,
+        &parser->msg_head->processid,
+        &parser->msg_head->messageid
+    };
+
+    cstr_buff *arena = parser->arena;
+    const char *base = arena->data->bytes;
+    ptrdiff_t offsets[HEAD_FIELD_COUNT];
+    size_t needed = 0;
+    int f_index;
+
+    for (f_index = 0; f_index < HEAD_FIELD_COUNT; f_index++) {
+        const cstr *field = fields[f_index];
+
+        if (field->size > 0 && field->bytes >= base && field->bytes < base + arena->position) {
+            offsets[f_index] = field->bytes - base;
+        } else {
+            offsets[f_index] = -1;
+            needed += field->size;
         }
     }
 
-    if (!parser->error && msg_complete) {
-        // If there was no error reported and the message is complete, pass it along
-        on_cb(parser, settings->on_msg_complete);
+    if (needed == 0) {
+        return;
+    }
 
-        if (!parser->error) {
-            // If there was no error, set the parser back to a blank slate
-            uslg_parser_reset(parser);
+    if (cstr_buff_reserve(arena, needed)) {
+        parser->error = SLERR_BUFFER_OVERFLOW;
+        return;
+    }
+
+    for (f_index = 0; f_index < HEAD_FIELD_COUNT; f_index++) {
+        cstr *field = fields[f_index];
+
+        if (offsets[f_index] >= 0) {
+            field->bytes = arena->data->bytes + offsets[f_index];
+        } else if (field->size > 0) {
+            char *pinned = arena->data->bytes + arena->position;
+
+            cstr_buff_append(arena, field->bytes, field->size);
+            field->bytes = pinned;
         }
     }
+}
 
-    return read;
+void buffer_token(syslog_parser *parser, const char *data, size_t length) {
+    if (cstr_buff_append(parser->buffer, data, length)) {
+        parser->error = SLERR_BUFFER_OVERFLOW;
+    }
 }
 
-int sd_value(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
-    switch (nb) {
-        case '\\':
-            parser->flags |= F_ESCAPED;
+/**
+* Hands off a complete header or SDATA token and moves the parser on to the
+* state that follows it.
+*/
+void on_token(syslog_parser *parser, const syslog_parser_settings *settings, const char *token, size_t length) {
+    switch (parser->state) {
+        case s_timestamp:
+            set_str_field(parser, token, length);
+
+            if (parser->options & SO_DECODE_TIMESTAMP) {
+                // Timestamps that fail to decode are still passed along raw
+                uslg_decode_timestamp(&parser->ts_cache, token, length, &parser->msg_head->decoded_timestamp);
+            }
+
+            field_end(parser, settings, s_hostname);
             break;
 
-        case '"':
-            if (parser->flags & F_ESCAPED) {
-                parser->flags |= F_ESCAPED;
-            } else {
-                on_data_cb(parser, settings->on_sd_value);
-                set_state(parser, s_sd_field_start);
+        case s_hostname:
+            set_str_field(parser, token, length);
+
+            if (filter_msg(parser, settings, s_hostname)) {
+                field_end(parser, settings, s_appname);
             }
             break;
 
-        default:
-            cstr_buff_put(parser->buffer, nb);
-    }
+        case s_appname:
+            set_str_field(parser, token, length);
 
-    return pa_advance;
-}
+            if (filter_msg(parser, settings, s_appname)) {
+                field_end(parser, settings, s_processid);
+            }
+            break;
 
-int sd_value_start(syslog_parser *parser, char nb) {
-    switch (nb) {
-        case '"':
-            set_state(parser, s_sd_value);
+        case s_processid:
+            set_str_field(parser, token, length);
+            field_end(parser, settings, s_messageid);
+            break;
+
+        case s_messageid:
+            set_str_field(parser, token, length);
+            field_end(parser, settings, s_sd_start);
+            break;
+
+        case s_sd_element:
+            on_data_cb(parser, settings->on_sd_element, token, length);
+            set_state(parser, s_sd_field_start);
+            break;
+
+        case s_sd_field:
+            on_data_cb(parser, settings->on_sd_field, token, length);
+            set_state(parser, s_sd_value_start);
+            break;
+
+        case s_sd_value:
+            on_data_cb(parser, settings->on_sd_value, token, length);
+            set_state(parser, s_sd_field_start);
             break;
 
         default:
-            parser->error = SLERR_BAD_SD_VALUE;
+            parser->error = SLERR_BAD_STATE;
     }
-
-    return pa_advance;
 }
 
-int sd_field(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
-    switch (nb) {
-        case '=':
-            on_data_cb(parser, settings->on_sd_field);
-            set_state(parser, s_sd_value_start);
+/**
+* Reads a header or SDATA token out of a run of bytes. The run is scanned for
+* the delimiter that ends the token in the current state. A token found whole
+* is handed off straight from the run while one that started in an earlier
+* chunk is finished in the parser buffer first. Header bytes are counted by
+* the caller. This function returns the number of bytes consumed, delimiter
+* included.
+*/
+size_t read_token(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length) {
+    const char *delim;
+    size_t read;
+
+    set_token_state(parser, ts_read);
+
+    switch (parser->state) {
+        case s_sd_field:
+            delim = memchr(data, '=', length);
+            break;
+
+        case s_sd_value:
+            delim = find_sd_value_end(data, length);
             break;
 
         default:
-            cstr_buff_put(parser->buffer, nb);
+            delim = find_ws(data, length);
     }
 
-    return pa_advance;
-}
+    if (delim == NULL) {
+        // The token runs past this chunk so hold on to what we have unless
+        // it is being skipped
+        if (field_wanted(parser)) {
+            buffer_token(parser, data, length);
+        }
 
-int sd_field_start(syslog_parser *parser, char nb) {
-    if (IS_ALPHANUM(nb)) {
-        cstr_buff_put(parser->buffer, nb);
-        set_state(parser, s_sd_field);
+        read = length;
     } else {
-        switch (nb) {
-            case ']':
-                set_state(parser, s_sd_start);
-                break;
+        const size_t token_length = delim - data;
+
+        if (*delim == '\\') {
+            // Escaped SDATA values have to be rebuilt in the buffer
+            buffer_token(parser, data, token_length);
+            set_state(parser, s_sd_value_escaped);
+        } else if (parser->buffer->position > 0) {
+            buffer_token(parser, data, token_length);
+
+            if (!parser->error) {
+                on_token(parser, settings, parser->buffer->data->bytes, parser->buffer->position);
+                pin_msg_head(parser);
+            }
 
-            default:
-                parser->error = SLERR_BAD_SD_FIELD;
+            cstr_buff_reset(parser->buffer);
+        } else {
+            on_token(parser, settings, data, token_length);
         }
+
+        read = token_length + 1;
     }
 
-    return pa_advance;
+    return read;
 }
 
-int sd_element(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
-    if (!IS_WS(nb)) {
-        cstr_buff_put(parser->buffer, nb);
+/**
+* Reads the message portion of a syslog message. When the whole message body
+* is available in the current chunk and the settings carry an on_msg_body
+* callback, the body is handed off in a single call in place of the
+* on_msg_part and on_msg_complete pair. This function returns an int value
+* representing the number of bytes read from the buffer.
+*/
+int read_message(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length) {
+    bool msg_complete = false;
+    size_t read;
+
+    // Blanks are part of the message once it has started
+    set_token_state(parser, ts_read);
+
+    if (parser->flags & F_COUNT_OCTETS) {
+        // If we're counting octets then the message ends when we run out of octets
+        read = parser->octets_remaining >= length ? length : parser->octets_remaining;
+        parser->octets_remaining -= read;
+        msg_complete = parser->octets_remaining == 0;
+    } else {
+        // If we're not counting octets then the \n character is EOF for the message
+        const char *eol = memchr(data, '\n', length);
+
+        if (eol != NULL) {
+            read = eol - data + 1;
+            msg_complete = true;
+        } else {
+            read = length;
+        }
+
+        parser->message_length += read;
+    }
+
+    if (parser->flags & F_DISCARD) {
+        // Filtered out messages are read past without a word
+    } else if (msg_complete && parser->octets_read == 0 && settings->on_msg_body != NULL) {
+        // The whole body is right here so pass it along in one go
+        on_data_cb(parser, settings->on_msg_body, data, read);
     } else {
-        on_data_cb(parser, settings->on_sd_element);
-        set_state(parser, s_sd_field_start);
+        if (read > 0) {
+            // If we read something we need to pass it along
+            on_data_cb(parser, settings->on_msg_part, data, read);
+            parser->octets_read += read;
+        }
+
+        if (!parser->error && msg_complete) {
+            // If there was no error reported and the message is complete, pass it along
+            on_cb(parser, settings->on_msg_complete);
+        }
     }
 
-    return pa_advance;
+    if (!parser->error && msg_complete) {
+        // If there was no error, set the parser back to a blank slate
+        uslg_parser_reset(parser);
+    }
+
+    return read;
 }
 
-int sd_start(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
-    int retval = pa_advance;
+void sd_value_escaped(syslog_parser *parser, char nb) {
+    // Only '"', '\\' and ']' are escapable, anything else keeps its backslash
+    if (nb != '"' && nb != '\\' && nb != ']') {
+        buffer_token(parser, "\\", 1);
+    }
 
-    switch (nb) {
-        case '[':
-            set_state(parser, s_sd_element);
-            break;
+    buffer_token(parser, &nb, 1);
 
-        case '-':
-            set_state(parser, s_message);
-            on_cb(parser, settings->on_msg_head_complete);
-            break;
+    // The rest of the value is read as-is, whitespace included
+    set_state(parser, s_sd_value);
+    set_token_state(parser, ts_read);
+}
 
-        default:
+void sd_value_open(syslog_parser *parser) {
+    // Whitespace inside the quotes belongs to the value
+    set_state(parser, s_sd_value);
+    set_token_state(parser, ts_read);
+}
 
-            set_state(parser, s_message);
-            on_cb(parser, settings->on_msg_head_complete);
-            retval = pa_rehash;
+void sd_close(syslog_parser *parser, const char *data) {
+    if (parser->msg_head->sd.bytes != NULL) {
+        parser->msg_head->sd.size = data + 1 - parser->msg_head->sd.bytes;
     }
 
-    return retval;
+    set_state(parser, s_sd_start);
 }
 
-int parse_msg_head_part(syslog_parser *parser, syslog_state next_state, char nb) {
-    if (!IS_WS(nb)) {
-        cstr_buff_put(parser->buffer, nb);
-    } else {
-        set_str_field(parser);
-        set_state(parser, next_state);
+void sd_open(syslog_parser *parser, const char *data) {
+    if (parser->msg_head->sd.bytes == NULL) {
+        // Mark where the SDATA section begins
+        parser->msg_head->sd.bytes = (char *) data;
     }
 
-    return pa_advance;
+    set_state(parser, s_sd_element);
 }
 
-int version(syslog_parser *parser, char nb) {
-    int retval = pa_advance;
-
-    if (IS_NUM(nb)) {
-        uint16_t nversion = parser->msg_head->version;
-        nversion *= 10;
-        nversion += nb - '0';
+/**
+* Moves the SDATA bytes of this chunk, up to end, into the SDATA buffer.
+*/
+void buffer_sd(syslog_parser *parser, const char *end) {
+    const char *start = parser->msg_head->sd.bytes;
 
-        if (nversion < parser->msg_head->version|| nversion > 999) {
-            parser->error = SLERR_BAD_VERSION;
-        } else {
-            parser->msg_head->version = nversion;
-        }
-    } else {
-        set_state(parser, s_timestamp);
+    if (cstr_buff_append(parser->sd_buffer, start, end - start)) {
+        parser->error = SLERR_BUFFER_OVERFLOW;
     }
-
-    return retval;
 }
 
-int priority(syslog_parser *parser, char nb) {
-    if (IS_NUM(nb)) {
-        uint16_t npriority = parser->msg_head->priority;
-        npriority *= 10;
-        npriority += nb - '0';
+void head_end(syslog_parser *parser, const syslog_parser_settings *settings) {
+    if (parser->flags & F_SD_BUFFERED) {
+        // The section ran across chunks so its span moves to the buffer
+        buffer_sd(parser, parser->msg_head->sd.bytes + parser->msg_head->sd.size);
 
-        if (npriority < parser->msg_head->priority || npriority > 999) {
-            parser->error = SLERR_BAD_PRIORITY;
-        } else {
-            parser->msg_head->priority = npriority;
+        if (parser->error) {
+            return;
         }
-    } else {
-        switch (nb) {
-            case '>':
-                set_state(parser, s_version);
-                break;
 
-            default:
-                parser->error = SLERR_BAD_PRIORITY;
-        }
+        parser->msg_head->sd.bytes = parser->sd_buffer->data->bytes;
+        parser->msg_head->sd.size = parser->sd_buffer->position;
     }
 
-    return pa_advance;
+    set_state(parser, s_message);
+    on_cb(parser, settings->on_msg_head_complete);
 }
 
-int priority_start(syslog_parser *parser, char nb) {
-    switch(nb) {
-        case '<':
-            set_state(parser, s_priority);
-            break;
+void version_digit(syslog_parser *parser, char nb) {
+    uint16_t nversion = parser->msg_head->version;
+    nversion *= 10;
+    nversion += nb - '0';
 
-        default:
-            parser->error = SLERR_BAD_PRIORITY_START;
+    if (nversion < parser->msg_head->version || nversion > 999) {
+        parser->error = SLERR_BAD_VERSION;
+    } else {
+        parser->msg_head->version = nversion;
+        set_token_state(parser, ts_read);
     }
-
-    return pa_advance;
 }
 
-int octet_count(syslog_parser *parser, char nb) {
-    int retval = pa_advance;
+void priority_digit(syslog_parser *parser, char nb) {
+    uint16_t npriority = parser->msg_head->priority;
+    npriority *= 10;
+    npriority += nb - '0';
 
-    if (IS_NUM(nb)) {
-        size_t mlength = parser->octets_remaining;
+    if (npriority < parser->msg_head->priority || npriority > 999) {
+        parser->error = SLERR_BAD_PRIORITY;
+    } else {
+        parser->msg_head->priority = npriority;
+        set_token_state(parser, ts_read);
+    }
+}
 
-        mlength *= 10;
-        mlength += nb - '0';
+void octet_digit(syslog_parser *parser, char nb) {
+    size_t mlength = parser->octets_remaining;
 
-        if (mlength < parser->octets_remaining || mlength == UINT_MAX) {
-            parser->error = SLERR_BAD_OCTET_COUNT;
-        } else {
-            parser->octets_remaining = mlength;
-        }
-    } else if (IS_WS(nb)) {
-        parser->flags |= F_COUNT_OCTETS;
-        parser->octets_remaining += 1;
-        parser->message_length += parser->octets_remaining;
-
-        set_state(parser, s_priority_start);
+    mlength *= 10;
+    mlength += nb - '0';
 
-        retval = pa_rehash;
-    } else {
+    if (mlength < parser->octets_remaining || mlength == UINT_MAX) {
         parser->error = SLERR_BAD_OCTET_COUNT;
+    } else {
+        parser->octets_remaining = mlength;
     }
+}
 
-    return retval;
+/**
+* Ends the octet count. The count covers everything after the delimiter and
+* the message length covers the count prefix as well.
+*/
+void octet_end(syslog_parser *parser) {
+    parser->flags |= F_COUNT_OCTETS;
+    parser->message_length += parser->octets_remaining;
+
+    set_state(parser, s_priority_start);
 }
 
-int msg_start(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
-    on_cb(parser, settings->on_msg_begin);
+void msg_begin(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
+    if (parser->filter == NULL) {
+        // Filtered parsers wait until the message has passed the filter
+        on_cb(parser, settings->on_msg_begin);
+    }
+
+    if (parser->error) {
+        return;
+    }
 
-    if (IS_NUM(nb)) {
+    if (IS_NUM(nb) && !(parser->flags & F_COUNT_OCTETS)) {
         set_state(parser, s_octet_count);
+        set_token_state(parser, ts_read);
+        octet_digit(parser, nb);
+    } else if (nb == '<') {
+        set_state(parser, s_priority);
     } else {
-        set_state(parser, s_priority_start);
+        parser->error = SLERR_BAD_PRIORITY_START;
     }
-
-    return pa_rehash;
 }
 
-// Big state switch
+/**
+* Runs the parser over a chunk of data. Each byte is classified and looked up
+* in the transition table along with the parser state to find the action to
+* take. Tokens and message bodies are scanned as runs by the actions that
+* start them. Header bytes are not counted one at a time; they are counted
+* in one go when the message body starts, when the octet count ends and at
+* the end of the chunk.
+*/
 int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length) {
-    int d_index;
+    const char *next = data;
+    const char *end = data + length;
+
+    // Header bytes before this have been counted against the message
+    const char *counted = data;
     int error = 0;
-    char next_byte;
 
-    for (d_index = 0; d_index < length; d_index++) {
-        int action = pa_none;
-        next_byte = data[d_index];
+    if (parser->flags & F_SD_BUFFERED) {
+        // The rest of the SDATA section starts with this chunk
+        parser->msg_head->sd.bytes = (char *) data;
+        parser->msg_head->sd.size = 0;
+    }
+
+    while (next < end) {
+        const char next_byte = *next;
+        size_t read = 1;
 
 #if DEBUG_OUTPUT
         printf("Next byte: %c\n", next_byte);
 #endif
 
-        // Token state is managed first
-        if (parser->token_state == ts_before) {
-            switch (next_byte) {
-                case ' ':
-                case '\t':
-                    action = pa_advance;
-                    break;
+        switch (transitions[parser->state][parser->token_state][char_classes[(unsigned char) next_byte]]) {
+            case pa_skip:
+                break;
 
-                case '\r':
-                //case '\n':  removed for issues with syslog messages with empty msg field
+            case pa_cr:
+                if (!(parser->flags & F_COUNT_OCTETS)) {
+                    parser->error = SLERR_PREMATURE_MSG_END;
+                }
+                break;
 
-                    if (!(parser->flags & F_COUNT_OCTETS)) {
-                        parser->error = SLERR_PREMATURE_MSG_END;
-                    }
-                    break;
+            case pa_msg_begin:
+                msg_begin(parser, settings, next_byte);
+                break;
 
-                default:
-                    set_token_state(parser, ts_read);
-                    action = pa_rehash;
-            }
-        } else {
-            // Parser state
-            switch (parser->state) {
-                case s_msg_start:
-                    action = msg_start(parser, settings, next_byte);
-                    break;
+            case pa_octet_digit:
+                octet_digit(parser, next_byte);
+                break;
 
-                case s_octet_count:
-                    action = octet_count(parser, next_byte);
-                    break;
+            case pa_octet_end:
+                count_octets(parser, next + 1 - counted);
+                counted = next + 1;
+                octet_end(parser);
+                break;
 
-                case s_priority_start:
-                    action = priority_start(parser, next_byte);
-                    break;
+            case pa_priority_open:
+                set_state(parser, s_priority);
+                break;
 
-                case s_priority:
-                    action = priority(parser, next_byte);
-                    break;
+            case pa_priority_digit:
+                priority_digit(parser, next_byte);
+                break;
 
-                case s_version:
-                    action = version(parser, next_byte);
-                    break;
+            case pa_priority_close:
+                if (filter_msg(parser, settings, s_priority)) {
+                    set_state(parser, s_version);
+                }
+                break;
 
-                case s_timestamp:
-                    action = parse_msg_head_part(parser, s_hostname, next_byte);
-                    break;
+            case pa_version_digit:
+                version_digit(parser, next_byte);
+                break;
 
-                case s_hostname:
-                    action = parse_msg_head_part(parser, s_appname, next_byte);
-                    break;
+            case pa_version_end:
+                field_end(parser, settings, s_timestamp);
+                break;
 
-                case s_appname:
-                    action = parse_msg_head_part(parser, s_processid, next_byte);
-                    break;
+            case pa_sd_field:
+                set_state(parser, s_sd_field);
+                read = read_token(parser, settings, next, end - next);
+                break;
 
-                case s_processid:
-                    action = parse_msg_head_part(parser, s_messageid, next_byte);
-                    break;
+            case pa_token:
+                read = read_token(parser, settings, next, end - next);
+                break;
 
-                case s_messageid:
-                    action = parse_msg_head_part(parser, s_sd_start, next_byte);
-                    break;
+            case pa_sd_open:
+                sd_open(parser, next);
+                break;
 
-                case s_sd_start:
-                    action = sd_start(parser, settings, next_byte);
-                    break;
+            case pa_sd_close:
+                sd_close(parser, next);
+                break;
 
-                case s_sd_element:
-                    action = sd_element(parser, settings, next_byte);
-                    break;
+            case pa_sd_value_open:
+                sd_value_open(parser);
+                break;
 
-                case s_sd_field_start:
-                    action = sd_field_start(parser, next_byte);
-                    break;
+            case pa_sd_value_escaped:
+                sd_value_escaped(parser, next_byte);
+                break;
 
-                case s_sd_field:
-                    action = sd_field(parser, settings, next_byte);
-                    break;
+            case pa_head_end:
+                head_end(parser, settings);
+                break;
 
-                case s_sd_value_start:
-                    action = sd_value_start(parser, next_byte);
-                    break;
+            case pa_head_message:
+                // The byte that ended the head is where the message starts
+                head_end(parser, settings);
 
-                case s_sd_value:
-                    action = sd_value(parser, settings, next_byte);
+                if (parser->error) {
                     break;
+                }
 
-                case s_message:
-                    d_index += read_message(parser, settings, data + d_index, length - d_index);
-                    action = pa_rehash;
-                    break;
+                // Fall through
 
-                default:
-                    parser->error = SLERR_BAD_STATE;
-            }
+            case pa_message:
+                count_octets(parser, next - counted);
+
+                if (!parser->error) {
+                    read = read_message(parser, settings, next, end - next);
+                    counted = next + read;
+                }
+                break;
+
+            default:
+                parser->error = state_errors[parser->state] ? state_errors[parser->state] : SLERR_BAD_STATE;
         }
 
-        // Upon error, exit the read loop regardless of action
+        // Upon error, exit the read loop
         if (parser->error) {
             error = parser->error;
             uslg_parser_reset(parser);
             break;
         }
 
-        // What action should be taken for this byte
-        switch (action) {
-            case pa_advance:
-                if (parser->flags & F_COUNT_OCTETS) {
-                    parser->octets_remaining--;
-                } else {
-                    parser->message_length++;
-                }
+        next += read;
+    }
 
-                break;
+    if (!error) {
+        count_octets(parser, end - counted);
 
-            case pa_rehash:
-                d_index--;
-                break;
+        if (parser->state != s_msg_start) {
+            // The message continues in the next chunk so its header fields
+            // can no longer point into this one
+            pin_msg_head(parser);
+
+            if (parser->state >= s_sd_start && parser->state < s_message && parser->msg_head->sd.bytes != NULL) {
+                // Neither can the SDATA span. Between elements the section
+                // only runs up to the last closing bracket.
+                cstr *sd = &parser->msg_head->sd;
+
+                buffer_sd(parser, parser->state == s_sd_start ? sd->bytes + sd->size : end);
+                parser->flags |= F_SD_BUFFERED;
+                sd->bytes = NULL;
+                sd->size = 0;
+            }
+        }
+
+        if (parser->error) {
+            error = parser->error;
+            uslg_parser_reset(parser);
         }
     }
 
     return error;
 }
 
+/**
+* Runs the parser over one whole message that is framed by neither an octet
+* count nor a trailing newline, such as a syslog datagram. The message is
+* counted as if its length had been given as its octet count and any message
+* in flight is dropped first. A message that ends before its head does is an
+* error.
+*/
+int uslg_parser_exec_message(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length) {
+    int error;
+
+    uslg_parser_reset(parser);
+
+    if (length == 0) {
+        return 0;
+    }
+
+    parser->flags |= F_COUNT_OCTETS;
+    parser->octets_remaining = length;
+    parser->message_length = length;
+
+    error = uslg_parser_exec(parser, settings, data, length);
+
+    if (error || parser->state == s_msg_start) {
+        return error;
+    }
+
+    if (parser->state == s_message && parser->octets_remaining == 0) {
+        // The head took up the whole message, which has an empty body
+        read_message(parser, settings, data + length, 0);
+        error = parser->error;
+    } else {
+        error = SLERR_PREMATURE_MSG_END;
+    }
+
+    if (error) {
+        uslg_parser_reset(parser);
+    }
+
+    return error;
+}
+
 
 // Exported Functions
 
@@ -628,12 +1078,15 @@ void uslg_parser_reset(syslog_parser *parser) {
 
     reset_msg_head(parser->msg_head);
     cstr_buff_reset(parser->buffer);
+    cstr_buff_reset(parser->arena);
+    cstr_buff_reset(parser->sd_buffer);
     set_state(parser, s_msg_start);
     set_token_state(parser, ts_before);
 }
 
 int uslg_parser_init(syslog_parser *parser, void *app_data) {
     memset(parser, 0, sizeof(*parser));
+    parser->fields = SF_ALL;
 
     // Create the msg_head
     parser->msg_head = (syslog_msg_head *) malloc(sizeof(syslog_msg_head));
@@ -646,13 +1099,30 @@ int uslg_parser_init(syslog_parser *parser, void *app_data) {
     memset(parser->msg_head, 0, sizeof(syslog_msg_head));
 
     parser->app_data = app_data;
-    parser->buffer = cstr_buff_new(MAX_BUFFER_SIZE);
+    // The buffers start small and only grow for the connections that need it
+    parser->buffer = cstr_buff_new_growable(INITIAL_BUFFER_SIZE, MAX_BUFFER_SIZE);
+    parser->arena = cstr_buff_new_growable(INITIAL_BUFFER_SIZE, HEAD_ARENA_SIZE);
+    parser->sd_buffer = cstr_buff_new_growable(INITIAL_BUFFER_SIZE, MAX_BUFFER_SIZE);
+
+    if (parser->buffer == NULL || parser->arena == NULL || parser->sd_buffer == NULL) {
+        // Allocating the buffers failed so let go
+        // of the memory we just allocated
+        if (parser->buffer != NULL) {
+            cstr_buff_free(parser->buffer);
+            parser->buffer = NULL;
+        }
+
+        if (parser->arena != NULL) {
+            cstr_buff_free(parser->arena);
+            parser->arena = NULL;
+        }
+
+        if (parser->sd_buffer != NULL) {
+            cstr_buff_free(parser->sd_buffer);
+            parser->sd_buffer = NULL;
+        }
 
-    if (parser->buffer == NULL) {
-        // Allocating the buffer failed so let go
-        // of the memory we just allocated for the
-        // msg_head struct
-        free_msg_head_fields(parser->msg_head);
+        free(parser->msg_head);
         parser->msg_head = NULL;
         return SLERR_UNABLE_TO_ALLOCATE;
     }
@@ -661,13 +1131,42 @@ int uslg_parser_init(syslog_parser *parser, void *app_data) {
     return 0;
 }
 
+void uslg_parser_trim(syslog_parser *parser) {
+    uslg_parser_reset(parser);
+    cstr_buff_trim(parser->buffer);
+    cstr_buff_trim(parser->arena);
+    cstr_buff_trim(parser->sd_buffer);
+}
+
 void uslg_free_parser(syslog_parser *parser) {
-    free_msg_head_fields(parser->msg_head);
     cstr_buff_free(parser->buffer);
+    cstr_buff_free(parser->arena);
+    cstr_buff_free(parser->sd_buffer);
     free(parser->msg_head);
     free(parser);
 }
 
+/**
+* Parses a raw STRUCTURED-DATA section on its own, as found in a message
+* head's sd span, calling only the SDATA callbacks of the settings. The
+* parser is reset before and after.
+*/
+int uslg_parse_sd(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length) {
+    int error;
+
+    uslg_parser_reset(parser);
+    set_state(parser, s_sd_start);
+
+    error = uslg_parser_exec(parser, settings, data, length);
+
+    if (!error && parser->state != s_sd_start) {
+        error = SLERR_PREMATURE_MSG_END;
+    }
+
+    uslg_parser_reset(parser);
+    return error;
+}
+
 char * uslg_error_string(int error) {
     switch (error) {
         case SLERR_UNCAUGHT:
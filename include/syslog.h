@@ -6,6 +6,7 @@ extern "C" {
 #endif
 
 #include "cstr.h"
+#include "timestamp.h"
 #include <stdint.h>
 #include <sys/types.h>
 
@@ -14,6 +15,7 @@ extern "C" {
 typedef struct syslog_parser syslog_parser;
 typedef struct syslog_msg_head syslog_msg_head;
 typedef struct syslog_parser_settings syslog_parser_settings;
+typedef struct syslog_filter syslog_filter;
 
 typedef int (*syslog_cb) (syslog_parser *parser);
 typedef int (*syslog_data_cb) (syslog_parser *parser, const char *data, size_t len);
@@ -23,8 +25,26 @@ typedef int (*syslog_data_cb) (syslog_parser *parser, const char *data, size_t l
 enum flags {
     F_RFC_3164       = 1 << 0,
     F_RFC_5424       = 1 << 1,
-    F_ESCAPED        = 1 << 2,
-    F_COUNT_OCTETS   = 1 << 3
+    F_COUNT_OCTETS   = 1 << 3,
+    F_SD_BUFFERED    = 1 << 4,
+    F_DISCARD        = 1 << 5
+};
+
+// Fields of the message head that may be left out of parsing. They are in
+// the order they appear in a message.
+enum syslog_fields {
+    SF_TIMESTAMP     = 1 << 0,
+    SF_HOSTNAME      = 1 << 1,
+    SF_APPNAME       = 1 << 2,
+    SF_PROCESSID     = 1 << 3,
+    SF_MESSAGEID     = 1 << 4,
+    SF_SD            = 1 << 5,
+    SF_ALL           = (1 << 6) - 1
+};
+
+// Optional work the parser can be asked to do
+enum syslog_options {
+    SO_DECODE_TIMESTAMP = 1 << 0
 };
 
 
@@ -53,11 +73,21 @@ struct syslog_msg_head {
     uint16_t priority;
     uint16_t version;
 
-    cstr *timestamp;
-    cstr *hostname;
-    cstr *appname;
-    cstr *processid;
-    cstr *messageid;
+    // String fields are spans that point either into the data being parsed
+    // or into the parser's head arena; they are never individually allocated
+    cstr timestamp;
+    cstr hostname;
+    cstr appname;
+    cstr processid;
+    cstr messageid;
+
+    // The raw STRUCTURED-DATA section, brackets included. It points into
+    // the data being parsed unless the section ran across chunks, in which
+    // case it points into the parser's SDATA buffer.
+    cstr sd;
+
+    // The timestamp decoded, when SO_DECODE_TIMESTAMP is set
+    syslog_timestamp decoded_timestamp;
 };
 
 struct syslog_parser_settings {
@@ -68,14 +98,39 @@ struct syslog_parser_settings {
     syslog_cb         on_msg_head_complete;
     syslog_data_cb    on_msg_part;
     syslog_cb         on_msg_complete;
+
+    // Optional, called in place of on_msg_part and on_msg_complete when a
+    // message body arrives whole within a single chunk
+    syslog_data_cb    on_msg_body;
+};
+
+// Messages that fail any of these checks are read past without any
+// callbacks, on_msg_begin included
+struct syslog_filter {
+    // Highest severity value let through, 7 lets everything through
+    uint8_t max_severity;
+
+    // One bit per facility let through
+    uint32_t facilities;
+
+    // Prefixes the hostname and appname must start with, unchecked if empty
+    cstr hostname_prefix;
+    cstr appname_prefix;
 };
 
 struct syslog_parser {
     // Parser fields
-    unsigned char flags : 4;
+    unsigned char flags;
     unsigned char token_state;
     unsigned char state;
 
+    // Head fields to parse; the head ends after the last one wanted and
+    // the rest of the message is passed along as the message body
+    unsigned char fields;
+
+    // SO_* options
+    unsigned char options;
+
     // Errors
     unsigned char error;
 
@@ -85,21 +140,39 @@ struct syslog_parser {
     // Byte tracking fields
     size_t message_length;
     size_t octets_remaining;
-    size_t octets_read;
+    size_t octets_read;     // Message body octets passed along so far
 
     // Buffer
     cstr_buff *buffer;
 
+    // Per-message arena for header fields that outlive their chunk
+    cstr_buff *arena;
+
+    // The raw SDATA read so far when the section runs across chunks
+    cstr_buff *sd_buffer;
+
+    // Optional message filter, owned by the caller
+    const syslog_filter *filter;
+
+    // Messages dropped by the filter
+    size_t discarded;
+
+    // The last timestamp date and hour decoded
+    syslog_ts_cache ts_cache;
+
     // Optionally settable application data pointer
     void *app_data;
 };
 
 // Functions
 void uslg_parser_reset(syslog_parser *parser);
+void uslg_parser_trim(syslog_parser *parser);
 void uslg_free_parser(syslog_parser *parser);
 
 int uslg_parser_init(syslog_parser *parser, void *app_data);
 int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length);
+int uslg_parser_exec_message(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length);
+int uslg_parse_sd(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length);
 
 char * uslg_error_string(int error);
 
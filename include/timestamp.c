@@ -0,0 +1,180 @@
+#include "timestamp.h"
+
+#include <string.h>
+
+// Macros
+#define IS_NUM(c)               ((c) >= '0' && (c) <= '9')
+#define MIN_TIMESTAMP_LENGTH    20      // YYYY-MM-DDTHH:MM:SSZ
+#define MAX_FRACTION_DIGITS     6
+
+
+// Supporting functions
+
+/**
+* Reads count digits into value. Returns nonzero if any of them is not a
+* digit.
+*/
+int read_digits(const char *data, int count, int *value) {
+    int d_index;
+
+    *value = 0;
+
+    for (d_index = 0; d_index < count; d_index++) {
+        if (!IS_NUM(data[d_index])) {
+            return 1;
+        }
+
+        *value = *value * 10 + (data[d_index] - '0');
+    }
+
+    return 0;
+}
+
+int is_leap_year(int year) {
+    return (year % 4 == 0 && year % 100 != 0) || year % 400 == 0;
+}
+
+int days_in_month(int year, int month) {
+    static const int days[] = {31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31};
+
+    return month == 2 && is_leap_year(year) ? 29 : days[month - 1];
+}
+
+/**
+* Days between 1970-01-01 and the given civil date, following the proleptic
+* Gregorian calendar.
+*/
+int64_t days_from_civil(int year, int month, int day) {
+    int64_t era;
+    int64_t year_of_era;
+    int64_t day_of_year;
+    int64_t day_of_era;
+
+    year -= month <= 2;
+    era = (year >= 0 ? year : year - 399) / 400;
+    year_of_era = year - era * 400;
+    day_of_year = (153 * (month + (month > 2 ? -3 : 9)) + 2) / 5 + day - 1;
+    day_of_era = year_of_era * 365 + year_of_era / 4 - year_of_era / 100 + day_of_year;
+
+    return era * 146097 + day_of_era - 719468;
+}
+
+/**
+* Decodes the YYYY-MM-DDTHH prefix into the seconds from the epoch to the
+* start of that hour, not yet adjusted for the UTC offset.
+*/
+int decode_prefix(const char *data, int64_t *seconds) {
+    int year, month, day, hour;
+
+    if (read_digits(data, 4, &year) || data[4] != '-' ||
+            read_digits(data + 5, 2, &month) || data[7] != '-' ||
+            read_digits(data + 8, 2, &day) || data[10] != 'T' ||
+            read_digits(data + 11, 2, &hour)) {
+        return 1;
+    }
+
+    if (month < 1 || month > 12 || day < 1 ||
+            day > days_in_month(year, month) || hour > 23) {
+        return 1;
+    }
+
+    *seconds = days_from_civil(year, month, day) * 86400 + hour * 3600;
+    return 0;
+}
+
+
+// Exported Functions
+
+/**
+* Decodes an RFC 5424 timestamp, YYYY-MM-DDTHH:MM:SS[.ffffff](Z|+HH:MM|-HH:MM).
+* The date and hour are looked up in the cache before being decoded and the
+* cache is updated with them when they are not there. Returns nonzero and
+* leaves the timestamp untouched when the data is not a well formed
+* timestamp, the NILVALUE included.
+*/
+int uslg_decode_timestamp(syslog_ts_cache *cache, const char *data, size_t length, syslog_timestamp *timestamp) {
+    const char *end = data + length;
+    const char *next;
+    int64_t hour_seconds;
+    uint32_t microseconds = 0;
+    int offset = 0;
+    int minute, second;
+    int digits;
+
+    if (length < MIN_TIMESTAMP_LENGTH) {
+        return 1;
+    }
+
+    if (cache->valid && memcmp(cache->prefix, data, TS_PREFIX_LENGTH) == 0) {
+        hour_seconds = cache->seconds;
+    } else {
+        if (decode_prefix(data, &hour_seconds)) {
+            return 1;
+        }
+
+        memcpy(cache->prefix, data, TS_PREFIX_LENGTH);
+        cache->seconds = hour_seconds;
+        cache->valid = 1;
+    }
+
+    next = data + TS_PREFIX_LENGTH;
+
+    if (next[0] != ':' || read_digits(next + 1, 2, &minute) ||
+            next[3] != ':' || read_digits(next + 4, 2, &second) ||
+            minute > 59 || second > 59) {
+        return 1;
+    }
+
+    next += 6;
+
+    if (*next == '.') {
+        // Fractions are read to microseconds and padded out if shorter
+        for (next++, digits = 0; next < end && IS_NUM(*next); next++, digits++) {
+            if (digits >= MAX_FRACTION_DIGITS) {
+                return 1;
+            }
+
+            microseconds = microseconds * 10 + (*next - '0');
+        }
+
+        if (digits == 0) {
+            return 1;
+        }
+
+        for (; digits < MAX_FRACTION_DIGITS; digits++) {
+            microseconds *= 10;
+        }
+    }
+
+    if (next < end && *next == 'Z') {
+        next++;
+    } else if (end - next >= 6 && (*next == '+' || *next == '-')) {
+        int offset_hours, offset_minutes;
+
+        if (read_digits(next + 1, 2, &offset_hours) || next[3] != ':' ||
+                read_digits(next + 4, 2, &offset_minutes) ||
+                offset_hours > 23 || offset_minutes > 59) {
+            return 1;
+        }
+
+        offset = offset_hours * 60 + offset_minutes;
+
+        if (*next == '-') {
+            offset = -offset;
+        }
+
+        next += 6;
+    } else {
+        return 1;
+    }
+
+    if (next != end) {
+        return 1;
+    }
+
+    timestamp->seconds = hour_seconds + minute * 60 + second - offset * 60;
+    timestamp->microseconds = microseconds;
+    timestamp->offset = (int16_t) offset;
+    timestamp->decoded = 1;
+    return 0;
+}
@@ -0,0 +1,49 @@
+#ifndef timestamp_h
+#define timestamp_h
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include <stdint.h>
+#include <sys/types.h>
+
+
+// Macros
+#define TS_PREFIX_LENGTH        13      // YYYY-MM-DDTHH
+
+
+// Typedefs
+typedef struct syslog_timestamp syslog_timestamp;
+typedef struct syslog_ts_cache syslog_ts_cache;
+
+
+// Structs
+struct syslog_timestamp {
+    // Seconds since the epoch, UTC
+    int64_t seconds;
+    uint32_t microseconds;
+
+    // Minutes east of UTC the timestamp was written in
+    int16_t offset;
+
+    // Set once the fields above hold a decoded timestamp
+    uint8_t decoded;
+};
+
+// The date and hour of the last timestamp decoded, which consecutive
+// messages nearly always share
+struct syslog_ts_cache {
+    char prefix[TS_PREFIX_LENGTH];
+    int64_t seconds;
+    uint8_t valid;
+};
+
+
+// Functions
+int uslg_decode_timestamp(syslog_ts_cache *cache, const char *data, size_t length, syslog_timestamp *timestamp);
+
+#ifdef __cplusplus
+}
+#endif
+#endif
@@ -1,10 +1,23 @@
+import os
+import shutil
 import signal
+import tempfile
+
+from functools import partial
+
+from tornado.netutil import bind_sockets
 
 import portal.config as config
 
+from portal.compression import FrameCompressor
 from portal.log import get_logger, get_log_manager
-from portal.server import SyslogServer, start_io, stop_io
-from portal.transport import SyslogToZeroMQHandler, ZeroMQCaster
+from portal.processes import FanIn, Supervisor, cpu_count, worker_count
+from portal.serializers import get_serializer
+from portal.server import (
+    SyslogServer, SyslogUdpServer, bind_udp_socket, start_io, stop_io)
+from portal.spool import Spool
+from portal.transport import (
+    SendPipeline, ShardedCaster, SyslogToZeroMQHandler, ZeroMQCaster)
 
 
 def stop(signum, frame):
@@ -20,9 +33,92 @@ logging_manager.configure(config)
 _LOG = get_logger(__name__)
 
 
-if __name__ == '__main__':
+def new_compressor():
+    if config.zmq.compression_level is None:
+        return None
+
+    dictionary = None
+
+    if config.zmq.compression_dictionary:
+        with open(config.zmq.compression_dictionary, 'rb') as dict_file:
+            dictionary = dict_file.read()
+
+    return FrameCompressor(config.zmq.compression_level, dictionary)
+
+
+def new_caster(bind_host, spool_dir=None, compressor=None, connect=False):
+    # Set up the spool for when downstream workers fall behind
+    spool = None
+
+    if spool_dir:
+        spool = Spool(
+            spool_dir,
+            segment_size=config.zmq.spool_segment_size,
+            max_segments=config.zmq.spool_segments)
+
+    return ZeroMQCaster(
+        bind_host,
+        batch_size=config.zmq.batch_size,
+        batch_bytes=config.zmq.batch_bytes,
+        batch_interval=config.zmq.batch_interval,
+        copy_threshold=config.zmq.copy_threshold,
+        sndhwm=config.zmq.sndhwm,
+        spool=spool,
+        compressor=compressor,
+        io_threads=config.zmq.io_threads,
+        connect=connect)
+
+
+def worker_bind_host(bind_host, worker, stride):
+    # Every worker binds its own range of shard ports
+    if worker is None:
+        return bind_host
+    return bind_host[0], bind_host[1] + worker * stride
+
+
+def worker_spool_dir(spool_dir, worker):
+    if spool_dir and worker is not None:
+        # Each worker replays its own messages
+        return os.path.join(spool_dir, 'worker-{0}'.format(worker))
+    return spool_dir
+
+
+def run_worker(worker=None, sockets=None, udp_socket=None, fan_in=None):
     # Set up the zmq message caster
-    caster = ZeroMQCaster(config.core.zmq_bind_host)
+    compressor = new_compressor()
+    shard_bind_hosts = config.zmq.shard_bind_hosts
+    spool_dir = worker_spool_dir(config.zmq.spool_dir, worker)
+
+    if fan_in:
+        caster = new_caster(fan_in, spool_dir, compressor, connect=True)
+    elif shard_bind_hosts:
+        casters = list()
+
+        for bind_host in shard_bind_hosts:
+            bind_host = worker_bind_host(
+                bind_host, worker, len(shard_bind_hosts))
+            shard_spool_dir = spool_dir
+
+            if shard_spool_dir:
+                # Each shard replays its own messages
+                shard_spool_dir = os.path.join(
+                    spool_dir, '{0}_{1}'.format(*bind_host))
+            casters.append(
+                new_caster(bind_host, shard_spool_dir, compressor))
+
+        caster = ShardedCaster(casters, key=config.zmq.shard_key)
+    else:
+        caster = new_caster(config.core.zmq_bind_host, spool_dir, compressor)
+
+    serializer = get_serializer(config.zmq.serializer)
+
+    if config.zmq.send_thread:
+        # Serialize and send off the IOLoop
+        caster = SendPipeline(
+            caster,
+            serializer=serializer,
+            zero_copy=config.zmq.zero_copy,
+            max_pending=config.zmq.send_queue_size)
 
     ssl_options = None
 
@@ -36,12 +132,45 @@ if __name__ == '__main__':
 
         _LOG.debug('SSL enabled: {}'.format(ssl_options))
 
-    # Set up the syslog server
+    # Set up the syslog servers
+    handler = SyslogToZeroMQHandler(
+        caster,
+        serializer=serializer,
+        zero_copy=config.zmq.zero_copy)
+    reuse_port = worker is not None and config.core.reuse_port
+
     syslog_server = SyslogServer(
         config.core.syslog_bind_host,
-        SyslogToZeroMQHandler(caster),
-        ssl_options)
-    syslog_server.start()
+        handler,
+        ssl_options,
+        decode_timestamp=config.core.decode_timestamps,
+        head_cache_size=config.core.head_cache_size,
+        reuse_port=reuse_port)
+    syslog_server.start(sockets)
+    servers = [syslog_server]
+
+    if config.core.udp_bind_host:
+        udp_server = SyslogUdpServer(
+            config.core.udp_bind_host,
+            handler,
+            rcvbuf=config.core.udp_rcvbuf,
+            decode_timestamp=config.core.decode_timestamps,
+            head_cache_size=config.core.head_cache_size,
+            reuse_port=reuse_port)
+        udp_server.start(udp_socket)
+        servers.append(udp_server)
+
+    # Stop reading syslog while downstream workers fall behind
+    def pause_reading():
+        for server in servers:
+            server.pause_reading()
+
+    def resume_reading():
+        for server in servers:
+            server.resume_reading()
+
+    caster.set_full_callback(pause_reading)
+    caster.set_drain_callback(resume_reading)
 
     # Take over SIGTERM and SIGINT
     signal.signal(signal.SIGTERM, stop)
@@ -49,3 +178,81 @@ if __name__ == '__main__':
 
     # Start I/O
     start_io()
+
+    # Send what is batched and keep what is spooled for the next start
+    caster.close()
+
+
+def run_fan_in(index, frontend):
+    FanIn(
+        frontend,
+        config.core.zmq_bind_host,
+        sndhwm=config.zmq.sndhwm,
+        io_threads=config.zmq.io_threads).run()
+
+
+def run_workers(processes):
+    fan_in = config.core.zmq_fan_in
+    fan_in_dir = None
+
+    if config.zmq.shard_bind_hosts:
+        if fan_in:
+            raise Exception(
+                'zmq_fan_in can not be used with shard_bind_hosts')
+
+        _LOG.warning(
+            'Each of the {0} processes binds its own shard ports'.format(
+                processes))
+    elif not fan_in:
+        # Workers send out of the one zmq_bind_host through a fan-in
+        fan_in_dir = tempfile.mkdtemp(prefix='meniscus-portal-')
+        fan_in = 'ipc://{0}/fan-in.sock'.format(fan_in_dir)
+
+    sockets = None
+    udp_socket = None
+
+    if not config.core.reuse_port:
+        # Workers share listening sockets bound before they are forked
+        host, port = config.core.syslog_bind_host
+        sockets = bind_sockets(port, host)
+
+        if config.core.udp_bind_host:
+            udp_socket = bind_udp_socket(
+                config.core.udp_bind_host, config.core.udp_rcvbuf)
+
+    supervisor = Supervisor(restart_delay=config.core.restart_delay)
+    cpus = cpu_count()
+
+    for worker in xrange(processes):
+        cpu = worker % cpus if config.core.cpu_affinity else None
+        supervisor.add_worker(
+            partial(
+                run_worker,
+                sockets=sockets,
+                udp_socket=udp_socket,
+                fan_in=fan_in),
+            cpu=cpu)
+
+    if fan_in:
+        supervisor.add_worker(
+            partial(run_fan_in, frontend=fan_in), name='fan-in')
+
+    # Stop every worker on SIGTERM and SIGINT
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+
+    try:
+        supervisor.start()
+        supervisor.run()
+    finally:
+        if fan_in_dir:
+            shutil.rmtree(fan_in_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    processes = worker_count(config.core.processes)
+
+    if processes == 1:
+        run_worker()
+    else:
+        run_workers(processes)
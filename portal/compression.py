@@ -0,0 +1,205 @@
+"""
+The compression module packs the frames of a zmq message into a single
+zlib compressed frame for links where bandwidth costs more than CPU, and
+unpacks them again for downstream receivers.
+
+Compressed frames may be primed with a preset dictionary of sample
+traffic. Syslog batches repeat the same keys, hosts and apps so a
+dictionary helps most with small batches, where zlib has little else to
+refer back to. train_dictionary builds one from sample messages.
+"""
+
+import re
+import struct
+import zlib
+
+
+# Compressed frame layout, all integers little-endian:
+#
+#   header      B format, I dictionary id
+#   data        a zlib stream of the packed frames, each an I length
+#               followed by the frame bytes
+#
+# The dictionary id is the adler32 checksum of the preset dictionary, or 0
+# without one, so that a receiver holding a different dictionary fails
+# cleanly rather than returning garbage.
+COMPRESSED_FORMAT = 1
+NO_DICTIONARY = 0
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+_HEADER = struct.Struct('<BI')
+_LENGTH = struct.Struct('<I')
+_TOKEN = re.compile(r'[^\s,;]+[\s,;]*')
+
+# Fed after the zlib stream, it is left over only when the stream is whole
+_SENTINEL = b'\x00'
+
+
+class CompressionError(Exception):
+    pass
+
+
+class FrameCompressor(object):
+    """
+    FrameCompressor compresses the frames of a message into one frame with
+    stdlib zlib.
+
+    zlib in Python 2 has no preset dictionary support, so a dictionary is
+    emulated by priming a compressor with it and compressing every message
+    with a copy of that compressor. Decompressors are primed with the same
+    dictionary. Only the window contents matter when decoding, so
+    receivers do not need the sender's compression level.
+    """
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, dictionary=None,
+                 max_size=DEFAULT_MAX_SIZE):
+        """
+        :param level: The zlib compression level, 0 to 9
+        :param dictionary: Optional sample bytes to prime compression with,
+        the last 32 KB of which are used
+        :param max_size: The most bytes a frame may decompress to
+        """
+        if not -1 <= level <= 9:
+            raise ValueError('level must be between 0 and 9')
+
+        self.level = level
+        self.max_size = max_size
+        self.dictionary = None
+        self.dictionary_id = NO_DICTIONARY
+        self._compressor = None
+        self._decompressor = None
+
+        if dictionary:
+            self.dictionary = dictionary[-MAX_DICTIONARY_SIZE:]
+            self.dictionary_id = zlib.adler32(self.dictionary) & 0xffffffff
+
+            self._compressor = zlib.compressobj(level)
+            self._compressor.compress(self.dictionary)
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+            # Stored blocks decode to the same window as any other encoding
+            primer = zlib.compressobj(0)
+            primed = (primer.compress(self.dictionary)
+                      + primer.flush(zlib.Z_SYNC_FLUSH))
+            self._decompressor = zlib.decompressobj()
+            self._decompressor.decompress(primed)
+
+        self._header = _HEADER.pack(COMPRESSED_FORMAT, self.dictionary_id)
+
+    def compress(self, frames):
+        """
+        Returns the given frames packed into one compressed frame
+        """
+        parts = list()
+
+        for frame in frames:
+            if not isinstance(frame, bytes):
+                frame = memoryview(frame).tobytes()
+
+            parts.append(_LENGTH.pack(len(frame)))
+            parts.append(frame)
+
+        data = b''.join(parts)
+
+        if self._compressor is None:
+            return self._header + zlib.compress(data, self.level)
+
+        compressor = self._compressor.copy()
+        return self._header + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        """
+        Returns the list of frames packed into a compressed frame
+        """
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+
+        try:
+            record_format, dictionary_id = _HEADER.unpack_from(data)
+        except struct.error:
+            raise CompressionError('Truncated compressed frame')
+
+        if record_format != COMPRESSED_FORMAT:
+            raise CompressionError(
+                'Unknown compressed frame format {0}'.format(record_format))
+
+        if dictionary_id != self.dictionary_id:
+            raise CompressionError(
+                'Compressed frame dictionary {0:#x} does not match '
+                '{1:#x}'.format(dictionary_id, self.dictionary_id))
+
+        if self._decompressor is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = self._decompressor.copy()
+
+        try:
+            packed = decompressor.decompress(
+                data[_HEADER.size:] + _SENTINEL, self.max_size + 1)
+
+            if not decompressor.unconsumed_tail:
+                packed += decompressor.flush()
+        except zlib.error as ex:
+            raise CompressionError(
+                'Unable to decompress frame: {0}'.format(ex))
+
+        if len(packed) > self.max_size or decompressor.unconsumed_tail:
+            raise CompressionError(
+                'Compressed frame exceeds {0} bytes'.format(self.max_size))
+
+        if decompressor.unused_data != _SENTINEL:
+            raise CompressionError(
+                'Truncated or trailing bytes in compressed frame')
+
+        frames = list()
+        offset = 0
+
+        while offset < len(packed):
+            try:
+                length, = _LENGTH.unpack_from(packed, offset)
+            except struct.error:
+                raise CompressionError('Truncated compressed frame')
+
+            offset += _LENGTH.size
+            end = offset + length
+
+            if end > len(packed):
+                raise CompressionError('Truncated compressed frame')
+
+            frames.append(packed[offset:end])
+            offset = end
+
+        return frames
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE):
+    """
+    Builds a preset dictionary of at most size bytes from sample messages.
+    The samples are split into delimited tokens which are ranked by the
+    bytes they would save across the samples. The most valuable tokens are
+    placed at the end of the dictionary, closest to the data compressed
+    with it.
+    """
+    counts = dict()
+
+    for sample in samples:
+        for token in _TOKEN.findall(sample):
+            counts[token] = counts.get(token, 0) + 1
+
+    ranked = sorted(
+        (token for token, count in counts.iteritems() if count > 1),
+        key=lambda token: (counts[token] * len(token), token),
+        reverse=True)
+
+    chosen = list()
+    remaining = size
+
+    for token in ranked:
+        if len(token) <= remaining:
+            chosen.append(token)
+            remaining -= len(token)
+
+    chosen.reverse()
+    return b''.join(chosen)
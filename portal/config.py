@@ -7,7 +7,34 @@ _CFG_DEFAULTS = {
     'core': {
         'processes': 1,
         'syslog_bind_host': 'localhost:5140',
-        'zmq_bind_host': 'localhost:5000'
+        'udp_bind_host': None,
+        'udp_rcvbuf': 8 * 1024 * 1024,
+        'zmq_bind_host': 'localhost:5000',
+        'decode_timestamps': False,
+        'head_cache_size': 0,
+        'reuse_port': True,
+        'cpu_affinity': False,
+        'zmq_fan_in': None,
+        'restart_delay': 1
+    },
+    'zmq': {
+        'batch_size': 1,
+        'batch_bytes': None,
+        'batch_interval': None,
+        'serializer': 'json',
+        'zero_copy': False,
+        'copy_threshold': None,
+        'sndhwm': None,
+        'spool_dir': None,
+        'spool_segment_size': 64 * 1024 * 1024,
+        'spool_segments': 16,
+        'shard_bind_hosts': None,
+        'shard_key': 'hostname',
+        'compression_level': None,
+        'compression_dictionary': None,
+        'io_threads': 1,
+        'send_thread': False,
+        'send_queue_size': 10000
     },
     'ssl': {
         'cert_file': None,
@@ -48,6 +75,7 @@ class PortalConfiguration(object):
     """
     def __init__(self, cfg):
         self.core = CoreConfiguration(cfg)
+        self.zmq = ZmqConfiguration(cfg)
         self.ssl = SSLConfiguration(cfg)
         self.logging = LoggingConfiguration(cfg)
 
@@ -118,7 +146,10 @@ class CoreConfiguration(ConfigurationObject):
     def processes(self):
         """
         Returns the number of processes Portal should spin up to handle
-        messages. If unset, this defaults to 1.
+        messages, where 0 starts one per CPU. Each process runs its own
+        listener and is restarted should it die, and their messages are
+        sent out of zmq_bind_host through zmq_fan_in. If unset, this
+        defaults to 1.
 
         Example
         --------
@@ -139,6 +170,33 @@ class CoreConfiguration(ConfigurationObject):
         """
         return _host_tuple(self._get('syslog_bind_host'))
 
+    @property
+    def udp_bind_host(self):
+        """
+        Returns a tuple of host and port that portal receives syslog
+        datagrams on, one message per datagram. If unset this defaults to
+        None, which disables the UDP listener.
+
+        Example
+        --------
+        udp_bind_host = 0.0.0.0:514
+        """
+        return _host_tuple(self._get('udp_bind_host'))
+
+    @property
+    def udp_rcvbuf(self):
+        """
+        Returns the size in bytes of the UDP socket's receive buffer, which
+        holds datagrams through bursts and while reading is paused. The
+        kernel caps it at net.core.rmem_max. If unset this defaults to
+        8388608.
+
+        Example
+        --------
+        udp_rcvbuf = 33554432
+        """
+        return self._getint('udp_rcvbuf')
+
     @property
     def zmq_bind_host(self):
         """
@@ -152,6 +210,330 @@ class CoreConfiguration(ConfigurationObject):
         """
         return _host_tuple(self._get('zmq_bind_host'))
 
+    @property
+    def decode_timestamps(self):
+        """
+        Returns a boolean representing whether or not Portal should decode
+        syslog timestamps into epoch seconds, microseconds and UTC offset
+        fields before sending messages downstream. If unset this value
+        defaults to False.
+
+        Example
+        --------
+        decode_timestamps = True
+        """
+        return self._getboolean('decode_timestamps')
+
+    @property
+    def head_cache_size(self):
+        """
+        Returns the number of parsed syslog message heads Portal should
+        cache so that messages repeating the head of an earlier message,
+        timestamp aside, are not parsed and serialized in full again. If
+        unset this value defaults to 0, which disables the cache.
+
+        Example
+        --------
+        head_cache_size = 1024
+        """
+        return self._getint('head_cache_size')
+
+    @property
+    def reuse_port(self):
+        """
+        Returns a boolean representing whether or not each Portal process
+        binds its own syslog socket with SO_REUSEPORT, letting the kernel
+        spread connections evenly across processes. When False the
+        processes share one listening socket. If unset this value defaults
+        to True.
+
+        Example
+        --------
+        reuse_port = False
+        """
+        return self._getboolean('reuse_port')
+
+    @property
+    def cpu_affinity(self):
+        """
+        Returns a boolean representing whether or not each Portal process
+        is pinned to a CPU of its own. If unset this value defaults to
+        False.
+
+        Example
+        --------
+        cpu_affinity = True
+        """
+        return self._getboolean('cpu_affinity')
+
+    @property
+    def zmq_fan_in(self):
+        """
+        Returns the zmq endpoint that Portal processes send their messages
+        to, to be forwarded out of zmq_bind_host by a process of its own.
+        If unset this defaults to None, in which case an ipc endpoint in a
+        temporary directory is used. Fan-in is not used with
+        shard_bind_hosts; each process then binds shard sockets of its
+        own, the process numbered n adding n times the number of shard
+        bind hosts to every shard port.
+
+        Example
+        --------
+        zmq_fan_in = ipc:///var/run/meniscus-portal/fan-in.sock
+        """
+        return self._get('zmq_fan_in')
+
+    @property
+    def restart_delay(self):
+        """
+        Returns the number of seconds to wait before restarting a Portal
+        process that died within a second of starting. If unset this
+        defaults to 1.
+
+        Example
+        --------
+        restart_delay = 5
+        """
+        return self._getint('restart_delay')
+
+
+class ZmqConfiguration(ConfigurationObject):
+    """
+    Class mapping for the Portal configuration section 'zmq'
+    """
+    @property
+    def batch_size(self):
+        """
+        Returns the most syslog messages Portal should send downstream in a
+        single multipart zmq message. If unset this defaults to 1, which
+        sends every message on its own.
+
+        Example
+        --------
+        batch_size = 100
+        """
+        return self._getint('batch_size')
+
+    @property
+    def batch_bytes(self):
+        """
+        Returns the number of bytes at which a batch of messages is sent
+        downstream before it is full. If unset this defaults to None.
+
+        Example
+        --------
+        batch_bytes = 65536
+        """
+        return self._getint('batch_bytes')
+
+    @property
+    def batch_interval(self):
+        """
+        Returns the number of milliseconds a batch of messages may wait
+        before being sent downstream. If unset this defaults to None, which
+        only sends batches once they are full.
+
+        Example
+        --------
+        batch_interval = 50
+        """
+        return self._getint('batch_interval')
+
+    @property
+    def serializer(self):
+        """
+        Returns the name of the serializer syslog messages are encoded with
+        before being sent downstream, either json or binary. Downstream
+        receivers must decode with the same serializer. If unset this
+        defaults to json.
+
+        Example
+        --------
+        serializer = binary
+        """
+        return self._get('serializer')
+
+    @property
+    def zero_copy(self):
+        """
+        Returns a boolean representing whether or not Portal should send
+        syslog message bodies downstream without copying them, in zmq
+        frames of their own following the serialized message head.
+        Downstream receivers must expect this framing. If unset this value
+        defaults to False.
+
+        Example
+        --------
+        zero_copy = True
+        """
+        return self._getboolean('zero_copy')
+
+    @property
+    def copy_threshold(self):
+        """
+        Returns the number of bytes under which zmq frames are copied
+        rather than sent zero-copy. If unset this defaults to None, which
+        keeps the pyzmq default of 65536.
+
+        Example
+        --------
+        copy_threshold = 1024
+        """
+        return self._getint('copy_threshold')
+
+    @property
+    def sndhwm(self):
+        """
+        Returns the number of messages the zmq socket may queue for
+        downstream workers before it is full. While it is full Portal stops
+        reading from its syslog connections. If unset this defaults to None,
+        which keeps the zmq default of 1000.
+
+        Example
+        --------
+        sndhwm = 10000
+        """
+        return self._getint('sndhwm')
+
+    @property
+    def spool_dir(self):
+        """
+        Returns the directory to spool messages to while the zmq socket is
+        full. Spooled messages are sent once downstream workers catch up,
+        including after a restart. If unset this defaults to None, which
+        disables spooling.
+
+        Example
+        --------
+        spool_dir = /var/spool/meniscus-portal
+        """
+        return self._get('spool_dir')
+
+    @property
+    def spool_segment_size(self):
+        """
+        Returns the size in bytes of each spool segment file. If unset this
+        defaults to 67108864.
+
+        Example
+        --------
+        spool_segment_size = 16777216
+        """
+        return self._getint('spool_segment_size')
+
+    @property
+    def spool_segments(self):
+        """
+        Returns the most spool segment files kept at once, which bounds the
+        spool at spool_segments * spool_segment_size bytes. If unset this
+        defaults to 16.
+
+        Example
+        --------
+        spool_segments = 64
+        """
+        return self._getint('spool_segments')
+
+    @property
+    def shard_bind_hosts(self):
+        """
+        Returns a list of host and port tuples that portal binds a zmq
+        socket to each, routing every message to one of them by its
+        shard_key. When set this replaces the zmq_bind_host core option.
+        If unset this defaults to None, which disables sharding.
+
+        Example
+        --------
+        shard_bind_hosts = localhost:5001, localhost:5002
+        """
+        hosts = self._get('shard_bind_hosts')
+
+        if hosts:
+            return [_host_tuple(host.strip()) for host in hosts.split(',')]
+        return None
+
+    @property
+    def shard_key(self):
+        """
+        Returns what sharded messages are routed by, either a head field
+        such as hostname or appname, or an SDATA value named as
+        sd:<SD-ID>:<PARAM-NAME>. If unset this defaults to hostname.
+
+        Example
+        --------
+        shard_key = sd:meniscus:tenant
+        """
+        return self._get('shard_key')
+
+    @property
+    def compression_level(self):
+        """
+        Returns the zlib level, 0 to 9, that messages and batches are
+        compressed with before being sent. Receivers must decompress them.
+        Compression pays off with batching since every compressed frame
+        carries a fixed setup cost. If unset this defaults to None, which
+        disables compression.
+
+        Example
+        --------
+        compression_level = 6
+        """
+        return self._getint('compression_level')
+
+    @property
+    def compression_dictionary(self):
+        """
+        Returns the path of a file of sample traffic to prime compression
+        with, such as one written from portal.compression.train_dictionary.
+        Receivers must be given the same file. If unset this defaults to
+        None.
+
+        Example
+        --------
+        compression_dictionary = /etc/meniscus-portal/zmq.dict
+        """
+        return self._get('compression_dictionary')
+
+    @property
+    def io_threads(self):
+        """
+        Returns the number of I/O threads each zmq context runs. A single
+        thread keeps up with around a gigabyte a second of messages. If
+        unset this defaults to 1.
+
+        Example
+        --------
+        io_threads = 2
+        """
+        return self._getint('io_threads')
+
+    @property
+    def send_thread(self):
+        """
+        Returns a boolean representing whether or not messages are
+        serialized and sent downstream on a thread of their own, leaving
+        the syslog listeners to only read and parse. If unset this value
+        defaults to False.
+
+        Example
+        --------
+        send_thread = True
+        """
+        return self._getboolean('send_thread')
+
+    @property
+    def send_queue_size(self):
+        """
+        Returns the most parsed messages that may wait for the send thread
+        before Portal stops reading from its syslog connections. If unset
+        this defaults to 10000.
+
+        Example
+        --------
+        send_queue_size = 50000
+        """
+        return self._getint('send_queue_size')
+
 
 class SSLConfiguration(ConfigurationObject):
     """
@@ -11,25 +11,59 @@ cdef extern from "cstr.h":
         size_t position
 
 
+cdef extern from "timestamp.h":
+
+    cdef struct syslog_timestamp:
+        int64_t seconds
+        uint32_t microseconds
+        int16_t offset
+        uint8_t decoded
+
+
 cdef extern from "syslog.h":
 
     cdef struct syslog_msg_head:
         uint16_t priority
         uint16_t version
 
-        cstr *timestamp
-        cstr *hostname
-        cstr *appname
-        cstr *processid
-        cstr *messageid
+        cstr timestamp
+        cstr hostname
+        cstr appname
+        cstr processid
+        cstr messageid
+        cstr sd
+
+        syslog_timestamp decoded_timestamp
+
+    cdef enum syslog_fields:
+        SF_TIMESTAMP
+        SF_HOSTNAME
+        SF_APPNAME
+        SF_PROCESSID
+        SF_MESSAGEID
+        SF_SD
+        SF_ALL
+
+    cdef struct syslog_filter:
+        uint8_t max_severity
+        uint32_t facilities
+        cstr hostname_prefix
+        cstr appname_prefix
+
+    cdef enum syslog_options:
+        SO_DECODE_TIMESTAMP
 
     cdef struct syslog_parser:
+        unsigned char fields
+        unsigned char options
         syslog_msg_head *msg_head
+        const syslog_filter *filter
+        size_t discarded
         size_t message_length
         void *app_data
 
     ctypedef int (*syslog_cb) (syslog_parser *parser)
-    ctypedef int (*syslog_data_cb) (syslog_parser *parser, char *data, size_t len)
+    ctypedef int (*syslog_data_cb) (syslog_parser *parser, const char *data, size_t len)
 
     struct syslog_parser_settings:
         syslog_cb         on_msg_begin
@@ -39,11 +73,62 @@ cdef extern from "syslog.h":
         syslog_cb         on_msg_head_complete
         syslog_data_cb    on_msg_part
         syslog_cb         on_msg_complete
+        syslog_data_cb    on_msg_body
 
     void uslg_parser_reset(syslog_parser *parser)
+    void uslg_parser_trim(syslog_parser *parser)
     void uslg_free_parser(syslog_parser *parser)
 
     int uslg_parser_init(syslog_parser *parser, void *app_data)
     int uslg_parser_exec(syslog_parser *parser, syslog_parser_settings *settings, char *data, size_t length) except 101
+    int uslg_parser_exec_message(syslog_parser *parser, syslog_parser_settings *settings, char *data, size_t length) except 101
+    int uslg_parse_sd(syslog_parser *parser, syslog_parser_settings *settings, const char *data, size_t length) except 101
 
     char * uslg_error_string(int error)
+
+
+cdef extern from "batch.h":
+
+    cdef enum batch_sd_kind:
+        SD_ELEMENT
+        SD_FIELD
+        SD_VALUE
+
+    cdef struct syslog_span:
+        size_t offset
+        size_t size
+
+    cdef struct syslog_batch_sd:
+        unsigned char kind
+        syslog_span value
+
+    cdef struct syslog_batch_msg:
+        uint16_t priority
+        uint16_t version
+
+        syslog_span timestamp
+        syslog_span hostname
+        syslog_span appname
+        syslog_span processid
+        syslog_span messageid
+        syslog_span message
+
+        syslog_timestamp decoded_timestamp
+
+        size_t sd_first
+        size_t sd_count
+        size_t message_length
+
+    cdef struct syslog_batch:
+        cstr_buff *bytes
+        syslog_batch_msg *msgs
+        size_t msg_count
+        syslog_batch_sd *sd
+
+    syslog_batch * uslg_batch_new()
+    void uslg_batch_free(syslog_batch *batch)
+
+    void uslg_batch_reset(syslog_batch *batch)
+    void uslg_batch_clear(syslog_batch *batch)
+
+    int uslg_batch_exec(syslog_parser *parser, syslog_batch *batch, const char *data, size_t length) nogil
@@ -1,7 +1,13 @@
-from libc.string cimport strlen
+from libc.string cimport strlen, memcpy
 from libc.stdlib cimport malloc, free
 from cpython cimport bool, PyBytes_FromStringAndSize, PyBytes_FromString
+from cpython cimport PyBytes_AS_STRING
+from cpython cimport array, Py_SIZE
+from cpython.buffer cimport (
+    PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+)
 
+import array
 import os
 
 
@@ -47,82 +53,319 @@ class SyslogMessageHandler(object):
     def on_msg_complete(self, message_size):
         pass
 
+    def on_msg_body(self, message_body, message_size):
+        """
+        Called in place of on_msg_part and on_msg_complete when a message
+        body arrives whole. The body is a memoryview over the data passed to
+        Parser.read and is only guaranteed to be valid for the duration of
+        the call.
 
-class SyslogMessageHead(object):
+        Parser only calls this when a handler overrides it. Handlers that
+        call it anyway receive the body as bytes in on_msg_part.
+        """
+        self.on_msg_part(message_body.tobytes())
+        self.on_msg_complete(message_size)
+
+
+cdef inline bytes span_bytes(const char *store, syslog_span *span):
+    return PyBytes_FromStringAndSize(store + span.offset, span.size)
+
+
+cdef class HeadCacheEntry(object):
+
+    cdef bytes key
+    cdef bytes hostname
+    cdef bytes appname
+    cdef bytes processid
+    cdef bytes messageid
+    cdef dict sd
+    cdef dict fragments
+
+    # Neighbours in the cache, newer and older
+    cdef HeadCacheEntry newer
+    cdef HeadCacheEntry older
+
+
+cdef class SyslogMessageHead(object):
+    """
+    The parsed head of a syslog message. Header fields are kept as the raw
+    bytes the parser produced and SDATA as a dict of dicts of raw bytes.
+    Nothing is decoded or rebuilt until as_dict is called.
+    """
+
+    cdef int _priority
+    cdef int _version
+
+    cdef readonly bytes timestamp
+    cdef readonly bytes hostname
+    cdef readonly bytes appname
+    cdef readonly bytes processid
+    cdef readonly bytes messageid
+    cdef readonly dict sd
+
+    cdef dict current_sde
+    cdef object current_sd_field
+
+    # Set when the parser decodes timestamps
+    cdef syslog_timestamp _decoded_timestamp
+
+    # Cached results of _cached_dict
+    cdef dict _dict
+    cdef dict _raw_dict
+
+    # Shared by every head read from the same HeadCache entry, None for
+    # heads that were not
+    cdef readonly dict fragments
 
     def __init__(self):
         self.reset()
 
-    def reset(self):
-        self.priority = ''
-        self.version = ''
-        self.timestamp = ''
-        self.hostname = ''
-        self.appname = ''
-        self.processid = ''
-        self.messageid = ''
+    property priority:
+        def __get__(self):
+            return str(self._priority) if self._priority >= 0 else ''
+
+    property version:
+        def __get__(self):
+            return str(self._version) if self._version >= 0 else ''
+
+    property timestamp_seconds:
+        """
+        Seconds since the epoch, UTC, or None if the timestamp was not
+        decoded.
+        """
+        def __get__(self):
+            if self._decoded_timestamp.decoded:
+                return self._decoded_timestamp.seconds
+            return None
+
+    property timestamp_microseconds:
+        def __get__(self):
+            if self._decoded_timestamp.decoded:
+                return self._decoded_timestamp.microseconds
+            return None
+
+    property timestamp_offset:
+        """
+        Minutes east of UTC the timestamp was written in, or None if the
+        timestamp was not decoded.
+        """
+        def __get__(self):
+            if self._decoded_timestamp.decoded:
+                return self._decoded_timestamp.offset
+            return None
+
+    cpdef reset(self):
+        self._priority = -1
+        self._version = -1
+        self._decoded_timestamp.decoded = 0
+        self.timestamp = b''
+        self.hostname = b''
+        self.appname = b''
+        self.processid = b''
+        self.messageid = b''
         self.sd = dict()
         self.current_sde = None
         self.current_sd_field = None
+        self._dict = None
+        self._raw_dict = None
+        self.fragments = None
+
+    cpdef SyslogMessageHead copy(self):
+        """
+        Returns a copy of the head that outlives the parser reusing this
+        one. The SDATA dictionary is shared rather than copied since the
+        parser starts a new one for every message.
+        """
+        cdef SyslogMessageHead head = SyslogMessageHead.__new__(
+            SyslogMessageHead)
+
+        head._priority = self._priority
+        head._version = self._version
+        head._decoded_timestamp = self._decoded_timestamp
+        head.timestamp = self.timestamp
+        head.hostname = self.hostname
+        head.appname = self.appname
+        head.processid = self.processid
+        head.messageid = self.messageid
+        head.sd = self.sd
+        head.fragments = self.fragments
+        head._dict = self._dict
+        head._raw_dict = self._raw_dict
+        return head
 
     def get_sd(self, name):
         return self.sd.get(name)
 
-    def create_sde(self, sd_name):
+    cpdef create_sde(self, sd_name):
         self.current_sde = dict()
         self.sd[sd_name] = self.current_sde
+        self._dict = self._raw_dict = None
 
-    def set_sd_field(self, sd_field_name):
+    cpdef set_sd_field(self, sd_field_name):
         self.current_sd_field = sd_field_name
 
-    def set_sd_value(self, value):
+    cpdef set_sd_value(self, value):
         self.current_sde[self.current_sd_field] = value
-
-    def as_dict(self):
-        sd_copy = dict()
-        dictionary = {
-            'priority': str(self.priority),
-            'version': str(self.version),
-            'timestamp': str(self.timestamp),
-            'hostname': str(self.hostname),
-            'appname': str(self.appname),
-            'processid': str(self.processid),
-            'messageid': str(self.messageid),
+        self._dict = self._raw_dict = None
+
+    cdef set_fields(self, syslog_msg_head *head):
+        self._priority = head.priority
+        self._version = head.version
+        self._decoded_timestamp = head.decoded_timestamp
+
+        self.timestamp = PyBytes_FromStringAndSize(
+            head.timestamp.bytes,
+            head.timestamp.size)
+
+        self.hostname = PyBytes_FromStringAndSize(
+            head.hostname.bytes,
+            head.hostname.size)
+
+        self.appname = PyBytes_FromStringAndSize(
+            head.appname.bytes,
+            head.appname.size)
+
+        self.processid = PyBytes_FromStringAndSize(
+            head.processid.bytes,
+            head.processid.size)
+
+        self.messageid = PyBytes_FromStringAndSize(
+            head.messageid.bytes,
+            head.messageid.size)
+
+        self._dict = self._raw_dict = None
+
+    cdef set_cached_fields(self, syslog_msg_head *head, HeadCacheEntry entry):
+        self._priority = head.priority
+        self._version = head.version
+        self._decoded_timestamp = head.decoded_timestamp
+
+        self.timestamp = PyBytes_FromStringAndSize(
+            head.timestamp.bytes,
+            head.timestamp.size)
+
+        self.hostname = entry.hostname
+        self.appname = entry.appname
+        self.processid = entry.processid
+        self.messageid = entry.messageid
+        self.sd = entry.sd
+        self.fragments = entry.fragments
+
+        self._dict = self._raw_dict = None
+
+    cdef set_batch_fields(self, const char *store, syslog_batch_msg *msg,
+                          syslog_batch_sd *sd):
+        cdef size_t sd_index
+        cdef syslog_batch_sd *entry
+
+        self._priority = msg.priority
+        self._version = msg.version
+        self._decoded_timestamp = msg.decoded_timestamp
+
+        self.timestamp = span_bytes(store, &msg.timestamp)
+        self.hostname = span_bytes(store, &msg.hostname)
+        self.appname = span_bytes(store, &msg.appname)
+        self.processid = span_bytes(store, &msg.processid)
+        self.messageid = span_bytes(store, &msg.messageid)
+
+        for sd_index in range(msg.sd_first, msg.sd_first + msg.sd_count):
+            entry = &sd[sd_index]
+
+            if entry.kind == SD_ELEMENT:
+                self.create_sde(span_bytes(store, &entry.value))
+            elif entry.kind == SD_FIELD:
+                self.set_sd_field(span_bytes(store, &entry.value))
+            else:
+                self.set_sd_value(span_bytes(store, &entry.value))
+
+        self._dict = self._raw_dict = None
+
+    def as_dict(self, bint decode=True):
+        """
+        Returns the head as a dictionary. SDATA values are decoded from
+        UTF-8 unless decode is False, in which case every value is left as
+        raw bytes. Decoded timestamps add the timestamp_seconds,
+        timestamp_microseconds and timestamp_offset keys. Each call returns
+        a new dictionary that the caller is free to modify.
+        """
+        cdef dict head = dict(self._cached_dict(decode))
+
+        head['sd'] = dict(
+            (sd_name, dict(sd_fields))
+            for sd_name, sd_fields in head['sd'].iteritems())
+        return head
+
+    def _cached_dict(self, bint decode=True):
+        """
+        Returns the dictionary as_dict copies. It is built on first use and
+        shared until the head changes, so it must not be modified.
+        """
+        if decode:
+            if self._dict is None:
+                self._dict = self._build_dict(True)
+            return self._dict
+
+        if self._raw_dict is None:
+            self._raw_dict = self._build_dict(False)
+        return self._raw_dict
+
+    cdef dict _build_dict(self, bint decode):
+        cdef dict sd_copy = dict()
+        cdef dict sd_fields
+
+        for sd_name, sd_element in self.sd.iteritems():
+            sd_fields = dict(sd_element)
+
+            if decode:
+                for sd_fieldname, value in sd_fields.iteritems():
+                    sd_fields[sd_fieldname] = value.decode('utf-8')
+
+            sd_copy[sd_name] = sd_fields
+
+        head = {
+            'priority': self.priority,
+            'version': self.version,
+            'timestamp': self.timestamp,
+            'hostname': self.hostname,
+            'appname': self.appname,
+            'processid': self.processid,
+            'messageid': self.messageid,
             'sd': sd_copy
         }
 
-        for sd_name in self.sd:
-            sd_copy[sd_name] = dict()
-            for sd_fieldname in self.sd[sd_name]:
-                value = self.sd[sd_name][sd_fieldname]
-                sd_copy[sd_name][sd_fieldname] = value.decode('utf-8')
-        return dictionary
+        if self._decoded_timestamp.decoded:
+            head['timestamp_seconds'] = self._decoded_timestamp.seconds
+            head['timestamp_microseconds'] = (
+                self._decoded_timestamp.microseconds)
+            head['timestamp_offset'] = self._decoded_timestamp.offset
+
+        return head
 
 
 cdef int on_msg_begin(syslog_parser *parser) except -1:
-    cdef object parser_data = <object> parser.app_data
+    cdef ParserData parser_data = <ParserData> parser.app_data
     parser_data.msg_head.reset()
     return 0
 
 
-cdef int on_sd_element(syslog_parser *parser, char *data, size_t size) except -1:
-    cdef object parser_data = <object> parser.app_data
+cdef int on_sd_element(syslog_parser *parser, const char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
     cdef object pystr = PyBytes_FromStringAndSize(data, size)
 
     parser_data.msg_head.create_sde(pystr)
     return 0
 
 
-cdef int on_sd_field(syslog_parser *parser, char *data, size_t size) except -1:
-    cdef object parser_data = <object> parser.app_data
+cdef int on_sd_field(syslog_parser *parser, const char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
     cdef object pystr = PyBytes_FromStringAndSize(data, size)
 
     parser_data.msg_head.set_sd_field(pystr)
     return 0
 
 
-cdef int on_sd_value(syslog_parser *parser, char *data, size_t size) except -1:
-    cdef object parser_data = <object> parser.app_data
+cdef int on_sd_value(syslog_parser *parser, const char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
     cdef object pystr = PyBytes_FromStringAndSize(data, size)
 
     parser_data.msg_head.set_sd_value(pystr)
@@ -130,36 +373,20 @@ cdef int on_sd_value(syslog_parser *parser, char *data, size_t size) except -1:
 
 
 cdef int on_msg_head_complete(syslog_parser *parser) except -1:
-    cdef object parser_data = <object> parser.app_data
-
-    parser_data.msg_head.priority = str(parser.msg_head.priority)
-    parser_data.msg_head.version = str(parser.msg_head.version)
+    cdef ParserData parser_data = <ParserData> parser.app_data
 
-    parser_data.msg_head.timestamp = PyBytes_FromStringAndSize(
-        parser.msg_head.timestamp.bytes,
-        parser.msg_head.timestamp.size)
-
-    parser_data.msg_head.hostname = PyBytes_FromStringAndSize(
-        parser.msg_head.hostname.bytes,
-        parser.msg_head.hostname.size)
-
-    parser_data.msg_head.appname = PyBytes_FromStringAndSize(
-        parser.msg_head.appname.bytes,
-        parser.msg_head.appname.size)
-
-    parser_data.msg_head.processid = PyBytes_FromStringAndSize(
-        parser.msg_head.processid.bytes,
-        parser.msg_head.processid.size)
-
-    parser_data.msg_head.messageid = PyBytes_FromStringAndSize(
-        parser.msg_head.messageid.bytes,
-        parser.msg_head.messageid.size)
+    if parser_data.head_cache is not None:
+        parser_data.msg_head.set_cached_fields(
+            parser.msg_head,
+            parser_data.head_cache.lookup(parser.msg_head))
+    else:
+        parser_data.msg_head.set_fields(parser.msg_head)
 
     parser_data.msg_handler.on_msg_head(parser_data.msg_head)
     return 0
 
 
-cdef int on_msg_part(syslog_parser *parser, char *data, size_t size) except -1:
+cdef int on_msg_part(syslog_parser *parser, const char *data, size_t size) except -1:
     cdef object parser_data = <object> parser.app_data
     cdef object pystr = PyBytes_FromStringAndSize(data, size)
 
@@ -174,52 +401,565 @@ cdef int on_msg_complete(syslog_parser *parser) except -1:
     return 0
 
 
+cdef int on_msg_body(syslog_parser *parser, const char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+    cdef Py_ssize_t offset = data - parser_data.input_base
+
+    parser_data.msg_handler.on_msg_body(
+        parser_data.get_input_view()[offset:offset + size],
+        parser.message_length)
+    return 0
+
+
+cdef object _default_on_msg_body = SyslogMessageHandler.on_msg_body.__func__
+
+
+cdef bint handles_msg_body(msg_handler):
+    """
+    Returns True when msg_handler has an on_msg_body method of its own
+    rather than the SyslogMessageHandler default, which only feeds the body
+    to on_msg_part.
+    """
+    on_msg_body = getattr(msg_handler, 'on_msg_body', None)
+
+    if on_msg_body is None:
+        return False
+    return getattr(on_msg_body, '__func__', None) is not _default_on_msg_body
+
+
+# Handler settings are the same for every parser. Handlers without an
+# on_msg_body method of their own get the settings that leave it out.
+
+cdef syslog_parser_settings _handler_settings
+_handler_settings.on_msg_begin = <syslog_cb> on_msg_begin
+_handler_settings.on_sd_element = <syslog_data_cb> on_sd_element
+_handler_settings.on_sd_field = <syslog_data_cb> on_sd_field
+_handler_settings.on_sd_value = <syslog_data_cb> on_sd_value
+_handler_settings.on_msg_head_complete = <syslog_cb> on_msg_head_complete
+_handler_settings.on_msg_part = <syslog_data_cb> on_msg_part
+_handler_settings.on_msg_complete = <syslog_cb> on_msg_complete
+_handler_settings.on_msg_body = <syslog_data_cb> on_msg_body
+
+cdef syslog_parser_settings _handler_part_settings = _handler_settings
+_handler_part_settings.on_msg_body = NULL
+
+# Parsers with a head cache only read SDATA for heads missing from it, out
+# of the raw span once the head is complete
+
+cdef int on_sd_noop(syslog_parser *parser, const char *data, size_t size) except -1:
+    return 0
+
+
+cdef syslog_parser_settings _cached_handler_settings = _handler_settings
+_cached_handler_settings.on_sd_element = <syslog_data_cb> on_sd_noop
+_cached_handler_settings.on_sd_field = <syslog_data_cb> on_sd_noop
+_cached_handler_settings.on_sd_value = <syslog_data_cb> on_sd_noop
+
+cdef syslog_parser_settings _cached_handler_part_settings = _cached_handler_settings
+_cached_handler_part_settings.on_msg_body = NULL
+
+
+# Head fields that Parser can be told to parse, in message order
+HEAD_FIELDS = (
+    'timestamp',
+    'hostname',
+    'appname',
+    'processid',
+    'messageid',
+    'sd'
+)
+
+_FIELD_FLAGS = {
+    'timestamp': SF_TIMESTAMP,
+    'hostname': SF_HOSTNAME,
+    'appname': SF_APPNAME,
+    'processid': SF_PROCESSID,
+    'messageid': SF_MESSAGEID,
+    'sd': SF_SD
+}
+
+
+cdef unsigned char fields_mask(fields) except? 0:
+    cdef unsigned char mask = 0
+
+    if fields is None:
+        return SF_ALL
+
+    for field in fields:
+        try:
+            mask |= _FIELD_FLAGS[field]
+        except KeyError:
+            raise ValueError('Unknown head field {}'.format(field))
+
+    return mask
+
+
+cdef uint32_t facility_bit(facility) except? 0:
+    if not 0 <= facility < 32:
+        raise ValueError('Unknown facility {}'.format(facility))
+    return 1 << facility
+
+
+cdef class MessageFilter(object):
+    """
+    Drops messages inside the C parser before any Python object is made for
+    them. min_severity is the least severe severity let through, from 0
+    (emergency) to 7 (debug). facilities names the facility numbers let
+    through, all of them by default, and deny_facilities names those that
+    are not. hostname_prefix and appname_prefix, when given, must start the
+    message hostname and appname respectively.
+    """
+
+    cdef syslog_filter _cfilter
+    cdef readonly bytes hostname_prefix
+    cdef readonly bytes appname_prefix
+
+    def __init__(self, min_severity=7, facilities=None, deny_facilities=None,
+                 hostname_prefix=None, appname_prefix=None):
+        cdef uint32_t mask = 0xffffffff
+
+        if not 0 <= min_severity <= 7:
+            raise ValueError('Unknown severity {}'.format(min_severity))
+
+        if facilities is not None:
+            mask = 0
+            for facility in facilities:
+                mask |= facility_bit(facility)
+
+        if deny_facilities is not None:
+            for facility in deny_facilities:
+                mask &= ~facility_bit(facility)
+
+        self.hostname_prefix = hostname_prefix or b''
+        self.appname_prefix = appname_prefix or b''
+
+        self._cfilter.max_severity = min_severity
+        self._cfilter.facilities = mask
+        self._cfilter.hostname_prefix.bytes = self.hostname_prefix
+        self._cfilter.hostname_prefix.size = len(self.hostname_prefix)
+        self._cfilter.appname_prefix.bytes = self.appname_prefix
+        self._cfilter.appname_prefix.size = len(self.appname_prefix)
+
+    cdef unsigned char required_fields(self):
+        cdef unsigned char fields = 0
+
+        if self.hostname_prefix:
+            fields |= SF_HOSTNAME
+        if self.appname_prefix:
+            fields |= SF_APPNAME
+        return fields
+
+
+# Head cache
+
+cdef int on_cache_noop(syslog_parser *parser) except -1:
+    return 0
+
+
+cdef int on_cache_sd_element(syslog_parser *parser, const char *data, size_t size) except -1:
+    (<SyslogMessageHead> parser.app_data).create_sde(
+        PyBytes_FromStringAndSize(data, size))
+    return 0
+
+
+cdef int on_cache_sd_field(syslog_parser *parser, const char *data, size_t size) except -1:
+    (<SyslogMessageHead> parser.app_data).set_sd_field(
+        PyBytes_FromStringAndSize(data, size))
+    return 0
+
+
+cdef int on_cache_sd_value(syslog_parser *parser, const char *data, size_t size) except -1:
+    (<SyslogMessageHead> parser.app_data).set_sd_value(
+        PyBytes_FromStringAndSize(data, size))
+    return 0
+
+
+cdef syslog_parser_settings _cache_sd_settings
+_cache_sd_settings.on_msg_begin = <syslog_cb> on_cache_noop
+_cache_sd_settings.on_sd_element = <syslog_data_cb> on_cache_sd_element
+_cache_sd_settings.on_sd_field = <syslog_data_cb> on_cache_sd_field
+_cache_sd_settings.on_sd_value = <syslog_data_cb> on_cache_sd_value
+_cache_sd_settings.on_msg_head_complete = <syslog_cb> on_cache_noop
+_cache_sd_settings.on_msg_part = <syslog_data_cb> on_sd_noop
+_cache_sd_settings.on_msg_complete = <syslog_cb> on_cache_noop
+_cache_sd_settings.on_msg_body = NULL
+
+
+cdef bytes head_key(syslog_msg_head *head):
+    """
+    Returns the priority and version followed by the raw hostname, appname,
+    processid, messageid and STRUCTURED-DATA bytes. None of the fields may
+    hold whitespace so they are simply joined with spaces.
+    """
+    cdef cstr *spans[5]
+    cdef Py_ssize_t length = 4
+    cdef bytes key
+    cdef char *out
+    cdef int index
+
+    spans[0] = &head.hostname
+    spans[1] = &head.appname
+    spans[2] = &head.processid
+    spans[3] = &head.messageid
+    spans[4] = &head.sd
+
+    for index in range(5):
+        length += spans[index].size + 1
+
+    key = PyBytes_FromStringAndSize(NULL, length)
+    out = PyBytes_AS_STRING(key)
+
+    out[0] = head.priority >> 8
+    out[1] = head.priority & 0xff
+    out[2] = head.version >> 8
+    out[3] = head.version & 0xff
+    out += 4
+
+    for index in range(5):
+        if spans[index].size > 0:
+            memcpy(out, spans[index].bytes, spans[index].size)
+            out += spans[index].size
+
+        out[0] = b' '
+        out += 1
+
+    return key
+
+
+cdef class HeadCache(object):
+    """
+    A bounded LRU cache of parsed message heads for senders that repeat the
+    same head message after message. Heads are keyed on their priority and
+    version and on their raw hostname, appname, processid, messageid and
+    STRUCTURED-DATA bytes, leaving only the timestamp to be read afresh.
+
+    Parsers given a cache skip SDATA callbacks entirely and read SDATA out
+    of the raw section only for heads that miss. The heads they hand out
+    share the cached field values, sd dictionary and fragments dictionary
+    with every other head read from the same entry, so none of them may be
+    modified. The fragments dictionary is left for message handlers to keep
+    whatever they derive from the cached fields, such as serialized output.
+
+    A cache may be shared between parsers as long as they are all used from
+    the same thread.
+    """
+
+    cdef readonly size_t max_size
+    cdef readonly size_t hits
+    cdef readonly size_t misses
+    cdef readonly size_t evictions
+
+    cdef dict _entries
+    cdef HeadCacheEntry _newest
+    cdef HeadCacheEntry _oldest
+
+    # Reads SDATA for heads that miss
+    cdef syslog_parser *_sd_parser
+    cdef SyslogMessageHead _sd_head
+
+    def __cinit__(self):
+        self._sd_parser = <syslog_parser *> malloc(sizeof(syslog_parser))
+
+        if self._sd_parser == NULL:
+            raise MemoryError()
+
+        if uslg_parser_init(self._sd_parser, NULL):
+            free(self._sd_parser)
+            self._sd_parser = NULL
+            raise MemoryError()
+
+    def __init__(self, max_size=1024):
+        if max_size < 1:
+            raise ValueError('Head caches must hold at least one head')
+
+        self.max_size = max_size
+        self._sd_head = SyslogMessageHead()
+        self.clear()
+
+    def __dealloc__(self):
+        if self._sd_parser != NULL:
+            uslg_free_parser(self._sd_parser)
+            self._sd_parser = NULL
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """
+        Drops every cached head and zeroes the statistics.
+        """
+        self._entries = dict()
+        self._newest = self._oldest = None
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    cdef HeadCacheEntry lookup(self, syslog_msg_head *head):
+        cdef bytes key = head_key(head)
+        cdef HeadCacheEntry entry = self._entries.get(key)
+
+        if entry is not None:
+            self.hits += 1
+
+            if entry is not self._newest:
+                self._unlink(entry)
+                self._link(entry)
+
+            return entry
+
+        self.misses += 1
+
+        entry = HeadCacheEntry()
+        entry.key = key
+        entry.hostname = PyBytes_FromStringAndSize(
+            head.hostname.bytes, head.hostname.size)
+        entry.appname = PyBytes_FromStringAndSize(
+            head.appname.bytes, head.appname.size)
+        entry.processid = PyBytes_FromStringAndSize(
+            head.processid.bytes, head.processid.size)
+        entry.messageid = PyBytes_FromStringAndSize(
+            head.messageid.bytes, head.messageid.size)
+        entry.sd = self._read_sd(&head.sd)
+        entry.fragments = dict()
+
+        if len(self._entries) >= self.max_size:
+            self.evictions += 1
+            del self._entries[self._oldest.key]
+            self._unlink(self._oldest)
+
+        self._entries[key] = entry
+        self._link(entry)
+        return entry
+
+    cdef dict _read_sd(self, cstr *sd):
+        self._sd_head.reset()
+
+        if sd.size > 0:
+            self._sd_parser.app_data = <void *> self._sd_head
+
+            try:
+                result = uslg_parse_sd(
+                    self._sd_parser, &_cache_sd_settings, sd.bytes, sd.size)
+            finally:
+                self._sd_parser.app_data = NULL
+
+            if result:
+                raise ParsingError(
+                    msg=PyBytes_FromString(uslg_error_string(result)),
+                    cause=None)
+
+        return self._sd_head.sd
+
+    cdef _link(self, HeadCacheEntry entry):
+        entry.newer = None
+        entry.older = self._newest
+
+        if self._newest is not None:
+            self._newest.newer = entry
+        else:
+            self._oldest = entry
+
+        self._newest = entry
+
+    cdef _unlink(self, HeadCacheEntry entry):
+        if entry.newer is not None:
+            entry.newer.older = entry.older
+        else:
+            self._newest = entry.older
+
+        if entry.older is not None:
+            entry.older.newer = entry.newer
+        else:
+            self._oldest = entry.newer
+
+        entry.newer = entry.older = None
+
+
 cdef class Parser(object):
+    """
+    Parses syslog messages and hands them to a message handler.
+
+    fields optionally names the head fields to parse out of HEAD_FIELDS;
+    priority and version are always parsed. Fields left out are skipped
+    without being buffered and the head ends after the last field named.
+    Everything after it, structured data included, is passed along
+    unparsed as the message body.
+
+    msg_filter is an optional MessageFilter. Messages it drops never reach
+    the message handler and are only counted in discarded.
+
+    With decode_timestamp set, timestamps are also decoded to the epoch in C
+    and exposed through the timestamp_* attributes of the message head.
+
+    head_cache is an optional HeadCache that heads handed to the message
+    handler are looked up in, see HeadCache. It is not used by read_batch.
+    """
 
     cdef syslog_parser_settings *_cparser_settings
     cdef syslog_parser *_cparser
-    cdef object _data
+    cdef syslog_batch *_cbatch
+    cdef ParserData _data
+    cdef MessageFilter _filter
+
+    def __init__(self, msg_handler=None, fields=None, msg_filter=None,
+                 decode_timestamp=False, HeadCache head_cache=None):
+        cdef unsigned char mask = fields_mask(fields)
+
+        if decode_timestamp:
+            mask |= SF_TIMESTAMP
+
+        if msg_filter is not None:
+            self._filter = msg_filter
+            mask |= self._filter.required_fields()
 
-    def __init__(self, msg_handler):
         self._data = ParserData(msg_handler)
 
         # Init the parser
         self._cparser = <syslog_parser *> malloc(sizeof(syslog_parser))
-        uslg_parser_init(self._cparser, <void *> self._data)
 
-        # Init our callbacks
-        self._cparser_settings = <syslog_parser_settings *> malloc(
-            sizeof(syslog_parser_settings))
+        if self._cparser == NULL:
+            raise MemoryError()
+
+        if uslg_parser_init(self._cparser, <void *> self._data):
+            uslg_free_parser(self._cparser)
+            self._cparser = NULL
+            raise MemoryError()
+
+        self._cparser.fields = mask
 
-        self._cparser_settings.on_msg_begin = <syslog_cb> on_msg_begin
-        self._cparser_settings.on_sd_element = <syslog_data_cb> on_sd_element
-        self._cparser_settings.on_sd_field = <syslog_data_cb> on_sd_field
-        self._cparser_settings.on_sd_value = <syslog_data_cb> on_sd_value
-        self._cparser_settings.on_msg_head_complete = <syslog_cb> on_msg_head_complete
-        self._cparser_settings.on_msg_part = <syslog_data_cb> on_msg_part
-        self._cparser_settings.on_msg_complete = <syslog_cb> on_msg_complete
+        if decode_timestamp:
+            self._cparser.options |= SO_DECODE_TIMESTAMP
+
+        if self._filter is not None:
+            self._cparser.filter = &self._filter._cfilter
+
+        self._data.head_cache = head_cache
+
+        # Callback settings are shared between parsers
+        if handles_msg_body(msg_handler):
+            if head_cache is not None:
+                self._cparser_settings = &_cached_handler_settings
+            else:
+                self._cparser_settings = &_handler_settings
+        elif head_cache is not None:
+            self._cparser_settings = &_cached_handler_part_settings
+        else:
+            self._cparser_settings = &_handler_part_settings
 
     def __dealloc__(self):
         if self._cparser != NULL:
             uslg_free_parser(self._cparser)
             self._cparser = NULL
 
+        if self._cbatch != NULL:
+            uslg_batch_free(self._cbatch)
+            self._cbatch = NULL
+
+    property discarded:
+        def __get__(self):
+            return self._cparser.discarded
+
     def read(self, data):
-        if isinstance(data, str):
-            strval = data
-        elif isinstance(data, bytearray):
-            strval = str(data)
-        elif isinstance(data, unicode):
-            strval = data.encode('utf-8')
+        """
+        Parses data, calling the message handler as messages are read. Data
+        may be any object exporting a contiguous buffer, such as str,
+        bytearray, memoryview, mmap or a slice of a recv_into buffer, and is
+        parsed in place without being copied. Unicode is encoded as UTF-8.
+        """
+        self._exec(self._cparser_settings, data)
+
+    def read_message(self, data, Py_ssize_t size=-1):
+        """
+        Parses data as one complete message that is framed by neither an
+        octet count nor a trailing newline, such as a syslog datagram,
+        calling the message handler once it has been read. Any message in
+        flight from an earlier read is dropped. Data is parsed in place as
+        with read. With size given only the first size bytes of data are
+        parsed, which lets a receive buffer be reused without slicing it.
+        """
+        self._exec(self._cparser_settings, data, True, size)
+
+    def read_batch(self, data):
+        """
+        Parses every complete message in data and returns them as a list of
+        (msg_head, message, msg_length) tuples. The message handler is not
+        called. A message left incomplete at the end of data is carried over
+        and returned by the call that completes it. Batch and handler reads
+        must not be mixed while a message is in flight.
+
+        Parsing fills a native batch without holding the GIL, which is only
+        taken back to build the returned records. Separate parsers may be
+        used from separate threads, but a parser must not be shared between
+        threads.
+        """
+        cdef object source = buffer_source(data)
+        cdef Py_buffer view
+        cdef int result
+
+        if self._cbatch == NULL:
+            self._cbatch = uslg_batch_new()
+
+            if self._cbatch == NULL:
+                raise MemoryError()
+
+        PyObject_GetBuffer(source, &view, PyBUF_SIMPLE)
 
         try:
-            result = uslg_parser_exec(
-                self._cparser,
-                self._cparser_settings,
-                strval,
-                len(strval))
-        except Exception as ex:
-            raise
+            with nogil:
+                result = uslg_batch_exec(
+                    self._cparser,
+                    self._cbatch,
+                    <const char *> view.buf,
+                    view.len)
+        finally:
+            PyBuffer_Release(&view)
+
+        try:
+            records = batch_records(self._cbatch)
+        finally:
+            uslg_batch_clear(self._cbatch)
+
+        if result:
+            raise ParsingError(
+                msg=PyBytes_FromString(uslg_error_string(result)),
+                cause=None)
+
+        return records
+
+    cdef _exec(self, syslog_parser_settings *settings, data,
+               bint message=False, Py_ssize_t size=-1):
+        cdef object source = buffer_source(data)
+        cdef Py_buffer view
+
+        PyObject_GetBuffer(source, &view, PyBUF_SIMPLE)
+        self._data.set_input(<const char *> view.buf, source)
+
+        if size < 0 or size > view.len:
+            size = view.len
+
+        try:
+            if message:
+                result = uslg_parser_exec_message(
+                    self._cparser,
+                    settings,
+                    <char *> view.buf,
+                    size)
+            else:
+                result = uslg_parser_exec(
+                    self._cparser,
+                    settings,
+                    <char *> view.buf,
+                    view.len)
+        finally:
+            self._data.clear_input()
+            PyBuffer_Release(&view)
 
         if result:
             error_pystr = PyBytes_FromString(uslg_error_string(result))
@@ -228,15 +968,336 @@ cdef class Parser(object):
                 msg=error_pystr,
                 cause=self._data.exception)
 
-    def reset(self):
-        uslg_parser_reset(self._cparser)
-        self._data.msg_handler.msg_head = None
-        self._data.msg_head = SyslogMessageHead()
+    def reset(self, trim=False):
+        """
+        Drops any message in flight. With trim set, the parser buffers are
+        also shrunk back to their initial size. The message handler is left
+        alone since pooled parsers share it.
+        """
+        if trim:
+            uslg_parser_trim(self._cparser)
+        else:
+            uslg_parser_reset(self._cparser)
 
+        self._data.msg_head = SyslogMessageHead()
 
-class ParserData(object):
+        if self._cbatch != NULL:
+            if trim:
+                uslg_batch_free(self._cbatch)
+                self._cbatch = NULL
+            else:
+                uslg_batch_reset(self._cbatch)
+
+
+cdef object buffer_source(data):
+    """
+    Returns an object exporting the bytes of data through the buffer
+    protocol. Objects that only support the old buffer interface, like mmap
+    and array, are wrapped in a buffer object rather than copied.
+    """
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    elif PyObject_CheckBuffer(data):
+        return data
+
+    try:
+        return buffer(data)
+    except TypeError:
+        raise TypeError('Unable to parse data of type {}'.format(type(data)))
+
+
+cdef list batch_records(syslog_batch *batch):
+    cdef const char *store = batch.bytes.data.bytes
+    cdef syslog_batch_msg *msg
+    cdef SyslogMessageHead msg_head
+    cdef list records = list()
+    cdef size_t msg_index
+
+    for msg_index in range(batch.msg_count):
+        msg = &batch.msgs[msg_index]
+
+        msg_head = SyslogMessageHead()
+        msg_head.set_batch_fields(store, msg, batch.sd)
+
+        records.append((
+            msg_head,
+            span_bytes(store, &msg.message),
+            msg.message_length))
+
+    return records
+
+
+class ParserPool(object):
+    """
+    A free-list of Parser instances sharing a single message handler and
+    parser options, head cache included. Parsers released back to the pool
+    are reset and trimmed so that idle pooled parsers hold on to as little
+    memory as possible.
+    """
+
+    def __init__(self, msg_handler, max_size=1024, fields=None,
+                 msg_filter=None, decode_timestamp=False, head_cache=None):
+        self.msg_handler = msg_handler
+        self.max_size = max_size
+        self.fields = fields
+        self.msg_filter = msg_filter
+        self.decode_timestamp = decode_timestamp
+        self.head_cache = head_cache
+        self._free = list()
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+        return Parser(
+            self.msg_handler,
+            self.fields,
+            self.msg_filter,
+            self.decode_timestamp,
+            self.head_cache)
+
+    def release(self, parser):
+        if len(self._free) < self.max_size:
+            parser.reset(trim=True)
+            self._free.append(parser)
+
+
+cdef class ParserData(object):
+
+    cdef public object msg_handler
+    cdef public SyslogMessageHead msg_head
+    cdef public object exception
+    cdef public HeadCache head_cache
+
+    # The data currently being parsed, kept so that message bodies can be
+    # handed out as slices of it. The view is only made when first needed.
+    cdef const char *input_base
+    cdef object input_source
+    cdef object input_view
 
     def __init__(self, msg_handler):
         self.msg_handler = msg_handler
         self.msg_head = SyslogMessageHead()
         self.exception = None
+
+    cdef set_input(self, const char *base, object source):
+        self.input_base = base
+        self.input_source = source
+
+    cdef object get_input_view(self):
+        if self.input_view is None:
+            self.input_view = memoryview(self.input_source)
+        return self.input_view
+
+    cdef clear_input(self):
+        self.input_base = NULL
+        self.input_source = None
+        self.input_view = None
+
+
+# Columnar parsing
+
+COLUMN_FIELDS = (
+    'timestamp',
+    'hostname',
+    'appname',
+    'processid',
+    'messageid',
+    'sd',
+    'message'
+)
+
+
+cdef inline append_span(array.array offsets, array.array lengths,
+                        const char *base, cstr *span):
+    cdef Py_ssize_t size = Py_SIZE(offsets)
+
+    array.resize_smart(offsets, size + 1)
+    array.resize_smart(lengths, size + 1)
+
+    if span.bytes != NULL:
+        offsets.data.as_ulongs[size] = span.bytes - base
+        lengths.data.as_ulongs[size] = span.size
+    else:
+        offsets.data.as_ulongs[size] = 0
+        lengths.data.as_ulongs[size] = 0
+
+
+cdef inline append_ushort(array.array column, unsigned short value):
+    cdef Py_ssize_t size = Py_SIZE(column)
+
+    array.resize_smart(column, size + 1)
+    column.data.as_ushorts[size] = value
+
+
+cdef int on_column_noop(syslog_parser *parser) except -1:
+    return 0
+
+
+cdef int on_column_data_noop(syslog_parser *parser, const char *data, size_t size) except -1:
+    return 0
+
+
+cdef int on_column_msg_body(syslog_parser *parser, const char *data, size_t size) except -1:
+    cdef SyslogColumns columns = <SyslogColumns> parser.app_data
+    cdef syslog_msg_head *head = parser.msg_head
+    cdef const char *base = columns.source_base
+    cdef cstr body
+
+    body.bytes = <char *> data
+    body.size = size
+
+    append_ushort(columns.priority, head.priority)
+    append_ushort(columns.version, head.version)
+
+    append_span(columns.timestamp_offset, columns.timestamp_length, base, &head.timestamp)
+    append_span(columns.hostname_offset, columns.hostname_length, base, &head.hostname)
+    append_span(columns.appname_offset, columns.appname_length, base, &head.appname)
+    append_span(columns.processid_offset, columns.processid_length, base, &head.processid)
+    append_span(columns.messageid_offset, columns.messageid_length, base, &head.messageid)
+    append_span(columns.sd_offset, columns.sd_length, base, &head.sd)
+    append_span(columns.message_offset, columns.message_length, base, &body)
+
+    columns.consumed = data + size - base
+    return 0
+
+
+cdef syslog_parser_settings _column_settings
+_column_settings.on_msg_begin = <syslog_cb> on_column_noop
+_column_settings.on_sd_element = <syslog_data_cb> on_column_data_noop
+_column_settings.on_sd_field = <syslog_data_cb> on_column_data_noop
+_column_settings.on_sd_value = <syslog_data_cb> on_column_data_noop
+_column_settings.on_msg_head_complete = <syslog_cb> on_column_noop
+_column_settings.on_msg_part = <syslog_data_cb> on_column_data_noop
+_column_settings.on_msg_complete = <syslog_cb> on_column_noop
+_column_settings.on_msg_body = <syslog_data_cb> on_column_msg_body
+
+
+cdef class SyslogColumns(object):
+    """
+    Struct-of-arrays parse output. Priority and version are held in
+    array('H') columns and every other field as a pair of array('L')
+    columns holding offsets into and lengths within the source buffer.
+    Missing fields have a length of zero. The sd columns span the raw
+    STRUCTURED-DATA section, brackets included. The source is the object
+    the offsets point into, which is the parsed data itself unless it had
+    to be encoded or wrapped to be read as a buffer.
+    """
+
+    cdef readonly object source
+    cdef readonly Py_ssize_t consumed
+    cdef const char *source_base
+
+    cdef readonly array.array priority
+    cdef readonly array.array version
+    cdef readonly array.array timestamp_offset
+    cdef readonly array.array timestamp_length
+    cdef readonly array.array hostname_offset
+    cdef readonly array.array hostname_length
+    cdef readonly array.array appname_offset
+    cdef readonly array.array appname_length
+    cdef readonly array.array processid_offset
+    cdef readonly array.array processid_length
+    cdef readonly array.array messageid_offset
+    cdef readonly array.array messageid_length
+    cdef readonly array.array sd_offset
+    cdef readonly array.array sd_length
+    cdef readonly array.array message_offset
+    cdef readonly array.array message_length
+
+    def __init__(self, source):
+        self.source = source
+        self.source_base = NULL
+        self.consumed = 0
+
+        self.priority = array.array('H')
+        self.version = array.array('H')
+
+        self.timestamp_offset = array.array('L')
+        self.timestamp_length = array.array('L')
+        self.hostname_offset = array.array('L')
+        self.hostname_length = array.array('L')
+        self.appname_offset = array.array('L')
+        self.appname_length = array.array('L')
+        self.processid_offset = array.array('L')
+        self.processid_length = array.array('L')
+        self.messageid_offset = array.array('L')
+        self.messageid_length = array.array('L')
+        self.sd_offset = array.array('L')
+        self.sd_length = array.array('L')
+        self.message_offset = array.array('L')
+        self.message_length = array.array('L')
+
+    def __len__(self):
+        return len(self.priority)
+
+    def offsets(self, field):
+        return getattr(self, field + '_offset')
+
+    def lengths(self, field):
+        return getattr(self, field + '_length')
+
+    def get(self, field, index):
+        """
+        Returns the bytes of the named field for the message at index.
+        """
+        cdef unsigned long offset = self.offsets(field)[index]
+        cdef unsigned long length = self.lengths(field)[index]
+        cdef Py_buffer view
+
+        PyObject_GetBuffer(self.source, &view, PyBUF_SIMPLE)
+
+        try:
+            if offset + length > <unsigned long> view.len:
+                raise IndexError('The source has changed since parsing')
+
+            return PyBytes_FromStringAndSize(
+                <const char *> view.buf + offset, length)
+        finally:
+            PyBuffer_Release(&view)
+
+
+def parse_columns(data):
+    """
+    Parses every complete message in data into a SyslogColumns instance.
+    The consumed attribute of the result is the offset just past the last
+    complete message; anything after it was left unparsed. Data may be any
+    object accepted by Parser.read and is parsed in place without being
+    copied.
+    """
+    cdef SyslogColumns columns = SyslogColumns(buffer_source(data))
+    cdef syslog_parser *cparser
+    cdef Py_buffer view
+    cdef int result
+
+    PyObject_GetBuffer(columns.source, &view, PyBUF_SIMPLE)
+    cparser = <syslog_parser *> malloc(sizeof(syslog_parser))
+
+    if cparser == NULL:
+        PyBuffer_Release(&view)
+        raise MemoryError()
+
+    columns.source_base = <const char *> view.buf
+
+    try:
+        result = uslg_parser_init(cparser, <void *> columns)
+
+        if not result:
+            result = uslg_parser_exec(
+                cparser,
+                &_column_settings,
+                <char *> view.buf,
+                view.len)
+    finally:
+        uslg_free_parser(cparser)
+        columns.source_base = NULL
+        PyBuffer_Release(&view)
+
+    if result:
+        raise ParsingError(
+            msg=PyBytes_FromString(uslg_error_string(result)),
+            cause=None)
+
+    return columns
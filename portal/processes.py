@@ -0,0 +1,280 @@
+"""
+The processes module runs Portal across several worker processes, each with
+its own IOLoop, parsers and zmq caster, and restarts workers that die.
+
+Workers either listen on sockets of their own with SO_REUSEPORT set, which
+lets the kernel spread connections across them, or share listening sockets
+bound before they were forked. Workers connect to a FanIn that forwards
+their messages out of a single bind address, or each binds zmq endpoints of
+its own.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import multiprocessing
+import os
+import signal
+import time
+
+import zmq
+
+from portal.log import get_logger
+
+
+_LOG = get_logger(__name__)
+
+_CPU_SET_SIZE = 1024
+_CPU_WORD_BITS = 8 * ctypes.sizeof(ctypes.c_ulong)
+_libc = None
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def worker_count(processes):
+    """
+    Returns the number of worker processes to run for the core processes
+    option, where 0 means one per CPU
+    """
+    if processes < 0:
+        raise ValueError('processes must not be negative')
+    return processes or cpu_count()
+
+
+def set_cpu_affinity(cpu, pid=0):
+    """
+    Pins a process, by default the calling one, to a single CPU. Returns
+    False when CPU affinity is not supported here.
+    """
+    global _libc
+
+    if not 0 <= cpu < _CPU_SET_SIZE:
+        raise ValueError('No such CPU: {0}'.format(cpu))
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    if not hasattr(_libc, 'sched_setaffinity'):
+        return False
+
+    cpu_set = (ctypes.c_ulong * (_CPU_SET_SIZE // _CPU_WORD_BITS))()
+    cpu_set[cpu // _CPU_WORD_BITS] = 1 << (cpu % _CPU_WORD_BITS)
+
+    if _libc.sched_setaffinity(pid, ctypes.sizeof(cpu_set), cpu_set) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return True
+
+
+class Worker(object):
+    """
+    A process run by the Supervisor. The target is called with the
+    worker's index in the forked process, which exits once it returns.
+    """
+
+    def __init__(self, index, target, name=None, cpu=None):
+        self.index = index
+        self.target = target
+        self.name = name or 'worker-{0}'.format(index)
+        self.cpu = cpu
+        self.pid = None
+        self.started = None
+        self.restarts = 0
+
+
+class Supervisor(object):
+    """
+    Supervisor forks worker processes and restarts them when they exit
+    until it is stopped. Workers that die within min_uptime seconds of
+    starting are restarted after restart_delay seconds so that a worker
+    failing at start up does not spin.
+    """
+
+    def __init__(self, restart_delay=1.0, min_uptime=1.0):
+        """
+        :param restart_delay: Seconds to wait before restarting a worker
+        that died early
+        :param min_uptime: Seconds a worker must run for to be restarted
+        straight away
+        """
+        self.restart_delay = restart_delay
+        self.min_uptime = min_uptime
+        self.workers = list()
+        self.running = False
+        self._pids = dict()
+
+    def add_worker(self, target, name=None, cpu=None):
+        """
+        Adds a worker that calls target with its index, optionally pinned
+        to a CPU. Workers added while running are started at once.
+        """
+        worker = Worker(len(self.workers), target, name, cpu)
+        self.workers.append(worker)
+
+        if self.running:
+            self._spawn(worker)
+        return worker
+
+    def start(self):
+        """
+        Forks every worker
+        """
+        self.running = True
+
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def run(self):
+        """
+        Waits on the workers, restarting any that exit, until stop is
+        called. Returns once every worker has exited.
+        """
+        while self._pids:
+            try:
+                pid, status = os.wait()
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno == errno.ECHILD:
+                    break
+                raise
+
+            worker = self._pids.pop(pid, None)
+
+            if worker is None or not self.running:
+                continue
+
+            _LOG.warning('{0} (pid {1}) exited with status {2}'.format(
+                worker.name, pid, status))
+
+            if time.time() - worker.started < self.min_uptime:
+                time.sleep(self.restart_delay)
+
+            if self.running:
+                worker.restarts += 1
+                self._spawn(worker)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Stops restarting workers and asks every running worker to exit.
+        May be used as a signal handler.
+        """
+        self.running = False
+
+        for pid in self._pids.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as ex:
+                if ex.errno != errno.ESRCH:
+                    raise
+
+    def _spawn(self, worker):
+        pid = os.fork()
+
+        if pid:
+            worker.pid = pid
+            worker.started = time.time()
+            self._pids[pid] = worker
+            _LOG.info('Started {0} (pid {1})'.format(worker.name, pid))
+            return
+
+        # The worker sets up its own signal handling
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+
+        try:
+            if worker.cpu is not None:
+                if not set_cpu_affinity(worker.cpu):
+                    _LOG.warning('CPU affinity is not supported')
+
+            worker.target(worker.index)
+        except Exception as ex:
+            _LOG.exception(ex)
+            code = 1
+        finally:
+            os._exit(code)
+
+
+class FanIn(object):
+    """
+    FanIn forwards the messages that worker processes push to its frontend
+    endpoint, for example an ipc:// path, out of a single PUSH socket bound
+    to a host:port for downstream clients. Messages are forwarded frame for
+    frame so batches, bodies and compressed frames pass through unchanged.
+    """
+
+    def __init__(self, frontend, bind_host_tuple, sndhwm=None,
+                 io_threads=1):
+        """
+        :param frontend: The zmq endpoint workers connect to
+        :param bind_host_tuple: (host, port) downstream clients connect to
+        :param sndhwm: Optional number of messages the PUSH socket may
+        queue for downstream clients
+        :param io_threads: The number of zmq I/O threads to run
+        """
+        self.frontend = frontend
+        self.bind_host = 'tcp://{0}:{1}'.format(*bind_host_tuple)
+        self.sndhwm = sndhwm
+        self.io_threads = io_threads
+        self.context = None
+        self.pull = None
+        self.push = None
+        self._running = False
+
+    def bind(self):
+        self.context = zmq.Context(self.io_threads)
+        self.pull = self.context.socket(zmq.PULL)
+        self.push = self.context.socket(zmq.PUSH)
+
+        if self.sndhwm is not None:
+            self.push.setsockopt(zmq.SNDHWM, self.sndhwm)
+
+        self.pull.bind(self.frontend)
+        self.push.bind(self.bind_host)
+        _LOG.info('Fanning in {0} to {1}'.format(
+            self.frontend, self.push.getsockopt(zmq.LAST_ENDPOINT)))
+
+    def run(self, index=None):
+        """
+        Binds, when not yet bound, and forwards messages until close is
+        called. May be used as a Supervisor worker target.
+        """
+        if self.context is None:
+            self.bind()
+
+        self._running = True
+
+        try:
+            zmq.proxy(self.pull, self.push)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            self._running = False
+            self._close_sockets()
+
+    def close(self):
+        """
+        Stops a running proxy and terminates the context
+        """
+        if self.context is None:
+            return
+
+        if not self._running:
+            self._close_sockets()
+
+        # Blocks until a running proxy has closed its sockets
+        context = self.context
+        self.context = None
+        context.term()
+
+    def _close_sockets(self):
+        for sock in (self.pull, self.push):
+            if sock is not None:
+                sock.close(linger=0)
+        self.pull = self.push = None
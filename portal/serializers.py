@@ -0,0 +1,370 @@
+"""
+The serializers module defines how parsed syslog messages are encoded for
+the transport layer and decoded again by downstream receivers.
+
+Every serializer offers the same four methods:
+
+    dumps(msg_head, message, msg_length) -> bytes
+    dumps_head(msg_head, message_size, msg_length) -> bytes
+    loads(data, message=None) -> dict
+    loads_many(records, messages=None) -> list of dicts
+
+where message is the raw message body, as bytes or as any object supporting
+the buffer protocol, and the dictionary returned by loads holds the head
+fields along with the message and msg_length keys. dumps_head encodes
+everything but the message body for transports that send the body on its
+own; loads is then given that body as message. loads_many decodes a list of
+records, and of their bodies when given, at once.
+"""
+
+import codecs
+import struct
+
+import simplejson as json
+
+
+# Binary record layout, all integers little-endian:
+#
+#   header      B format, B flags, H priority, H version, I msg_length,
+#               H length table size, I message length
+#   lengths     H timestamp, hostname, appname, processid and messageid
+#               lengths followed, for each SD element, by H name length,
+#               H field count and then H name and value lengths per field
+#   timestamp   q seconds, I microseconds, h offset; only when the
+#               FLAG_TIMESTAMP flag is set
+#   bytes       the raw timestamp, hostname, appname, processid and
+#               messageid bytes, then each SD element name followed by
+#               its field names and values, then the raw message bytes
+#
+# Keeping every length in one table lets a record be decoded with two
+# struct calls and a walk over the bytes. Missing priority and version
+# values are written as NO_VALUE.
+BINARY_FORMAT = 1
+FLAG_TIMESTAMP = 1
+NO_VALUE = 0xFFFF
+
+_HEADER = struct.Struct('<BBHHIHI')
+_TIMESTAMP = struct.Struct('<qIh')
+_LENGTH = struct.Struct('<H')
+_HEAD_FIELDS = 5
+_length_tables = dict()
+
+
+def _length_table(size):
+    table = _length_tables.get(size)
+
+    if table is None:
+        table = _length_tables[size] = struct.Struct('<{0}H'.format(size))
+    return table
+
+
+class SerializationError(Exception):
+    pass
+
+
+class JsonSerializer(object):
+    """
+    JsonSerializer encodes messages as JSON objects. Message bodies must be
+    valid UTF-8. This is the format portal has always sent and is kept for
+    compatibility with existing consumers.
+    """
+
+    name = 'json'
+
+    def dumps(self, msg_head, message, msg_length):
+        message = codecs.utf_8_decode(message, 'strict', True)[0]
+        return self._dumps(msg_head, msg_length, message)
+
+    def dumps_head(self, msg_head, message_size, msg_length):
+        return self._dumps(msg_head, msg_length)
+
+    def _dumps(self, msg_head, msg_length, message=None):
+        fragments = msg_head.fragments
+
+        if fragments is None:
+            # The head dictionary is shared by the head so it is copied
+            # before being added to. SDATA values stay as bytes since
+            # simplejson decodes them as UTF-8 while encoding.
+            syslog_msg = dict(msg_head._cached_dict(decode=False))
+
+            if message is not None:
+                syslog_msg['message'] = message
+            syslog_msg['msg_length'] = msg_length
+
+            return json.dumps(syslog_msg)
+
+        prefix = fragments.get(self.name)
+
+        if prefix is None:
+            prefix = fragments[self.name] = self._head_prefix(msg_head)
+
+        syslog_msg = {
+            'timestamp': msg_head.timestamp,
+            'msg_length': msg_length
+        }
+
+        if message is not None:
+            syslog_msg['message'] = message
+
+        if msg_head.timestamp_seconds is not None:
+            syslog_msg['timestamp_seconds'] = msg_head.timestamp_seconds
+            syslog_msg['timestamp_microseconds'] = (
+                msg_head.timestamp_microseconds)
+            syslog_msg['timestamp_offset'] = msg_head.timestamp_offset
+
+        # The object is opened by the cached head keys
+        return prefix + json.dumps(syslog_msg)[1:]
+
+    def _head_prefix(self, msg_head):
+        """
+        Returns the opening of a JSON object holding every head key that a
+        HeadCache entry shares, up to and including the separator that
+        follows them.
+        """
+        head = {
+            'priority': msg_head.priority,
+            'version': msg_head.version,
+            'hostname': msg_head.hostname,
+            'appname': msg_head.appname,
+            'processid': msg_head.processid,
+            'messageid': msg_head.messageid,
+            'sd': msg_head.sd
+        }
+
+        return json.dumps(head)[:-1] + ', '
+
+    def loads(self, data, message=None):
+        syslog_msg = json.loads(data)
+
+        if message is not None:
+            syslog_msg['message'] = codecs.utf_8_decode(
+                message, 'strict', True)[0]
+
+        return syslog_msg
+
+    def loads_many(self, records, messages=None):
+        # Parsing one array saves the per call set up of the decoder
+        syslog_msgs = json.loads(b'[' + b','.join(records) + b']')
+
+        if len(syslog_msgs) != len(records):
+            # A record was not a single object, find and report it
+            syslog_msgs = [json.loads(record) for record in records]
+
+        if messages is not None:
+            for syslog_msg, message in zip(syslog_msgs, messages):
+                syslog_msg['message'] = codecs.utf_8_decode(
+                    message, 'strict', True)[0]
+
+        return syslog_msgs
+
+
+class BinarySerializer(object):
+    """
+    BinarySerializer encodes messages as compact binary records, see
+    BINARY_FORMAT above. Field, SDATA and message bytes are copied as they
+    were read off the wire so nothing is decoded or validated as UTF-8 on
+    either end; loads returns every field, SDATA value and the message as
+    bytes.
+    """
+
+    name = 'binary'
+
+    def dumps(self, msg_head, message, msg_length):
+        if not isinstance(message, bytes):
+            message = memoryview(message).tobytes()
+
+        parts = self._head_parts(msg_head, len(message), msg_length)
+        parts.append(message)
+        return b''.join(parts)
+
+    def dumps_head(self, msg_head, message_size, msg_length):
+        return b''.join(self._head_parts(msg_head, message_size, msg_length))
+
+    def _head_parts(self, msg_head, message_size, msg_length):
+        priority = msg_head.priority
+        version = msg_head.version
+        timestamp = msg_head.timestamp
+        seconds = msg_head.timestamp_seconds
+        fragments = msg_head.fragments
+
+        if fragments is None:
+            fragment = self._head_fragment(msg_head)
+        else:
+            fragment = fragments.get(self.name)
+
+            if fragment is None:
+                fragment = fragments[self.name] = self._head_fragment(
+                    msg_head)
+
+        table_size, table_tail, field_bytes = fragment
+
+        if seconds is not None:
+            flags = FLAG_TIMESTAMP
+            decoded_timestamp = _TIMESTAMP.pack(
+                seconds,
+                msg_head.timestamp_microseconds,
+                msg_head.timestamp_offset)
+        else:
+            flags = 0
+            decoded_timestamp = b''
+
+        try:
+            header = _HEADER.pack(
+                BINARY_FORMAT,
+                flags,
+                int(priority) if priority else NO_VALUE,
+                int(version) if version else NO_VALUE,
+                msg_length,
+                table_size,
+                message_size)
+            timestamp_length = _LENGTH.pack(len(timestamp))
+        except struct.error as ex:
+            raise SerializationError(
+                'Message does not fit the binary format: {0}'.format(ex))
+
+        return [
+            header, timestamp_length, table_tail, decoded_timestamp,
+            timestamp, field_bytes]
+
+    def _head_fragment(self, msg_head):
+        """
+        Encodes every head field but the timestamp, which are the fields a
+        HeadCache entry shares. Returns the size of the full length table,
+        the length table less the timestamp length that starts it and the
+        field bytes.
+        """
+        hostname = msg_head.hostname
+        appname = msg_head.appname
+        processid = msg_head.processid
+        messageid = msg_head.messageid
+
+        lengths = [len(hostname), len(appname), len(processid), len(messageid)]
+        parts = [hostname, appname, processid, messageid]
+
+        for sd_name, sd_fields in msg_head.sd.iteritems():
+            lengths.append(len(sd_name))
+            lengths.append(len(sd_fields))
+            parts.append(sd_name)
+
+            for field_name, value in sd_fields.iteritems():
+                lengths.append(len(field_name))
+                lengths.append(len(value))
+                parts.append(field_name)
+                parts.append(value)
+
+        try:
+            table_tail = _length_table(len(lengths)).pack(*lengths)
+        except struct.error as ex:
+            raise SerializationError(
+                'Message does not fit the binary format: {0}'.format(ex))
+
+        return len(lengths) + 1, table_tail, b''.join(parts)
+
+    def loads(self, data, message=None):
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+
+        if message is not None and not isinstance(message, bytes):
+            message = memoryview(message).tobytes()
+
+        try:
+            (record_format, flags, priority, version, msg_length,
+             table_size, message_len) = _HEADER.unpack_from(data)
+
+            if record_format != BINARY_FORMAT:
+                raise SerializationError(
+                    'Unknown binary record format {0}'.format(record_format))
+
+            table = _length_table(table_size)
+            lengths = table.unpack_from(data, _HEADER.size)
+            offset = _HEADER.size + table.size
+
+            syslog_msg = {
+                'priority': str(priority) if priority != NO_VALUE else '',
+                'version': str(version) if version != NO_VALUE else '',
+                'msg_length': msg_length
+            }
+
+            if flags & FLAG_TIMESTAMP:
+                (syslog_msg['timestamp_seconds'],
+                 syslog_msg['timestamp_microseconds'],
+                 syslog_msg['timestamp_offset']) = _TIMESTAMP.unpack_from(
+                    data, offset)
+                offset += _TIMESTAMP.size
+        except struct.error:
+            raise SerializationError('Truncated binary record')
+
+        if table_size < _HEAD_FIELDS:
+            raise SerializationError('Truncated binary length table')
+
+        end = offset + lengths[0]
+        syslog_msg['timestamp'] = data[offset:end]
+        offset, end = end, end + lengths[1]
+        syslog_msg['hostname'] = data[offset:end]
+        offset, end = end, end + lengths[2]
+        syslog_msg['appname'] = data[offset:end]
+        offset, end = end, end + lengths[3]
+        syslog_msg['processid'] = data[offset:end]
+        offset, end = end, end + lengths[4]
+        syslog_msg['messageid'] = data[offset:end]
+        offset = end
+
+        sd = syslog_msg['sd'] = dict()
+        index = _HEAD_FIELDS
+
+        try:
+            while index < table_size:
+                end = offset + lengths[index]
+                sd_fields = sd[data[offset:end]] = dict()
+                offset = end
+                field_count = lengths[index + 1]
+                index += 2
+
+                for _ in xrange(field_count):
+                    end = offset + lengths[index]
+                    value_end = end + lengths[index + 1]
+                    sd_fields[data[offset:end]] = data[end:value_end]
+                    offset = value_end
+                    index += 2
+        except IndexError:
+            raise SerializationError('Truncated binary length table')
+
+        if message is None:
+            end = offset + message_len
+            syslog_msg['message'] = data[offset:end]
+        else:
+            # The record ends where the message would have begun
+            end = offset
+            syslog_msg['message'] = message
+
+            if len(message) != message_len:
+                raise SerializationError('Binary message length mismatch')
+
+        if end != len(data):
+            raise SerializationError('Binary record length mismatch')
+
+        return syslog_msg
+
+    def loads_many(self, records, messages=None):
+        loads = self.loads
+
+        if messages is None:
+            return [loads(record) for record in records]
+        return [loads(record, message)
+                for record, message in zip(records, messages)]
+
+
+SERIALIZERS = {
+    JsonSerializer.name: JsonSerializer,
+    BinarySerializer.name: BinarySerializer
+}
+
+
+def get_serializer(name):
+    """
+    Returns a new serializer for the given name, either 'json' or 'binary'
+    """
+    try:
+        return SERIALIZERS[name]()
+    except KeyError:
+        raise ValueError('Unknown serializer: {0}'.format(name))
@@ -1,57 +1,420 @@
+import errno
+import os
+import socket
+import time
+
 from portal.log import get_logger
 
 from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 from tornado.tcpserver import TCPServer
 
-from portal.input.syslog import Parser, SyslogMessageHandler
+from portal.input.syslog import (
+    HeadCache, Parser, ParserPool, ParsingError, SyslogMessageHandler)
 
 
 _LOG = get_logger(__name__)
 
+# The largest payload a UDP datagram can carry
+MAX_DATAGRAM_SIZE = 65535
+
+_PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
 
 class TornadoConnection(object):
+    """
+    Reads a stream one chunk at a time into its reader. Reading stops while
+    the connection is paused, leaving unread data in the socket so that TCP
+    flow control pushes back on the sender.
+    """
 
-    def __init__(self, reader, stream, address):
+    def __init__(self, reader, stream, address, close_callback=None,
+                 paused=False):
         self.reader = reader
         self.stream = stream
         self.address = address
+        self.close_callback = close_callback
+        self.paused = paused
+        self._reading = False
 
         # Set our callbacks
         self.stream.set_close_callback(self._on_close)
-        self.stream.read_until_close(
-            callback=self._on_stream,
-            streaming_callback=self._on_stream)
+
+        if not paused:
+            self._read()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+        if not self._reading and self.reader is not None:
+            self._read()
+
+    def _read(self):
+        self._reading = True
+
+        try:
+            self.stream.read_bytes(
+                self.stream.read_chunk_size,
+                callback=self._on_stream,
+                partial=True)
+        except StreamClosedError:
+            self._reading = False
 
     def _on_stream(self, data):
+        self._reading = False
+
+        if self.reader is None:
+            return
+
         try:
             self.reader.read(data)
         except Exception as ex:
             _LOG.exception(ex)
 
+        if not self.paused and self.reader is not None:
+            self._read()
+
     def _on_close(self):
-        pass
+        reader = self.reader
+        self.reader = None
+
+        if self.close_callback is not None:
+            self.close_callback(reader)
 
 
 class TornadoTcpServer(TCPServer):
+    """
+    Listens on address, or on listening sockets bound before a worker
+    process was forked. With reuse_port set the socket is bound with
+    SO_REUSEPORT so that every worker process may bind the same address
+    and have the kernel spread connections across them.
+    """
 
-    def __init__(self, address, ssl_options=None):
+    def __init__(self, address, ssl_options=None, reuse_port=False):
         super(TornadoTcpServer, self).__init__(ssl_options=ssl_options)
         self.address = address
+        self.reuse_port = reuse_port
 
-    def start(self):
-        self.bind(self.address[1], self.address[0])
+    def start(self, sockets=None):
+        if sockets is None:
+            self.bind(
+                self.address[1], self.address[0], reuse_port=self.reuse_port)
+        else:
+            self.add_sockets(sockets)
         super(TornadoTcpServer, self).start()
         _LOG.info('TCP server ready!')
 
 
 class SyslogServer(TornadoTcpServer):
+    """
+    Accepts syslog connections and parses them with pooled parsers. Reading
+    from every connection may be paused and resumed, for example while the
+    transport downstream is full; paused_time totals the seconds spent
+    paused.
+    """
 
-    def __init__(self, address, msg_delegate, ssl_options=None):
-        super(SyslogServer, self).__init__(address, ssl_options)
+    def __init__(self, address, msg_delegate, ssl_options=None,
+                 parser_pool_size=1024, decode_timestamp=False,
+                 head_cache_size=0, reuse_port=False):
+        super(SyslogServer, self).__init__(address, ssl_options, reuse_port)
         self.msg_delegate = msg_delegate
+        self.head_cache = None
+        self.connections = dict()
+        self.pauses = 0
+        self._paused_since = None
+        self._paused_time = 0.0
+
+        if head_cache_size:
+            self.head_cache = HeadCache(head_cache_size)
+
+        self.parser_pool = ParserPool(
+            msg_delegate,
+            parser_pool_size,
+            decode_timestamp=decode_timestamp,
+            head_cache=self.head_cache)
+
+    @property
+    def paused(self):
+        return self._paused_since is not None
+
+    @property
+    def paused_time(self):
+        """
+        Seconds spent paused, including the current pause
+        """
+        if self._paused_since is None:
+            return self._paused_time
+        return self._paused_time + time.time() - self._paused_since
+
+    def pause_reading(self):
+        """
+        Stops reading from every connection, including ones accepted later
+        """
+        if self._paused_since is not None:
+            return
+
+        self._paused_since = time.time()
+        self.pauses += 1
+
+        for connection in self.connections.itervalues():
+            connection.pause()
+
+    def resume_reading(self):
+        """
+        Starts reading from every connection again
+        """
+        if self._paused_since is None:
+            return
+
+        self._paused_time += time.time() - self._paused_since
+        self._paused_since = None
+
+        for connection in self.connections.values():
+            connection.resume()
 
     def handle_stream(self, stream, address):
-        TornadoConnection(Parser(self.msg_delegate), stream, address)
+        reader = self.parser_pool.acquire()
+        self.connections[reader] = TornadoConnection(
+            reader,
+            stream,
+            address,
+            self._on_connection_close,
+            paused=self.paused)
+
+    def _on_connection_close(self, reader):
+        self.connections.pop(reader, None)
+        self.parser_pool.release(reader)
+
+
+def bind_udp_socket(address, rcvbuf=None, reuse_port=False):
+    """
+    Returns a non-blocking UDP socket bound to a (host, port) address. The
+    socket's receive buffer is grown to rcvbuf bytes when given, as far as
+    the kernel allows.
+    """
+    host, port = address
+    family, sock_type, proto, _, sockaddr = socket.getaddrinfo(
+        host, port, socket.AF_UNSPEC, socket.SOCK_DGRAM)[0]
+    sock = socket.socket(family, sock_type, proto)
+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+            # Linux doubles the size asked for to make room for bookkeeping
+            granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+            if granted < rcvbuf:
+                _LOG.warning(
+                    'UDP receive buffer is {0} bytes, not {1}; raise '
+                    'net.core.rmem_max to allow more'.format(granted, rcvbuf))
+
+        sock.setblocking(False)
+        sock.bind(sockaddr)
+    except Exception:
+        sock.close()
+        raise
+
+    return sock
+
+
+class SyslogUdpServer(object):
+    """
+    Reads syslog datagrams off a non-blocking UDP socket on the IOLoop.
+    Every datagram holds one message, see RFC 5426, which is received into
+    a buffer allocated once and parsed in place by a single Parser shared
+    by every sender. Up to batch_size datagrams are read each time the
+    socket is readable so that a flood of datagrams does not starve the
+    rest of the IOLoop.
+
+    Reading may be paused and resumed like SyslogServer's, in which case
+    datagrams queue in the socket's receive buffer until the kernel drops
+    them. Malformed datagrams are counted in errors and datagrams the
+    kernel dropped in kernel_drops.
+    """
+
+    def __init__(self, address, msg_delegate, rcvbuf=None, batch_size=64,
+                 decode_timestamp=False, head_cache_size=0,
+                 reuse_port=False, io_loop=None):
+        """
+        :param address: (host, port) to receive datagrams on
+        :param msg_delegate: The message handler parsed messages are
+        passed to
+        :param rcvbuf: Optional size in bytes of the socket's receive buffer
+        :param batch_size: The most datagrams read in one pass of the IOLoop
+        :param decode_timestamp: Whether the parser decodes timestamps
+        :param head_cache_size: The number of message heads to cache, see
+        portal.input.syslog.HeadCache
+        :param reuse_port: Whether the socket is bound with SO_REUSEPORT
+        :param io_loop: The IOLoop to read on, defaults to the current
+        IOLoop
+        """
+        self.address = address
+        self.msg_delegate = msg_delegate
+        self.rcvbuf = rcvbuf
+        self.batch_size = batch_size
+        self.reuse_port = reuse_port
+        self.io_loop = io_loop
+        self.socket = None
+        self.head_cache = None
+
+        self.received = 0
+        self.errors = 0
+        self.pauses = 0
+        self._paused_since = None
+        self._paused_time = 0.0
+        self._reading = False
+
+        if head_cache_size:
+            self.head_cache = HeadCache(head_cache_size)
+
+        self.parser = Parser(
+            msg_delegate,
+            decode_timestamp=decode_timestamp,
+            head_cache=self.head_cache)
+        self._buffer = bytearray(MAX_DATAGRAM_SIZE)
+
+    @property
+    def paused(self):
+        return self._paused_since is not None
+
+    @property
+    def paused_time(self):
+        """
+        Seconds spent paused, including the current pause
+        """
+        if self._paused_since is None:
+            return self._paused_time
+        return self._paused_time + time.time() - self._paused_since
+
+    @property
+    def kernel_drops(self):
+        """
+        The number of datagrams the kernel dropped for want of room in the
+        socket's receive buffer, or None where that is not reported
+        """
+        if self.socket is None:
+            return None
+
+        inode = str(os.fstat(self.socket.fileno()).st_ino)
+
+        for path in _PROC_NET_UDP:
+            try:
+                with open(path) as proc_file:
+                    lines = proc_file.readlines()[1:]
+            except IOError:
+                continue
+
+            for line in lines:
+                fields = line.split()
+
+                # The inode is the tenth field and drops the last
+                if len(fields) > 12 and fields[9] == inode:
+                    return int(fields[-1])
+        return None
+
+    def start(self, sock=None):
+        """
+        Starts reading datagrams, from sock when given, for example one
+        bound before a worker process was forked
+        """
+        if sock is None:
+            sock = bind_udp_socket(
+                self.address, self.rcvbuf, self.reuse_port)
+
+        if self.io_loop is None:
+            self.io_loop = IOLoop.current()
+
+        self.socket = sock
+
+        if not self.paused:
+            self._add_handler()
+        _LOG.info('UDP server ready!')
+
+    def stop(self):
+        """
+        Stops reading and closes the socket
+        """
+        if self.socket is None:
+            return
+
+        self._remove_handler()
+        self.socket.close()
+        self.socket = None
+
+    def pause_reading(self):
+        """
+        Stops reading datagrams
+        """
+        if self._paused_since is not None:
+            return
+
+        self._paused_since = time.time()
+        self.pauses += 1
+        self._remove_handler()
+
+    def resume_reading(self):
+        """
+        Starts reading datagrams again
+        """
+        if self._paused_since is None:
+            return
+
+        self._paused_time += time.time() - self._paused_since
+        self._paused_since = None
+
+        if self.socket is not None:
+            self._add_handler()
+
+    def _add_handler(self):
+        if not self._reading:
+            self._reading = True
+            self.io_loop.add_handler(
+                self.socket.fileno(), self._on_readable, IOLoop.READ)
+
+    def _remove_handler(self):
+        if self._reading:
+            self._reading = False
+            self.io_loop.remove_handler(self.socket.fileno())
+
+    def _on_readable(self, fd=None, events=None):
+        recv_into = self.socket.recv_into
+        read_message = self.parser.read_message
+        buffer = self._buffer
+
+        for _ in xrange(self.batch_size):
+            try:
+                size = recv_into(buffer)
+            except socket.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+
+                if ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    _LOG.exception(ex)
+                return
+
+            self.received += 1
+
+            try:
+                read_message(buffer, size)
+            except ParsingError as ex:
+                self.errors += 1
+                _LOG.debug('Dropped a malformed datagram: {0}'.format(ex))
+            except Exception as ex:
+                self.errors += 1
+                _LOG.exception(ex)
+
+            if not self._reading:
+                # Paused by the message handler
+                return
 
 
 def start_io():
@@ -0,0 +1,359 @@
+"""
+The spool module keeps serialized messages on disk while they can not be
+sent downstream so that they survive an outage of the downstream workers,
+and a restart of Portal during one.
+
+A spool is a directory of fixed size, memory-mapped segment files that
+messages are appended to in order and replayed from in the same order. A
+segment is deleted once every message in it has been replayed.
+"""
+
+import os
+import mmap
+import struct
+import time
+
+from collections import deque
+
+from portal.log import get_logger
+
+
+_LOG = get_logger(__name__)
+
+# Record layout, all integers little-endian:
+#
+#   header      I payload length, B state, I frame count
+#   payload     I length per frame followed by the frame bytes
+#
+# The header is written after the payload and segments start out zeroed so
+# a zero payload length marks the end of a segment's records. Replayed
+# records are marked SENT so that a reopened spool skips them.
+PENDING = 0
+SENT = 1
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 16
+
+_RECORD = struct.Struct('<IBI')
+_STATE = struct.Struct('<B')
+_STATE_OFFSET = 4
+_SEGMENT_NAME = '{0:010d}.spool'
+_SEGMENT_SUFFIX = '.spool'
+_FRAME_LENGTH = struct.Struct('<I')
+
+
+def _frame_table_format(count):
+    return '<{0}I'.format(count)
+
+
+class SpoolError(Exception):
+    pass
+
+
+class SpoolSegment(object):
+    """
+    A single memory-mapped segment file. Records are read from read_offset
+    and appended at write_offset.
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+
+        if size is None:
+            fd = os.open(path, os.O_RDWR)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+
+        try:
+            if size is None:
+                size = os.fstat(fd).st_size
+            else:
+                os.ftruncate(fd, size)
+
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.size = size
+        self.read_offset = 0
+        self.write_offset = 0
+
+    def recover(self):
+        """
+        Finds the records left in the segment by an earlier spool. Returns
+        the number of records that were never replayed.
+        """
+        offset = 0
+        pending = 0
+
+        while True:
+            record = self._read_header(offset)
+
+            if record is None:
+                break
+
+            length, state, _ = record
+
+            if state == SENT and pending == 0:
+                self.read_offset = offset + _RECORD.size + length
+            elif state != SENT:
+                pending += 1
+
+            offset += _RECORD.size + length
+
+        self.write_offset = offset
+        return pending
+
+    def append(self, frames):
+        """
+        Appends a record holding the given frames. Returns False when the
+        segment has no room left for it.
+        """
+        table = struct.pack(
+            _frame_table_format(len(frames)), *[len(f) for f in frames])
+        payload = table + b''.join(frames)
+        start = self.write_offset + _RECORD.size
+        end = start + len(payload)
+
+        if end > self.size:
+            return False
+
+        self.map[start:end] = payload
+        _RECORD.pack_into(
+            self.map, self.write_offset, len(payload), PENDING, len(frames))
+        self.write_offset = end
+        return True
+
+    def read(self):
+        """
+        Returns the frames of the record at read_offset and the offset of
+        the record after it, or None when every record has been read.
+        """
+        offset = self.read_offset
+
+        if offset >= self.write_offset:
+            return None
+
+        length, _, count = self._read_header(offset)
+        lengths = struct.unpack_from(
+            _frame_table_format(count), self.map, offset + _RECORD.size)
+        start = offset + _RECORD.size + _FRAME_LENGTH.size * count
+        frames = list()
+
+        for frame_length in lengths:
+            end = start + frame_length
+            frames.append(self.map[start:end])
+            start = end
+
+        return frames, offset + _RECORD.size + length
+
+    def mark_sent(self, next_offset):
+        _STATE.pack_into(self.map, self.read_offset + _STATE_OFFSET, SENT)
+        self.read_offset = next_offset
+
+    def _read_header(self, offset):
+        if offset + _RECORD.size > self.size:
+            return None
+
+        record = _RECORD.unpack_from(self.map, offset)
+        length, _, count = record
+
+        if length == 0:
+            return None
+
+        if (offset + _RECORD.size + length > self.size
+                or length < _FRAME_LENGTH.size * count):
+            raise SpoolError(
+                'Corrupt spool record at {0}:{1}'.format(self.path, offset))
+        return record
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+class Spool(object):
+    """
+    Spool is an append-only queue of multipart messages kept in
+    memory-mapped segment files under a directory. At most max_segments
+    files of segment_size bytes each are used; appends are refused once
+    they are full.
+
+    Messages left in the directory by an earlier spool are replayed first.
+    A record is marked as sent when it is popped so messages are replayed
+    at least once, and only sent again if Portal stops between sending
+    a message and popping it.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 max_segments=DEFAULT_MAX_SEGMENTS):
+        """
+        :param directory: The directory to keep segment files in, created
+        when missing
+        :param segment_size: The size of each segment file in bytes
+        :param max_segments: The most segment files to use at once
+        """
+        if segment_size <= _RECORD.size:
+            raise ValueError('segment_size is too small')
+
+        if max_segments < 1:
+            raise ValueError('max_segments must be at least 1')
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+
+        self.depth = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.refused = 0
+        self.replay_rate = 0.0
+
+        self._segments = deque()
+        self._next_segment = 0
+        self._peeked = None
+        self._rate_start = None
+        self._rate_count = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._recover()
+
+    def __len__(self):
+        return self.depth
+
+    def _recover(self):
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith(_SEGMENT_SUFFIX))
+
+        for name in names:
+            segment = SpoolSegment(os.path.join(self.directory, name))
+            pending = segment.recover()
+
+            if pending:
+                self._segments.append(segment)
+                self.depth += pending
+            else:
+                self._remove(segment)
+
+            self._next_segment = int(name[:-len(_SEGMENT_SUFFIX)]) + 1
+
+        if self.depth:
+            _LOG.info('Recovered {0} spooled messages from {1}'.format(
+                self.depth, self.directory))
+
+    def append(self, frames):
+        """
+        Appends a message made up of the given frames. Returns False, and
+        keeps nothing, when the spool is full.
+        """
+        frames = [
+            frame if isinstance(frame, bytes) else memoryview(frame).tobytes()
+            for frame in frames]
+
+        if not self._segments or not self._segments[-1].append(frames):
+            record_size = (_RECORD.size + _FRAME_LENGTH.size * len(frames)
+                           + sum(len(frame) for frame in frames))
+
+            if (len(self._segments) >= self.max_segments
+                    or record_size > self.segment_size):
+                self.refused += 1
+                return False
+
+            self._add_segment().append(frames)
+
+        self.depth += 1
+        self.spooled += 1
+        return True
+
+    def peek(self):
+        """
+        Returns the frames of the oldest message in the spool, or None when
+        the spool is empty
+        """
+        if self._peeked is None:
+            if not self.depth:
+                return None
+
+            segment = self._segments[0]
+            record = segment.read()
+
+            if record is None:
+                # Every record in the oldest segment has been read
+                self._remove(self._segments.popleft())
+                return self.peek()
+
+            self._peeked = segment, record[0], record[1]
+
+        return self._peeked[1]
+
+    def pop(self):
+        """
+        Drops the oldest message from the spool once it has been sent
+        """
+        if self.peek() is None:
+            return
+
+        segment, _, next_offset = self._peeked
+        self._peeked = None
+        segment.mark_sent(next_offset)
+        self.depth -= 1
+        self.replayed += 1
+        self._count_replay()
+
+        if not self.depth:
+            # Start over with a fresh segment on the next append
+            while self._segments:
+                self._remove(self._segments.popleft())
+
+    def _count_replay(self):
+        now = time.time()
+
+        if self._rate_start is None:
+            self._rate_start = now
+            self._rate_count = 0
+
+        self._rate_count += 1
+        elapsed = now - self._rate_start
+
+        if elapsed >= 1.0:
+            self.replay_rate = self._rate_count / elapsed
+            self._rate_start = now
+            self._rate_count = 0
+
+    def _add_segment(self):
+        path = os.path.join(
+            self.directory, _SEGMENT_NAME.format(self._next_segment))
+        segment = SpoolSegment(path, self.segment_size)
+        self._segments.append(segment)
+        self._next_segment += 1
+        return segment
+
+    def _remove(self, segment):
+        segment.close()
+        os.unlink(segment.path)
+
+    def stats(self):
+        """
+        Returns the spool's metrics as a dictionary
+        """
+        return {
+            'depth': self.depth,
+            'segments': len(self._segments),
+            'spooled': self.spooled,
+            'replayed': self.replayed,
+            'refused': self.refused,
+            'replay_rate': self.replay_rate
+        }
+
+    def close(self):
+        """
+        Flushes and closes the segment files, leaving every message that
+        was not popped on disk
+        """
+        while self._segments:
+            self._segments.popleft().close()
+
+        self._peeked = None
@@ -0,0 +1,143 @@
+import unittest
+import zlib
+
+from portal import compression
+from portal.serializers import JsonSerializer
+from portal.input.syslog.usyslog import Parser
+from portal.tests.serializers_test import MessageCatcher
+
+
+def sample_traffic(count, serializer=None):
+    catcher = MessageCatcher(serializer or JsonSerializer())
+    parser = Parser(catcher)
+
+    for index in range(count):
+        parser.read(
+            b'<46>1 2003-10-11T22:14:{0:02d}.003+01:00 host-{1} rsyslogd '
+            b'{2} ID47 [origin software="rsyslogd" swVersion="7.2.5"] '
+            b'queue {3} of worker {4} processed\n'.format(
+                index % 60, index % 7, 12000 + index % 13, index, index % 3))
+    return catcher.records
+
+
+class WhenCompressingFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = ['head', '', bytearray('body'), memoryview('tail')]
+
+    def test_round_trip(self):
+        compressor = compression.FrameCompressor()
+        frame = compressor.compress(self.frames)
+        self.assertEqual(
+            ['head', '', 'body', 'tail'], compressor.decompress(frame))
+        self.assertEqual(
+            ['head', '', 'body', 'tail'],
+            compressor.decompress(memoryview(frame)))
+
+    def test_compresses_repetitive_batches(self):
+        batch = sample_traffic(100)
+        frame = compression.FrameCompressor().compress(batch)
+        self.assertLess(len(frame) * 4, sum(len(msg) for msg in batch))
+
+    def test_dictionary(self):
+        samples = sample_traffic(200)
+        dictionary = compression.train_dictionary(samples)
+        plain = compression.FrameCompressor(6)
+        primed = compression.FrameCompressor(6, dictionary)
+
+        # A receiver may use any level with the same dictionary
+        receiver = compression.FrameCompressor(1, dictionary)
+
+        batch = samples[-2:]
+        frame = primed.compress(batch)
+        self.assertEqual(batch, receiver.decompress(frame))
+        self.assertEqual(batch, primed.decompress(frame))
+        self.assertLess(len(frame) * 2, len(plain.compress(batch)))
+
+        # The primed compressor is reused
+        self.assertEqual(frame, primed.compress(batch))
+
+    def test_dictionary_mismatch(self):
+        primed = compression.FrameCompressor(dictionary='hostname appname')
+        other = compression.FrameCompressor(dictionary='hostname processid')
+        frame = primed.compress(self.frames)
+
+        with self.assertRaises(compression.CompressionError):
+            other.decompress(frame)
+
+        with self.assertRaises(compression.CompressionError):
+            compression.FrameCompressor().decompress(frame)
+
+    def test_corrupt_frames(self):
+        compressor = compression.FrameCompressor()
+        frame = compressor.compress(self.frames)
+
+        for corrupt in (frame[:3], b'\x02' + frame[1:], frame[:-4],
+                        frame + b'junk', frame[:5] + b'junk'):
+            with self.assertRaises(compression.CompressionError):
+                compressor.decompress(corrupt)
+
+        # A frame length past the end of the packed frames
+        packed = zlib.compress(b'\xff\x00\x00\x00abc')
+        with self.assertRaises(compression.CompressionError):
+            compressor.decompress(frame[:5] + packed)
+
+    def test_max_size(self):
+        compressor = compression.FrameCompressor(max_size=1024)
+        frame = compressor.compress(['x' * 2048])
+
+        with self.assertRaises(compression.CompressionError):
+            compressor.decompress(frame)
+
+    def test_level(self):
+        with self.assertRaises(ValueError):
+            compression.FrameCompressor(10)
+
+    def test_train_dictionary(self):
+        samples = sample_traffic(100)
+        dictionary = compression.train_dictionary(samples, 256)
+        self.assertLessEqual(len(dictionary), 256)
+        self.assertIn('"hostname": ', dictionary)
+        self.assertEqual('', compression.train_dictionary(['unique']))
+
+
+def compression_performance(batch_sizes=(1, 10, 100, 1000), messages=20000,
+                            levels=(1, 6, 9)):
+    import time
+
+    samples = sample_traffic(messages)
+    dictionary = compression.train_dictionary(samples[:1000])
+    raw_bytes = sum(len(msg) for msg in samples)
+
+    print('{0} JSON messages, {1} bytes'.format(messages, raw_bytes))
+
+    for batch_size in batch_sizes:
+        batches = [samples[index:index + batch_size]
+                   for index in range(0, messages, batch_size)]
+
+        for level in levels:
+            for preset in (None, dictionary):
+                compressor = compression.FrameCompressor(level, preset)
+
+                then = time.time()
+                frames = [compressor.compress(batch) for batch in batches]
+                compress_time = time.time() - then
+
+                then = time.time()
+                for frame in frames:
+                    compressor.decompress(frame)
+                decompress_time = time.time() - then
+
+                sent_bytes = sum(len(frame) for frame in frames)
+                print('batch {0:>4}, level {1}, {2:<13} ratio {3:5.2f}, '
+                      'compress {4:6.2f} us/msg, '
+                      'decompress {5:5.2f} us/msg'.format(
+                          batch_size, level,
+                          'dictionary,' if preset else 'no dictionary,',
+                          raw_bytes / float(sent_bytes),
+                          compress_time / messages * 1e6,
+                          decompress_time / messages * 1e6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
+import calendar
+import mmap
+import threading
 import unittest
 import time
 
 from portal.input.syslog import (
-    SyslogMessageHandler, Parser, ParsingError
+    SyslogMessageHandler, SyslogMessageHead, Parser, ParserPool,
+    ParsingError, parse_columns, HEAD_FIELDS, MessageFilter, HeadCache
 )
 
 BAD_OCTET_COUNT = (
@@ -50,6 +54,10 @@ MISSING_FIELDS = bytearray(
 NO_STRUCTURED_DATA = bytearray(
     b'30 <46>1 - tohru - 6611 - - start')
 
+ESCAPED_SD_VALUE = (
+    b'<46>1 - tohru - 6611 - [origin x-info="a \\"quoted\\" \\] \\\\ \\x"] '
+    b'start\n')
+
 BLANK_CHAR_MESSAGE = bytearray(
     b'156 <13>1 2013-11-19T20:30:58+00:00 '
     b'c-10-13-0-254.c0002.netdev-ord.ohthree.com - - - '
@@ -225,6 +233,49 @@ class MissingSDValidator(MessageValidator):
         test.assertEqual('-', msg_head.messageid)
         test.assertEqual(0, len(msg_head.sd))
 
+class EscapedSDValidator(MessageValidator):
+
+    def _validate(self, test, caught_exception, msg_head, msg):
+        test.assertEqual(
+            {'origin': {'x-info': b'a "quoted" ] \\ \\x'}},
+            msg_head.sd)
+        test.assertEqual('start\n', msg)
+
+class WholeBodyValidator(RsyslogMessageValidator):
+
+    def __init__(self, test):
+        super(WholeBodyValidator, self).__init__(test)
+        self.bodies = 0
+        self.parts = 0
+
+    def on_msg_part(self, msg_part):
+        self.parts += 1
+        super(WholeBodyValidator, self).on_msg_part(msg_part)
+
+    def on_msg_body(self, msg_body, msg_length):
+        self.bodies += 1
+        self.test.assertIsInstance(msg_body, memoryview)
+        self.msg = bytearray(msg_body)
+        self.on_msg_complete(msg_length)
+
+class StrConcatHandler(SyslogMessageHandler):
+    """
+    A handler written against the part API alone, building each message
+    up as a str
+    """
+
+    def __init__(self):
+        super(StrConcatHandler, self).__init__()
+        self.messages = list()
+
+    def on_msg_part(self, msg_part):
+        self.msg += msg_part
+
+    def on_msg_complete(self, msg_length):
+        self.messages.append(self.msg)
+        self.msg = ''
+
+
 msg_1 = '156 <13>1 2013-11-19T20:30:58+00:00 c-10-13-0-254.c0002.netdev-ord.ohthree.com - - - [meniscus tenant="95feffb0" token="4c5e9071-6791-4023-859c-aa39077582d0"] '
 class BlankCharMessageValidator(MessageValidator):
 
@@ -263,6 +314,13 @@ class WhenParsingSyslog(unittest.TestCase):
         with self.assertRaises(ParsingError):
             parser.read(SHORT_OCTET_COUNT)
 
+    def test_octet_count_shorter_than_head(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator)
+
+        with self.assertRaises(ParsingError):
+            parser.read(b'10 <46>1 - tohru - 6611 - - start')
+
     def test_read_message_with_no_octet_count(self):
         validator = NoOctetCountValidator(self)
         parser = Parser(validator)
@@ -319,6 +377,95 @@ class WhenParsingSyslog(unittest.TestCase):
         self.assertTrue(validator.called)
         validator.validate()
 
+    def test_read_message_with_escaped_sd_value(self):
+        validator = EscapedSDValidator(self)
+        parser = Parser(validator)
+
+        parser.read(ESCAPED_SD_VALUE)
+        self.assertTrue(validator.called)
+        validator.validate()
+
+    def test_read_message_one_byte_at_a_time(self):
+        validator = HappyPathValidator(self)
+        parser = Parser(validator)
+
+        chunk_message(HAPPY_PATH_MESSAGE, parser, chunk_size=1)
+        self.assertTrue(validator.called)
+        validator.validate()
+
+    def test_read_whole_message_body_in_one_call(self):
+        validator = WholeBodyValidator(self)
+        parser = Parser(validator)
+
+        parser.read(ACTUAL_MESSAGE + ACTUAL_MESSAGE_NO_OCTET_COUNT)
+        self.assertEqual(2, validator.bodies)
+        self.assertEqual(0, validator.parts)
+
+        chunk_message(ACTUAL_MESSAGE, parser)
+        self.assertEqual(2, validator.bodies)
+        self.assertTrue(validator.parts > 1)
+        validator.validate()
+
+    def test_read_into_handler_without_on_msg_body(self):
+        handler = StrConcatHandler()
+        parser = Parser(handler)
+
+        parser.read(ACTUAL_MESSAGE + ACTUAL_MESSAGE_NO_OCTET_COUNT)
+        body = ACTUAL_MESSAGE.split(b' - - - ')[1]
+        self.assertEqual([body, body + b'\n'], handler.messages)
+
+    def test_default_on_msg_body_passes_bytes(self):
+        handler = StrConcatHandler()
+        body = bytearray(b'start')
+
+        handler.on_msg_body(memoryview(body), 5)
+        body[:] = b'xxxxx'
+        self.assertEqual(['start'], handler.messages)
+
+    def test_read_message_from_recv_into_slice(self):
+        validator = WholeBodyValidator(self)
+        parser = Parser(validator)
+        recv_buffer = bytearray(4096)
+        recv_buffer[10:10 + len(ACTUAL_MESSAGE)] = ACTUAL_MESSAGE
+
+        parser.read(memoryview(recv_buffer)[10:10 + len(ACTUAL_MESSAGE)])
+        self.assertEqual(1, validator.bodies)
+        validator.validate()
+
+    def test_read_message_from_mmap(self):
+        validator = RsyslogMessageValidator(self)
+        parser = Parser(validator)
+        mapped = mmap.mmap(-1, len(ACTUAL_MESSAGE))
+        mapped.write(ACTUAL_MESSAGE)
+
+        try:
+            parser.read(mapped)
+        finally:
+            mapped.close()
+
+        self.assertTrue(validator.called)
+        validator.validate()
+
+    def test_read_rejects_non_buffers(self):
+        parser = Parser(MessageValidator(self))
+
+        with self.assertRaises(TypeError):
+            parser.read(12)
+
+    def test_read_message_with_long_tokens(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator)
+        hostname = b'h' * 1500
+
+        chunk_message(
+            b'<46>1 - ' + hostname + b' - - - [origin x="' + b'v' * 3000 +
+            b'"] start\n',
+            parser)
+
+        self.assertTrue(validator.complete)
+        self.assertEqual(hostname, validator.msg_head.hostname)
+        self.assertEqual(b'v' * 3000, validator.msg_head.sd['origin']['x'])
+
     def test_read_messages_back_to_back(self):
         validator = BackToBackValidator(self)
         parser = Parser(validator)
@@ -335,6 +482,577 @@ class WhenParsingSyslog(unittest.TestCase):
         self.assertEqual(4, validator.times_called)
 
 
+class DatagramCollector(SyslogMessageHandler):
+
+    def __init__(self):
+        self.messages = list()
+        self.msg_head = None
+        self.msg = bytearray()
+
+    def on_msg_head(self, msg_head):
+        self.msg_head = msg_head
+
+    def on_msg_part(self, msg_part):
+        self.msg.extend(msg_part)
+
+    def on_msg_complete(self, msg_length):
+        self.messages.append(
+            (self.msg_head.hostname, bytes(self.msg), msg_length))
+        self.msg = bytearray()
+
+
+class WhenParsingDatagrams(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = DatagramCollector()
+        self.parser = Parser(self.collector)
+
+    def test_read_message(self):
+        datagram = bytes(HAPPY_PATH_MESSAGE[4:])
+        self.parser.read_message(datagram)
+        self.parser.read_message(memoryview(bytearray(datagram)))
+
+        self.assertEqual(
+            [(b'tohru', b'start', len(datagram))] * 2,
+            self.collector.messages)
+
+    def test_read_message_size(self):
+        buffer = bytearray(b'<46>1 - host - - - - first datagram')
+        self.parser.read_message(buffer, 26)
+        self.parser.read_message(buffer, 1000)
+
+        self.assertEqual(
+            [(b'host', b'first', 26), (b'host', b'first datagram', 35)],
+            self.collector.messages)
+
+    def test_newlines_belong_to_the_message(self):
+        datagram = b'<46>1 - host - - - - line 1\nline 2\n'
+        self.parser.read_message(datagram)
+
+        self.assertEqual(
+            [(b'host', b'line 1\nline 2\n', len(datagram))],
+            self.collector.messages)
+
+    def test_empty_message(self):
+        self.parser.read_message(b'<46>1 - host - - - - ')
+        self.parser.read_message(b'')
+
+        self.assertEqual([(b'host', b'', 21)], self.collector.messages)
+
+    def test_message_ending_in_the_head(self):
+        with self.assertRaises(ParsingError):
+            self.parser.read_message(b'<46>1 - host - - -')
+
+        self.parser.read_message(b'<46>1 - host - - - - ok')
+        self.assertEqual([(b'host', b'ok', 23)], self.collector.messages)
+
+    def test_octet_counts_are_not_read(self):
+        with self.assertRaises(ParsingError):
+            self.parser.read_message(bytes(HAPPY_PATH_MESSAGE))
+
+    def test_drops_message_in_flight(self):
+        self.parser.read(bytes(HAPPY_PATH_MESSAGE[:100]))
+        self.parser.read_message(b'<46>1 - host - - - - ok')
+
+        self.assertEqual([(b'host', b'ok', 23)], self.collector.messages)
+
+
+class WhenSelectingHeadFields(unittest.TestCase):
+
+    def test_head_ends_after_last_field(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator, fields=('hostname',))
+
+        chunk_message(ACTUAL_MESSAGE, parser)
+        self.assertTrue(validator.complete)
+        self.assertEqual('47', validator.msg_head.priority)
+        self.assertEqual(b'', validator.msg_head.timestamp)
+        self.assertEqual(b'tohru', validator.msg_head.hostname)
+        self.assertEqual(b'', validator.msg_head.appname)
+        self.assertEqual(0, len(validator.msg_head.sd))
+        self.assertTrue(validator.msg.startswith(b'rsyslogd - - - [origin '))
+        self.assertTrue(validator.msg.endswith(b'] start'))
+
+    def test_sd_is_passed_along_unparsed(self):
+        validator = WholeBodyValidator(self)
+        parser = Parser(validator, fields=HEAD_FIELDS[:-1])
+
+        parser.read(HAPPY_PATH_MESSAGE)
+        self.assertEqual(1, validator.bodies)
+        self.assertEqual(b'12512', validator.msg_head.messageid)
+        self.assertEqual(0, len(validator.msg_head.sd))
+        self.assertTrue(validator.msg.startswith(b'[origin_1 software='))
+        self.assertTrue(validator.msg.endswith(b'"] start'))
+
+    def test_no_fields(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator, fields=())
+
+        parser.read(bytes(NO_STRUCTURED_DATA))
+        self.assertEqual('46', validator.msg_head.priority)
+        self.assertEqual('1', validator.msg_head.version)
+        self.assertEqual(b'- tohru - 6611 - - start', bytes(validator.msg))
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            Parser(MessageValidator(self), fields=('severity',))
+
+
+class WhenFilteringMessages(unittest.TestCase):
+
+    def test_severity_filter(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator, msg_filter=MessageFilter(min_severity=6))
+
+        chunk_message(ACTUAL_MESSAGE + bytes(HAPPY_PATH_MESSAGE), parser)
+        self.assertEqual(1, validator.times_called)
+        self.assertEqual('46', validator.msg_head.priority)
+        self.assertEqual(b'start', bytes(validator.msg))
+        self.assertEqual(1, parser.discarded)
+
+    def test_facility_filter(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator, msg_filter=MessageFilter(
+            facilities=range(24), deny_facilities=[5]))
+
+        parser.read(ACTUAL_MESSAGE_NO_OCTET_COUNT + ACTUAL_MESSAGE)
+        self.assertFalse(validator.called)
+        self.assertFalse(validator.complete)
+        self.assertEqual(2, parser.discarded)
+
+    def test_hostname_filter(self):
+        validator = MessageValidator(self)
+        parser = Parser(
+            validator,
+            fields=(),
+            msg_filter=MessageFilter(hostname_prefix=b'toh'))
+
+        parser.read(ACTUAL_MESSAGE_NO_OCTET_COUNT)
+        self.assertTrue(validator.complete)
+        self.assertEqual(b'tohru', validator.msg_head.hostname)
+
+        parser = Parser(
+            validator,
+            msg_filter=MessageFilter(hostname_prefix=b'tohru.'))
+        parser.read(ACTUAL_MESSAGE_NO_OCTET_COUNT)
+        self.assertEqual(1, parser.discarded)
+
+    def test_appname_filter_with_batches(self):
+        parser = Parser(msg_filter=MessageFilter(appname_prefix=b'rsys'))
+        batch = parser.read_batch(
+            bytes(NO_STRUCTURED_DATA) + ACTUAL_MESSAGE +
+            bytes(NO_STRUCTURED_DATA))
+
+        self.assertEqual(1, len(batch))
+        self.assertEqual(b'rsyslogd', batch[0][0].appname)
+        self.assertEqual(2, parser.discarded)
+
+    def test_bad_severity(self):
+        with self.assertRaises(ValueError):
+            MessageFilter(min_severity=8)
+
+
+def timestamp_message(timestamp):
+    return b'<46>1 ' + timestamp + b' tohru - 6611 - - start\n'
+
+
+class WhenDecodingTimestamps(unittest.TestCase):
+
+    def setUp(self):
+        self.validator = MessageValidator(self)
+        self.parser = Parser(self.validator, decode_timestamp=True)
+
+    def decode(self, timestamp):
+        self.parser.read(timestamp_message(timestamp))
+        return self.validator.msg_head
+
+    def test_decode_timestamp_with_offset(self):
+        chunk_message(HAPPY_PATH_MESSAGE, self.parser, chunk_size=7)
+        msg_head = self.validator.msg_head
+
+        self.assertEqual(
+            calendar.timegm((2012, 12, 11, 21, 48, 23)),
+            msg_head.timestamp_seconds)
+        self.assertEqual(217459, msg_head.timestamp_microseconds)
+        self.assertEqual(-360, msg_head.timestamp_offset)
+        self.assertEqual(b'2012-12-11T15:48:23.217459-06:00',
+                         msg_head.timestamp)
+
+        head = msg_head.as_dict()
+        self.assertEqual(msg_head.timestamp_seconds, head['timestamp_seconds'])
+        self.assertEqual(-360, head['timestamp_offset'])
+
+    def test_decode_utc_timestamps_sharing_an_hour(self):
+        msg_head = self.decode(b'2003-10-11T22:14:15.003Z')
+        self.assertEqual(calendar.timegm((2003, 10, 11, 22, 14, 15)),
+                         msg_head.timestamp_seconds)
+        self.assertEqual(3000, msg_head.timestamp_microseconds)
+        self.assertEqual(0, msg_head.timestamp_offset)
+
+        msg_head = self.decode(b'2003-10-11T22:59:59+05:30')
+        self.assertEqual(
+            calendar.timegm((2003, 10, 11, 22, 59, 59)) - 330 * 60,
+            msg_head.timestamp_seconds)
+        self.assertEqual(0, msg_head.timestamp_microseconds)
+
+        msg_head = self.decode(b'2004-02-29T00:00:00Z')
+        self.assertEqual(calendar.timegm((2004, 2, 29, 0, 0, 0)),
+                         msg_head.timestamp_seconds)
+
+    def test_undecodable_timestamps(self):
+        for timestamp in (b'-', b'2003-02-29T00:00:00Z',
+                          b'2003-10-11T22:14:15', b'2003-10-11T22:14:15.Z',
+                          b'2003-10-11T22:14:15.0000001Z',
+                          b'2003-10-11X22:14:15Z'):
+            msg_head = self.decode(timestamp)
+            self.assertIsNone(msg_head.timestamp_seconds)
+            self.assertEqual(timestamp, msg_head.timestamp)
+            self.assertNotIn('timestamp_seconds', msg_head.as_dict())
+
+    def test_timestamps_are_not_decoded_by_default(self):
+        validator = MessageValidator(self)
+        Parser(validator).read(HAPPY_PATH_MESSAGE)
+
+        self.assertIsNone(validator.msg_head.timestamp_seconds)
+
+    def test_decode_timestamp_in_batches(self):
+        batch = self.parser.read_batch(
+            timestamp_message(b'2003-10-11T22:14:15.003Z'))
+
+        self.assertEqual(3000, batch[0][0].timestamp_microseconds)
+
+
+class WhenUsingSyslogMessageHead(unittest.TestCase):
+
+    def setUp(self):
+        parser = Parser()
+        self.msg_head = parser.read_batch(bytes(HAPPY_PATH_MESSAGE))[0][0]
+
+    def test_empty_head(self):
+        msg_head = SyslogMessageHead()
+
+        self.assertEqual('', msg_head.priority)
+        self.assertEqual('', msg_head.version)
+        self.assertEqual(b'', msg_head.hostname)
+        self.assertEqual({}, msg_head.sd)
+
+    def test_as_dict_decodes_sd_values(self):
+        as_dict = self.msg_head.as_dict()
+
+        self.assertEqual('46', as_dict['priority'])
+        self.assertEqual('1', as_dict['version'])
+        self.assertEqual('tohru', as_dict['hostname'])
+        self.assertEqual(
+            unicode('rsyslogd'), as_dict['sd']['origin_1']['software'])
+        self.assertIsInstance(
+            as_dict['sd']['origin_1']['software'], unicode)
+
+    def test_as_dict_without_decoding(self):
+        as_dict = self.msg_head.as_dict(decode=False)
+
+        self.assertIsInstance(as_dict['sd']['origin_1']['software'], bytes)
+        self.assertEqual(b'12297', as_dict['sd']['origin_2']['x-pid'])
+
+    def test_as_dict_is_cached_until_reset(self):
+        cached = self.msg_head._cached_dict()
+        self.assertIs(cached, self.msg_head._cached_dict())
+
+        self.msg_head.reset()
+        self.assertIsNot(cached, self.msg_head._cached_dict())
+        self.assertEqual({}, self.msg_head.as_dict()['sd'])
+
+    def test_as_dict_returns_a_copy(self):
+        as_dict = self.msg_head.as_dict()
+        as_dict['message'] = 'message'
+        as_dict['sd']['origin_1']['software'] = 'changed'
+        del as_dict['sd']['origin_2']
+
+        as_dict = self.msg_head.as_dict()
+        self.assertNotIn('message', as_dict)
+        self.assertEqual(
+            unicode('rsyslogd'), as_dict['sd']['origin_1']['software'])
+        self.assertIn('origin_2', as_dict['sd'])
+
+    def test_as_dict_is_rebuilt_when_sd_changes(self):
+        as_dict = self.msg_head.as_dict()
+
+        self.msg_head.create_sde(b'meniscus')
+        self.msg_head.set_sd_field(b'tenant')
+        self.msg_head.set_sd_value(b'5164')
+
+        self.assertEqual(
+            unicode('5164'),
+            self.msg_head.as_dict()['sd']['meniscus']['tenant'])
+        self.assertNotIn('meniscus', as_dict['sd'])
+
+    def test_copy_outlives_reset(self):
+        copy = self.msg_head.copy()
+        self.msg_head.reset()
+
+        self.assertEqual('46', copy.priority)
+        self.assertEqual(b'tohru', copy.hostname)
+        self.assertEqual(b'12512', copy.messageid)
+        self.assertEqual(b'12297', copy.sd['origin_2']['x-pid'])
+        self.assertEqual(b'', self.msg_head.hostname)
+        self.assertEqual({}, self.msg_head.sd)
+
+
+class WhenPoolingParsers(unittest.TestCase):
+
+    def setUp(self):
+        self.validator = HappyPathValidator(self)
+        self.pool = ParserPool(self.validator, max_size=1)
+
+    def test_released_parsers_are_reused(self):
+        parser = self.pool.acquire()
+        self.pool.release(parser)
+
+        self.assertEqual(1, len(self.pool))
+        self.assertIs(parser, self.pool.acquire())
+        self.assertEqual(0, len(self.pool))
+
+    def test_released_parsers_drop_partial_messages(self):
+        parser = self.pool.acquire()
+        parser.read(bytes(HAPPY_PATH_MESSAGE[:100]))
+        self.pool.release(parser)
+
+        parser = self.pool.acquire()
+        chunk_message(HAPPY_PATH_MESSAGE, parser)
+        self.validator.validate()
+
+    def test_release_leaves_shared_handler_alone(self):
+        reading = self.pool.acquire()
+        released = self.pool.acquire()
+        split = len(HAPPY_PATH_MESSAGE) - 3
+
+        reading.read(bytes(HAPPY_PATH_MESSAGE[:split]))
+        self.pool.release(released)
+        reading.read(bytes(HAPPY_PATH_MESSAGE[split:]))
+
+        self.assertTrue(self.validator.called)
+        self.validator.validate()
+
+    def test_pool_is_bounded(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+
+        self.pool.release(first)
+        self.pool.release(second)
+        self.assertEqual(1, len(self.pool))
+
+
+class WhenCachingHeads(unittest.TestCase):
+
+    def setUp(self):
+        self.head_cache = HeadCache(max_size=2)
+
+    def test_cached_heads_match_parsed_heads(self):
+        validator = HappyPathValidator(self)
+        parser = Parser(validator, head_cache=self.head_cache)
+
+        for chunk_size in (1, 7, 64, len(HAPPY_PATH_MESSAGE)):
+            chunk_message(HAPPY_PATH_MESSAGE, parser, chunk_size)
+            validator.validate()
+
+        self.assertEqual(1, self.head_cache.misses)
+        self.assertEqual(3, self.head_cache.hits)
+
+    def test_cached_escaped_sd(self):
+        validator = EscapedSDValidator(self)
+        parser = Parser(validator, head_cache=self.head_cache)
+
+        chunk_message(ESCAPED_SD_VALUE, parser, 5)
+        validator.validate()
+
+    def test_hits_share_fields(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator, head_cache=self.head_cache)
+
+        parser.read(timestamp_message(b'2003-10-11T22:14:15Z'))
+        first = validator.msg_head
+        sd, fragments = first.sd, first.fragments
+        self.assertEqual({}, fragments)
+
+        parser.read(timestamp_message(b'2003-10-11T22:14:16Z'))
+        second = validator.msg_head
+        self.assertEqual(b'2003-10-11T22:14:16Z', second.timestamp)
+        self.assertIs(sd, second.sd)
+        self.assertIs(fragments, second.fragments)
+        self.assertEqual(1, self.head_cache.hits)
+
+    def test_least_recently_used_heads_are_evicted(self):
+        parser = Parser(MessageValidator(self), head_cache=self.head_cache)
+
+        for hostname in (b'a', b'b', b'a', b'c', b'b'):
+            parser.read(
+                b'<46>1 - ' + hostname + b' - - - [x y="z"] start\n')
+
+        self.assertEqual({
+            'size': 2,
+            'max_size': 2,
+            'hits': 1,
+            'misses': 4,
+            'evictions': 2
+        }, self.head_cache.stats())
+
+        self.head_cache.clear()
+        self.assertEqual(0, len(self.head_cache))
+        self.assertEqual(0, self.head_cache.misses)
+
+    def test_uncached_heads_have_no_fragments(self):
+        validator = MessageValidator(self)
+        Parser(validator).read(ACTUAL_MESSAGE)
+        self.assertIsNone(validator.msg_head.fragments)
+
+    def test_cache_size(self):
+        with self.assertRaises(ValueError):
+            HeadCache(max_size=0)
+
+
+class WhenBatchParsingSyslog(unittest.TestCase):
+
+    def test_read_batch_returns_every_message(self):
+        parser = Parser()
+
+        batch = parser.read_batch(
+            bytes(HAPPY_PATH_MESSAGE) + ACTUAL_MESSAGE +
+            ACTUAL_MESSAGE_NO_OCTET_COUNT)
+
+        self.assertEqual(3, len(batch))
+
+        msg_head, message, msg_length = batch[0]
+        self.assertEqual('46', msg_head.priority)
+        self.assertEqual('2012-12-11T15:48:23.217459-06:00',
+                         msg_head.timestamp)
+        self.assertEqual('12512', msg_head.messageid)
+        self.assertEqual(b'7.2.2', msg_head.sd['origin_2']['swVersion'])
+        self.assertEqual(b'start', message)
+        self.assertEqual(263, msg_length)
+
+        msg_head, message, msg_length = batch[2]
+        self.assertEqual('47', msg_head.priority)
+        self.assertEqual(0, len(msg_head.sd))
+        self.assertEqual(159, msg_length)
+
+    def test_read_batch_carries_partial_messages_over(self):
+        parser = Parser()
+        data = bytes(HAPPY_PATH_MESSAGE) + ACTUAL_MESSAGE
+        split = len(HAPPY_PATH_MESSAGE) + 20
+
+        self.assertEqual(1, len(parser.read_batch(data[:split])))
+
+        batch = parser.read_batch(data[split:])
+        self.assertEqual(1, len(batch))
+
+        msg_head, message, msg_length = batch[0]
+        self.assertEqual('tohru', msg_head.hostname)
+        self.assertTrue(message.endswith(b'] start'))
+        self.assertEqual(162, msg_length)
+
+    def test_read_batch_carries_partial_sd_over(self):
+        parser = Parser()
+        data = bytes(HAPPY_PATH_MESSAGE)
+        split = data.index(b'swVersion') + 3
+
+        self.assertEqual(0, len(parser.read_batch(data[:split])))
+
+        batch = parser.read_batch(data[split:] + ACTUAL_MESSAGE)
+        self.assertEqual(2, len(batch))
+
+        msg_head, message, msg_length = batch[0]
+        self.assertEqual(b'7.2.2', msg_head.sd['origin_2']['swVersion'])
+        self.assertEqual(b'start', message)
+
+    def test_read_batch_recovers_from_errors(self):
+        parser = Parser()
+
+        with self.assertRaises(ParsingError):
+            parser.read_batch(BAD_OCTET_COUNT)
+
+        self.assertEqual(1, len(parser.read_batch(ACTUAL_MESSAGE)))
+
+    def test_read_batch_does_not_call_handler(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator)
+
+        self.assertEqual(1, len(parser.read_batch(ACTUAL_MESSAGE)))
+        self.assertFalse(validator.called)
+        self.assertFalse(validator.complete)
+
+
+class WhenParsingSyslogIntoColumns(unittest.TestCase):
+
+    def test_parse_columns(self):
+        data = (bytes(HAPPY_PATH_MESSAGE) + ACTUAL_MESSAGE_NO_OCTET_COUNT +
+                bytes(NO_STRUCTURED_DATA))
+        columns = parse_columns(data)
+
+        self.assertEqual(3, len(columns))
+        self.assertEqual([46, 47, 46], list(columns.priority))
+        self.assertEqual([1, 1, 1], list(columns.version))
+        self.assertEqual('H', columns.priority.typecode)
+        self.assertEqual(len(data), columns.consumed)
+
+        self.assertEqual(b'2012-12-11T15:48:23.217459-06:00',
+                         columns.get('timestamp', 0))
+        self.assertEqual(b'tohru', columns.get('hostname', 1))
+        self.assertEqual(b'6611', columns.get('processid', 2))
+        self.assertEqual(b'start', columns.get('message', 0))
+        self.assertEqual(b'start', columns.get('message', 2))
+
+        sd = columns.get('sd', 0)
+        self.assertTrue(sd.startswith(b'[origin_1 '))
+        self.assertTrue(sd.endswith(b'x-info="http://www.rsyslog.com"]'))
+        self.assertEqual(0, columns.sd_length[1])
+        self.assertEqual(0, columns.sd_length[2])
+
+    def test_parse_columns_stops_at_incomplete_message(self):
+        data = ACTUAL_MESSAGE + ACTUAL_MESSAGE[:40]
+        columns = parse_columns(data)
+
+        self.assertEqual(1, len(columns))
+        self.assertEqual(len(ACTUAL_MESSAGE), columns.consumed)
+        self.assertEqual(1, len(columns.hostname_offset))
+
+    def test_parse_columns_from_bytearray(self):
+        data = bytearray(ACTUAL_MESSAGE)
+        columns = parse_columns(data)
+
+        self.assertIs(data, columns.source)
+        self.assertEqual(b'tohru', columns.get('hostname', 0))
+
+    def test_parse_columns_from_memoryview_slice(self):
+        recv_buffer = bytearray(4096)
+        recv_buffer[10:10 + len(ACTUAL_MESSAGE)] = ACTUAL_MESSAGE
+        data = memoryview(recv_buffer)[10:10 + len(ACTUAL_MESSAGE)]
+        columns = parse_columns(data)
+
+        self.assertIs(data, columns.source)
+        self.assertEqual(1, len(columns))
+        self.assertEqual(len(ACTUAL_MESSAGE), columns.consumed)
+        self.assertEqual(b'tohru', columns.get('hostname', 0))
+        self.assertTrue(columns.get('message', 0).endswith(b'] start'))
+
+    def test_parse_columns_from_mmap(self):
+        data = ACTUAL_MESSAGE + ACTUAL_MESSAGE_NO_OCTET_COUNT
+        mapped = mmap.mmap(-1, len(data))
+        mapped.write(data)
+
+        try:
+            columns = parse_columns(mapped)
+
+            self.assertEqual(2, len(columns))
+            self.assertEqual(len(data), columns.consumed)
+            self.assertEqual(b'rsyslogd', columns.get('appname', 1))
+            self.assertEqual(b'tohru', columns.get('hostname', 0))
+        finally:
+            mapped.close()
+
+    def test_parse_columns_rejects_non_buffers(self):
+        with self.assertRaises(TypeError):
+            parse_columns(12)
+
+
 def performance(duration=10, print_output=True):
     validator = MessageValidator(None)
     parser = Parser(validator)
@@ -350,9 +1068,104 @@ def performance(duration=10, print_output=True):
             runs / float(duration)))
 
 
+def batch_performance(duration=10, print_output=True, batch_size=100):
+    parser = Parser()
+    data = bytes(HAPPY_PATH_MESSAGE) * batch_size
+    runs = 0
+    then = time.time()
+    while time.time() - then < duration:
+        parser.read_batch(data)
+        runs += batch_size
+    if print_output:
+        print('Batch parsed {} messages in {} seconds for {} messages per '
+              'second.'.format(runs, duration, runs / float(duration)))
+
+
+def heavy_sd_message(elements=8, fields=6):
+    sd = b''.join(
+        b'[element_{} '.format(e_index) +
+        b' '.join(b'field_{}="value {} \\"{}\\""'.format(f_index, e_index, f_index)
+                  for f_index in range(fields)) +
+        b']'
+        for e_index in range(elements))
+    return (b'<46>1 2012-12-11T15:48:23.217459-06:00 tohru rsyslogd 6611 '
+            b'12512 ' + sd + b' start\n')
+
+
+MESSAGE_SHAPES = (
+    ('octet counted', bytes(HAPPY_PATH_MESSAGE)),
+    ('newline framed', ACTUAL_MESSAGE_NO_OCTET_COUNT),
+    ('heavy sd', heavy_sd_message()),
+    ('no sd', bytes(NO_STRUCTURED_DATA))
+)
+
+
+def shape_performance(duration=10, print_output=True, batch_size=100):
+    for name, message in MESSAGE_SHAPES:
+        parser = Parser(SyslogMessageHandler())
+        data = message * batch_size
+        runs = 0
+        then = time.time()
+        while time.time() - then < duration:
+            parser.read(data)
+            runs += batch_size
+        if print_output:
+            print('{}: {} messages per second, {} MB per second.'.format(
+                name,
+                runs / float(duration),
+                runs * len(message) / float(duration) / 1048576))
+
+
+def head_cache_performance(duration=10, print_output=True, batch_size=100):
+    for name, message in MESSAGE_SHAPES:
+        for head_cache in (None, HeadCache()):
+            parser = Parser(SyslogMessageHandler(), head_cache=head_cache)
+            data = message * batch_size
+            runs = 0
+            then = time.time()
+            while time.time() - then < duration:
+                parser.read(data)
+                runs += batch_size
+            if print_output:
+                print('{}, {}: {} messages per second.'.format(
+                    name,
+                    'cached' if head_cache is not None else 'uncached',
+                    runs / float(duration)))
+
+
+def threaded_batch_performance(duration=10, print_output=True, threads=4,
+                               batch_size=100):
+    data = bytes(HAPPY_PATH_MESSAGE) * batch_size
+    counts = [0] * threads
+    then = time.time()
+
+    def run(index):
+        parser = Parser()
+        while time.time() - then < duration:
+            parser.read_batch(data)
+            counts[index] += batch_size
+
+    workers = [threading.Thread(target=run, args=(index,))
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if print_output:
+        print('{} threads batch parsed {} messages in {} seconds for {} '
+              'messages per second.'.format(
+                  threads, sum(counts), duration,
+                  sum(counts) / float(duration)))
+
+
 if __name__ == '__main__':
     unittest.main()
 
 if __name__ == 'performance':
     print('Executing performance test')
     performance(4)
+    batch_performance(4)
+    shape_performance(4)
+    for threads in (1, 2, 4):
+        threaded_batch_performance(4, threads=threads)
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import zmq
+from mock import patch
+
+from portal import processes
+
+
+class WhenCountingWorkers(unittest.TestCase):
+
+    def test_worker_count(self):
+        self.assertEqual(3, processes.worker_count(3))
+
+        with patch('portal.processes.cpu_count', return_value=8):
+            self.assertEqual(8, processes.worker_count(0))
+
+        with self.assertRaises(ValueError):
+            processes.worker_count(-1)
+
+    def test_set_cpu_affinity(self):
+        with self.assertRaises(ValueError):
+            processes.set_cpu_affinity(-1)
+
+        # Pin a child so the test runner keeps every CPU
+        pid = os.fork()
+
+        if not pid:
+            try:
+                processes.set_cpu_affinity(0)
+            finally:
+                os._exit(0)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+
+
+class WhenSupervisingWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.supervisor = processes.Supervisor(
+            restart_delay=0.01, min_uptime=0)
+        self.thread = None
+
+    def run_supervisor(self):
+        self.supervisor.start()
+        self.thread = threading.Thread(target=self.supervisor.run)
+        self.thread.start()
+
+    def read_workers(self, count):
+        started = b''
+
+        while len(started) < count:
+            started += os.read(self.read_fd, count - len(started))
+        return started
+
+    def test_restarts_workers_that_exit(self):
+        def target(index):
+            os.write(self.write_fd, str(index))
+
+        self.supervisor.add_worker(target)
+        self.supervisor.add_worker(target)
+        self.run_supervisor()
+
+        started = b''
+
+        # Each worker is started again every time it exits
+        while started.count('0') < 3 or started.count('1') < 3:
+            started += self.read_workers(1)
+
+        self.supervisor.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertTrue(all(
+            worker.restarts >= 2 for worker in self.supervisor.workers))
+
+    def test_stop_terminates_workers(self):
+        def target(index):
+            os.write(self.write_fd, 'x')
+            time.sleep(60)
+
+        worker = self.supervisor.add_worker(target, name='sleeper')
+        self.run_supervisor()
+        self.read_workers(1)
+
+        self.supervisor.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(0, worker.restarts)
+
+        with self.assertRaises(OSError):
+            os.kill(worker.pid, 0)
+
+    def tearDown(self):
+        self.supervisor.stop()
+
+        if self.thread is not None:
+            self.thread.join(5)
+
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class WhenFanningIn(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.frontend = 'ipc://{0}/fan-in.sock'.format(self.directory)
+        self.fan_in = processes.FanIn(self.frontend, ('127.0.0.1', 5000))
+        self.fan_in.bind()
+        self.thread = threading.Thread(target=self.fan_in.run)
+        self.thread.start()
+        self.context = zmq.Context()
+
+    def test_forwards_messages(self):
+        receiver = self.context.socket(zmq.PULL)
+        receiver.connect('tcp://127.0.0.1:5000')
+
+        for index in range(2):
+            worker = self.context.socket(zmq.PUSH)
+            worker.connect(self.frontend)
+            worker.send_multipart(['head', str(index)])
+            worker.close(linger=1000)
+
+        self.assertTrue(receiver.poll(5000))
+        received = sorted(receiver.recv_multipart() for _ in range(2))
+        self.assertEqual([['head', '0'], ['head', '1']], received)
+        receiver.close()
+
+    def tearDown(self):
+        self.fan_in.close()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.context.term()
+        shutil.rmtree(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+import unittest
+
+import simplejson
+
+from portal import serializers
+from portal.input.syslog.usyslog import (
+    HeadCache, Parser, SyslogMessageHandler
+)
+
+
+MESSAGE = (
+    b'<46>1 2003-10-11T22:14:15.003+01:00 tohru rsyslogd 12662 ID47 '
+    b'[origin software="rsyslogd" swVersion="7.2.5"][meta x="\xc3\xa9"] '
+    b'start \xff\n')
+
+
+class MessageCatcher(SyslogMessageHandler):
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.records = list()
+        self.msg_head = None
+
+    def on_msg_head(self, msg_head):
+        self.msg_head = msg_head
+
+    def on_msg_body(self, msg_body, msg_length):
+        self.records.append(
+            self.serializer.dumps(self.msg_head, msg_body, msg_length))
+
+
+def serialize(serializer, message=MESSAGE, **parser_options):
+    catcher = MessageCatcher(serializer)
+    Parser(catcher, **parser_options).read(message)
+    return catcher.records[0]
+
+
+class WhenUsingBinarySerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = serializers.BinarySerializer()
+
+    def test_round_trip(self):
+        syslog_msg = self.serializer.loads(serialize(self.serializer))
+
+        self.assertEqual('46', syslog_msg['priority'])
+        self.assertEqual('1', syslog_msg['version'])
+        self.assertEqual(
+            b'2003-10-11T22:14:15.003+01:00', syslog_msg['timestamp'])
+        self.assertEqual(b'tohru', syslog_msg['hostname'])
+        self.assertEqual(b'rsyslogd', syslog_msg['appname'])
+        self.assertEqual(b'12662', syslog_msg['processid'])
+        self.assertEqual(b'ID47', syslog_msg['messageid'])
+        self.assertEqual(
+            {b'origin': {b'software': b'rsyslogd', b'swVersion': b'7.2.5'},
+             b'meta': {b'x': b'\xc3\xa9'}},
+            syslog_msg['sd'])
+        self.assertEqual(b'start \xff\n', syslog_msg['message'])
+        self.assertEqual(len(MESSAGE), syslog_msg['msg_length'])
+        self.assertNotIn('timestamp_seconds', syslog_msg)
+
+    def test_keys_match_json(self):
+        json_msg = simplejson.loads(serialize(
+            serializers.JsonSerializer(), MESSAGE.replace(b'\xff', b'')))
+        binary_msg = self.serializer.loads(serialize(self.serializer))
+
+        self.assertEqual(sorted(json_msg), sorted(binary_msg))
+
+    def test_missing_values(self):
+        syslog_msg = self.serializer.loads(serialize(
+            self.serializer, b'<46>1 - - - - - - start\n',
+            fields=('hostname',)))
+
+        self.assertEqual('46', syslog_msg['priority'])
+        self.assertEqual(b'', syslog_msg['timestamp'])
+        self.assertEqual({}, syslog_msg['sd'])
+
+    def test_decoded_timestamp(self):
+        syslog_msg = self.serializer.loads(
+            serialize(self.serializer, decode_timestamp=True))
+
+        self.assertEqual(1065906855, syslog_msg['timestamp_seconds'])
+        self.assertEqual(3000, syslog_msg['timestamp_microseconds'])
+        self.assertEqual(60, syslog_msg['timestamp_offset'])
+        self.assertEqual(b'start \xff\n', syslog_msg['message'])
+
+    def test_head_and_message_apart(self):
+        catcher = MessageCatcher(self.serializer)
+        Parser(catcher, decode_timestamp=True).read(MESSAGE)
+        head = self.serializer.dumps_head(
+            catcher.msg_head, len(b'start \xff\n'), len(MESSAGE))
+
+        self.assertEqual(
+            self.serializer.loads(catcher.records[0]),
+            self.serializer.loads(head, memoryview(b'start \xff\n')))
+
+        with self.assertRaises(serializers.SerializationError):
+            self.serializer.loads(head, b'start')
+
+    def test_loads_buffer(self):
+        record = serialize(self.serializer)
+        self.assertEqual(
+            self.serializer.loads(record),
+            self.serializer.loads(memoryview(record)))
+
+    def test_malformed_records(self):
+        record = serialize(self.serializer)
+
+        with self.assertRaises(serializers.SerializationError):
+            self.serializer.loads(record[:10])
+
+        with self.assertRaises(serializers.SerializationError):
+            self.serializer.loads(record[:-1])
+
+        with self.assertRaises(serializers.SerializationError):
+            self.serializer.loads(record + b'x')
+
+        with self.assertRaises(serializers.SerializationError):
+            self.serializer.loads(b'\x02' + record[1:])
+
+
+class WhenUsingJsonSerializer(unittest.TestCase):
+
+    def test_invalid_utf8_is_rejected(self):
+        with self.assertRaises(UnicodeDecodeError):
+            serialize(serializers.JsonSerializer())
+
+    def test_head_and_message_apart(self):
+        serializer = serializers.JsonSerializer()
+        message = MESSAGE.replace(b'\xff', b'')
+        catcher = MessageCatcher(serializer)
+        Parser(catcher).read(message)
+        head = serializer.dumps_head(catcher.msg_head, 7, len(message))
+
+        self.assertNotIn('message', serializer.loads(head))
+        self.assertEqual(
+            serializer.loads(catcher.records[0]),
+            serializer.loads(head, b'start \n'))
+
+    def test_round_trip(self):
+        serializer = serializers.JsonSerializer()
+        syslog_msg = serializer.loads(
+            serialize(serializer, MESSAGE.replace(b'\xff', b'')))
+
+        self.assertEqual(u'start \n', syslog_msg['message'])
+        self.assertEqual(u'\xe9', syslog_msg['sd']['meta']['x'])
+
+
+class WhenLoadingManyRecords(unittest.TestCase):
+
+    def records(self, serializer):
+        catcher = MessageCatcher(serializer)
+        Parser(catcher).read(
+            MESSAGE.replace(b'\xff', b'1') + MESSAGE.replace(b'\xff', b'2'))
+        return catcher.records
+
+    def test_loads_many(self):
+        for serializer in (serializers.JsonSerializer(),
+                           serializers.BinarySerializer()):
+            records = self.records(serializer)
+            self.assertEqual(
+                [serializer.loads(record) for record in records],
+                serializer.loads_many(records))
+            self.assertEqual([], serializer.loads_many([]))
+
+    def test_loads_many_with_messages(self):
+        for serializer in (serializers.JsonSerializer(),
+                           serializers.BinarySerializer()):
+            catcher = MessageCatcher(serializer)
+            Parser(catcher).read(MESSAGE.replace(b'\xff', b''))
+            heads = [
+                serializer.dumps_head(catcher.msg_head, 4, length)
+                for length in (10, 20)]
+            self.assertEqual(
+                [serializer.loads(head, b'body') for head in heads],
+                serializer.loads_many(heads, [b'body', b'body']))
+
+    def test_json_records_must_be_objects(self):
+        serializer = serializers.JsonSerializer()
+        records = self.records(serializer)
+
+        with self.assertRaises(ValueError):
+            serializer.loads_many([records[0] + b',' + records[1]])
+
+        with self.assertRaises(ValueError):
+            serializer.loads_many([records[0], b'{'])
+
+
+class WhenSerializingCachedHeads(unittest.TestCase):
+
+    def serialize_cached(self, serializer, message, **parser_options):
+        catcher = MessageCatcher(serializer)
+        parser = Parser(catcher, head_cache=HeadCache(), **parser_options)
+
+        parser.read(message)
+        parser.read(message.replace(b'22:14:15', b'22:14:16'))
+        self.assertIn(serializer.name, catcher.msg_head.fragments)
+        return catcher.records
+
+    def assert_matches_uncached(self, serializer, message, **parser_options):
+        first, second = self.serialize_cached(
+            serializer, message, **parser_options)
+
+        self.assertEqual(
+            serializer.loads(serialize(serializer, message, **parser_options)),
+            serializer.loads(first))
+
+        expected = serializer.loads(first)
+        expected['timestamp'] = expected['timestamp'].replace(
+            '22:14:15', '22:14:16')
+        if 'timestamp_seconds' in expected:
+            expected['timestamp_seconds'] += 1
+        self.assertEqual(expected, serializer.loads(second))
+
+    def test_binary(self):
+        self.assert_matches_uncached(
+            serializers.BinarySerializer(), MESSAGE)
+        self.assert_matches_uncached(
+            serializers.BinarySerializer(), MESSAGE, decode_timestamp=True)
+
+    def test_json(self):
+        message = MESSAGE.replace(b'\xff', b'')
+
+        self.assert_matches_uncached(serializers.JsonSerializer(), message)
+        self.assert_matches_uncached(
+            serializers.JsonSerializer(), message, decode_timestamp=True)
+
+
+class WhenGettingSerializers(unittest.TestCase):
+
+    def test_get_serializer(self):
+        self.assertIsInstance(
+            serializers.get_serializer('json'), serializers.JsonSerializer)
+        self.assertIsInstance(
+            serializers.get_serializer('binary'),
+            serializers.BinarySerializer)
+
+        with self.assertRaises(ValueError):
+            serializers.get_serializer('xml')
+
+
+def serializer_performance(iterations=100000):
+    import time
+
+    for serializer in (serializers.JsonSerializer(),
+                       serializers.BinarySerializer()):
+        record = serialize(serializer, MESSAGE.replace(b'\xff', b''))
+        catcher = MessageCatcher(serializer)
+        parser = Parser(catcher)
+        data = MESSAGE.replace(b'\xff', b'') * 1000
+
+        then = time.time()
+        for _ in range(iterations // 1000):
+            parser.read(data)
+            del catcher.records[:]
+        encode_time = time.time() - then
+
+        then = time.time()
+        for _ in range(iterations):
+            serializer.loads(record)
+        decode_time = time.time() - then
+
+        print('{0}: {1} bytes, parse+dumps {2:.0f} msg/sec, '
+              'loads {3:.0f} msg/sec'.format(
+                  serializer.name, len(record), iterations / encode_time,
+                  iterations / decode_time))
+
+
+if __name__ == '__main__':
+    unittest.main()
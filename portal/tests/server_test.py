@@ -0,0 +1,272 @@
+import os
+import select
+import socket
+import unittest
+
+from mock import MagicMock, patch
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_sockets
+
+from portal import server
+from portal.tests.input.syslog.syslog_test import DatagramCollector
+
+
+class WhenTestingTornadoConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = MagicMock()
+        self.stream = MagicMock()
+        self.stream.read_chunk_size = 4096
+        self.close_callback = MagicMock()
+
+    def connect(self, paused=False):
+        return server.TornadoConnection(
+            self.reader, self.stream, ('127.0.0.1', 5140),
+            self.close_callback, paused=paused)
+
+    def test_reads_in_chunks(self):
+        connection = self.connect()
+        self.stream.read_bytes.assert_called_once_with(
+            4096, callback=connection._on_stream, partial=True)
+
+        connection._on_stream('data')
+        self.reader.read.assert_called_once_with('data')
+        self.assertEqual(2, self.stream.read_bytes.call_count)
+
+    def test_pause(self):
+        connection = self.connect()
+        connection.pause()
+
+        # The read in flight finishes but no other is started
+        connection._on_stream('data')
+        self.reader.read.assert_called_once_with('data')
+        self.assertEqual(1, self.stream.read_bytes.call_count)
+
+        connection.resume()
+        self.assertEqual(2, self.stream.read_bytes.call_count)
+
+    def test_resume_with_read_in_flight(self):
+        connection = self.connect()
+        connection.pause()
+        connection.resume()
+        self.assertEqual(1, self.stream.read_bytes.call_count)
+
+    def test_starts_paused(self):
+        connection = self.connect(paused=True)
+        self.assertFalse(self.stream.read_bytes.called)
+
+        connection.resume()
+        self.assertEqual(1, self.stream.read_bytes.call_count)
+
+    def test_closed_stream(self):
+        self.stream.read_bytes.side_effect = StreamClosedError()
+        connection = self.connect()
+        self.assertFalse(connection._reading)
+
+        connection._on_close()
+        self.close_callback.assert_called_once_with(self.reader)
+        self.assertIsNone(connection.reader)
+
+        connection.resume()
+        self.assertEqual(1, self.stream.read_bytes.call_count)
+
+
+class WhenTestingSyslogServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = server.SyslogServer(('127.0.0.1', 5140), MagicMock())
+        self.stream = MagicMock()
+        self.stream.read_chunk_size = 4096
+
+    def test_pause_and_resume_reading(self):
+        self.server.handle_stream(self.stream, ('127.0.0.1', 5141))
+        connection = self.server.connections.values()[0]
+
+        with patch('portal.server.time.time', return_value=10.0):
+            self.server.pause_reading()
+            self.server.pause_reading()
+        self.assertTrue(self.server.paused)
+        self.assertTrue(connection.paused)
+        self.assertEqual(1, self.server.pauses)
+
+        # Connections accepted while paused start paused
+        self.server.handle_stream(MagicMock(), ('127.0.0.1', 5142))
+        self.assertTrue(
+            all(c.paused for c in self.server.connections.values()))
+
+        with patch('portal.server.time.time', return_value=12.5):
+            self.assertEqual(2.5, self.server.paused_time)
+            self.server.resume_reading()
+        self.assertFalse(self.server.paused)
+        self.assertFalse(connection.paused)
+        self.assertEqual(2.5, self.server.paused_time)
+
+    def test_closed_connections_are_released(self):
+        self.server.handle_stream(self.stream, ('127.0.0.1', 5141))
+        connection = self.server.connections.values()[0]
+        reader = connection.reader
+
+        connection._on_close()
+        self.assertEqual(dict(), self.server.connections)
+        self.assertIs(reader, self.server.parser_pool.acquire())
+
+
+class WhenListening(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.servers = list()
+
+    def listen(self, **kwargs):
+        syslog_server = server.SyslogServer(
+            ('127.0.0.1', 5140), MagicMock(), **kwargs)
+        self.servers.append(syslog_server)
+        return syslog_server
+
+    def test_reuse_port(self):
+        self.listen(reuse_port=True).start()
+        self.listen(reuse_port=True).start()
+
+        with self.assertRaises(socket.error):
+            self.listen().start()
+
+    def test_shared_sockets(self):
+        sockets = bind_sockets(5140, '127.0.0.1')
+        syslog_server = self.listen()
+        syslog_server.start(sockets)
+
+        client = socket.create_connection(('127.0.0.1', 5140))
+        self.addCleanup(client.close)
+        self.io_loop.call_later(0.05, self.io_loop.stop)
+        self.io_loop.start()
+        self.assertEqual(1, len(syslog_server.connections))
+
+    def tearDown(self):
+        for syslog_server in self.servers:
+            syslog_server.stop()
+
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+
+class WhenIntegrationTestingPausedConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.client, peer = socket.socketpair()
+        self.client.setblocking(False)
+        self.stream = IOStream(peer, io_loop=self.io_loop)
+        self.reader = MagicMock()
+        self.received = bytearray()
+        self.reader.read.side_effect = self.received.extend
+        self.connection = server.TornadoConnection(
+            self.reader, self.stream, None, paused=True)
+
+    def run_loop(self):
+        self.io_loop.call_later(0.01, self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_paused_connection_pushes_back(self):
+        data = b'x' * self.stream.read_chunk_size
+        sent = 0
+
+        # Write until the socket pushes back on the client
+        for _ in range(1000):
+            try:
+                sent += self.client.send(data)
+            except socket.error:
+                break
+            self.run_loop()
+        else:
+            self.fail('The paused connection never pushed back')
+
+        self.assertEqual(0, len(self.received))
+        self.assertLessEqual(
+            self.stream._read_buffer_size, self.stream.read_chunk_size)
+
+        self.connection.resume()
+        for _ in range(1000):
+            if len(self.received) == sent:
+                break
+            self.run_loop()
+        self.assertEqual(sent, len(self.received))
+
+    def tearDown(self):
+        self.client.close()
+        self.stream.close()
+        self.io_loop.close(all_fds=True)
+
+
+class WhenReceivingDatagrams(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.collector = DatagramCollector()
+        self.server = server.SyslogUdpServer(
+            ('127.0.0.1', 5514), self.collector, rcvbuf=262144,
+            batch_size=2, io_loop=self.io_loop)
+        self.server.start()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, *datagrams):
+        for datagram in datagrams:
+            self.client.sendto(datagram, ('127.0.0.1', 5514))
+
+    def run_loop(self):
+        self.io_loop.call_later(0.05, self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_one_message_per_datagram(self):
+        self.send(b'<46>1 - host-1 - - - - first',
+                  b'not syslog',
+                  b'<46>1 - host-2 - - - - second\n')
+        self.run_loop()
+
+        self.assertEqual(
+            [(b'host-1', b'first', 28), (b'host-2', b'second\n', 30)],
+            self.collector.messages)
+        self.assertEqual(3, self.server.received)
+        self.assertEqual(1, self.server.errors)
+
+    def test_reads_in_batches(self):
+        self.send(*[b'<46>1 - host - - - - {0}'.format(i) for i in range(5)])
+        select.select([self.server.socket], [], [], 5)
+
+        self.server._on_readable()
+        self.assertEqual(2, len(self.collector.messages))
+
+        self.run_loop()
+        self.assertEqual(5, len(self.collector.messages))
+
+    def test_pause_and_resume_reading(self):
+        self.server.pause_reading()
+        self.send(b'<46>1 - host - - - - held')
+        self.run_loop()
+        self.assertEqual([], self.collector.messages)
+        self.assertEqual(1, self.server.pauses)
+
+        self.server.resume_reading()
+        self.run_loop()
+        self.assertEqual(1, len(self.collector.messages))
+
+    def test_receive_buffer(self):
+        self.assertGreaterEqual(
+            self.server.socket.getsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF),
+            262144)
+
+    def test_kernel_drops(self):
+        drops = self.server.kernel_drops
+
+        if os.path.exists('/proc/net/udp'):
+            self.assertEqual(0, drops)
+
+        self.server.stop()
+        self.assertIsNone(self.server.kernel_drops)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.io_loop.close()
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from portal import spool
+
+
+class WhenUsingSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = spool.Spool(
+            self.directory, segment_size=72, max_segments=2)
+
+    def segment_files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_replays_in_order(self):
+        self.assertIsNone(self.spool.peek())
+
+        self.assertTrue(self.spool.append(['head', 'body']))
+        self.assertTrue(self.spool.append([bytearray('1'), memoryview('2')]))
+        self.assertEqual(2, len(self.spool))
+
+        self.assertEqual(['head', 'body'], self.spool.peek())
+        self.assertEqual(['head', 'body'], self.spool.peek())
+        self.spool.pop()
+        self.assertEqual(['1', '2'], self.spool.peek())
+        self.spool.pop()
+
+        self.assertIsNone(self.spool.peek())
+        self.assertEqual(0, self.spool.depth)
+        self.assertEqual(2, self.spool.replayed)
+
+    def test_bounded_size(self):
+        # Each record takes 9 + 4 + 20 bytes so two fit in a segment
+        for _ in range(4):
+            self.assertTrue(self.spool.append(['x' * 20]))
+        self.assertEqual(2, len(self.segment_files()))
+
+        self.assertFalse(self.spool.append(['x' * 20]))
+        self.assertFalse(self.spool.append(['x' * 100]))
+        self.assertEqual(4, self.spool.depth)
+        self.assertEqual(2, self.spool.refused)
+
+    def test_replayed_segments_are_removed(self):
+        for msg in ('1' * 20, '2' * 20, '3' * 20):
+            self.spool.append([msg])
+
+        self.spool.pop()
+        self.spool.pop()
+        self.assertEqual(['3' * 20], self.spool.peek())
+        self.assertEqual(1, len(self.segment_files()))
+
+        # Room for two more now that a segment was freed
+        self.assertTrue(self.spool.append(['4']))
+        self.assertTrue(self.spool.append(['5' * 20]))
+        self.assertTrue(self.spool.append(['6' * 20]))
+        self.assertFalse(self.spool.append(['7' * 20]))
+
+        self.spool.pop()
+        self.spool.pop()
+        self.spool.pop()
+        self.spool.pop()
+        self.assertEqual([], self.segment_files())
+
+    def test_recovers_unsent_messages(self):
+        for msg in ('1', '2', '3'):
+            self.spool.append([msg, 'body'])
+        self.spool.pop()
+        self.spool.close()
+
+        recovered = spool.Spool(
+            self.directory, segment_size=72, max_segments=2)
+        self.assertEqual(2, recovered.depth)
+        self.assertEqual(['2', 'body'], recovered.peek())
+        recovered.pop()
+
+        self.assertTrue(recovered.append(['4']))
+        self.assertEqual(['3', 'body'], recovered.peek())
+        recovered.pop()
+        self.assertEqual(['4'], recovered.peek())
+        recovered.close()
+
+    def test_corrupt_record(self):
+        self.spool.append(['1'])
+        self.spool.close()
+
+        path = os.path.join(self.directory, self.segment_files()[0])
+        with open(path, 'r+b') as segment:
+            segment.write('\xff\xff')
+
+        with self.assertRaises(spool.SpoolError):
+            spool.Spool(self.directory, segment_size=72)
+
+    def test_many_frames(self):
+        many = spool.Spool(
+            os.path.join(self.directory, 'many'), segment_size=1 << 20)
+        frames = ['x'] * 70000
+
+        self.assertTrue(many.append(frames))
+        many.close()
+
+        many = spool.Spool(
+            os.path.join(self.directory, 'many'), segment_size=1 << 20)
+        self.assertEqual(frames, many.peek())
+        many.close()
+
+    def test_stats(self):
+        self.spool.append(['1'])
+        self.spool.append(['2'])
+        self.spool.pop()
+
+        stats = self.spool.stats()
+        self.assertEqual(1, stats['depth'])
+        self.assertEqual(1, stats['segments'])
+        self.assertEqual(2, stats['spooled'])
+        self.assertEqual(1, stats['replayed'])
+        self.assertEqual(0, stats['refused'])
+
+    def test_limits(self):
+        with self.assertRaises(ValueError):
+            spool.Spool(self.directory, segment_size=4)
+
+        with self.assertRaises(ValueError):
+            spool.Spool(self.directory, max_segments=0)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
@@ -1,9 +1,16 @@
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import simplejson
 from mock import MagicMock, patch
-from portal import transport
-from portal.input.syslog.usyslog import SyslogMessageHead
+from tornado.ioloop import IOLoop
+from portal import serializers, transport
+from portal.compression import FrameCompressor
+from portal.spool import Spool
+from portal.input.syslog.usyslog import SyslogMessageHead, Parser
 
 
 class WhenTestingSyslogToZeroMQHandler(unittest.TestCase):
@@ -58,6 +65,95 @@ class WhenTestingSyslogToZeroMQHandler(unittest.TestCase):
             simplejson.dumps(self.final_message))
         self.assertEqual(self.handler.msg, b'')
 
+    def test_on_msg_body(self):
+        self.handler.on_msg_head(self.msg_head)
+        self.handler.on_msg_body(
+            memoryview(self.test_message), self.msg_length)
+        self.caster.cast.assert_called_once_with(
+            simplejson.dumps(self.final_message))
+        self.assertEqual(self.handler.msg, b'')
+
+    def test_zero_copy_on_msg_body(self):
+        handler = transport.SyslogToZeroMQHandler(
+            self.caster, zero_copy=True)
+        msg_body = memoryview(self.test_message)
+
+        handler.on_msg_head(self.msg_head)
+        handler.on_msg_body(msg_body, self.msg_length)
+
+        head, body = self.caster.cast.call_args[0]
+        self.assertIs(msg_body, body)
+        self.assertEqual(
+            self.final_message,
+            handler.serializer.loads(head, body))
+
+    def test_zero_copy_copies_writable_bodies(self):
+        handler = transport.SyslogToZeroMQHandler(
+            self.caster, zero_copy=True)
+
+        handler.on_msg_head(self.msg_head)
+        handler.on_msg_body(
+            memoryview(bytearray(self.test_message)), self.msg_length)
+
+        head, body = self.caster.cast.call_args[0]
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(self.test_message, body)
+
+    def test_zero_copy_on_msg_complete(self):
+        handler = transport.SyslogToZeroMQHandler(
+            self.caster, zero_copy=True)
+        msg = handler.msg
+
+        handler.on_msg_head(self.msg_head)
+        handler.on_msg_part(self.msg_part_1)
+        handler.on_msg_part(self.msg_part_2)
+        handler.on_msg_part(self.msg_part_3)
+        handler.on_msg_complete(self.msg_length)
+
+        head, body = self.caster.cast.call_args[0]
+        self.assertIs(msg, body)
+        self.assertEqual(bytearray(self.test_message), body)
+        self.assertEqual(b'', handler.msg)
+        self.assertIsNot(msg, handler.msg)
+
+    def test_decoded_timestamp_is_sent(self):
+        parser = Parser(self.handler, decode_timestamp=True)
+        parser.read(b'<46>1 2003-10-11T22:14:15.003+01:00 tohru - - - - '
+                    b'start\n')
+
+        syslog_msg = simplejson.loads(self.caster.cast.call_args[0][0])
+        self.assertEqual(1065906855, syslog_msg['timestamp_seconds'])
+        self.assertEqual(3000, syslog_msg['timestamp_microseconds'])
+        self.assertEqual(60, syslog_msg['timestamp_offset'])
+        self.assertEqual('start\n', syslog_msg['message'])
+
+    def test_pipelined_handler_submits_unserialized(self):
+        pipeline = MagicMock(spec=transport.SendPipeline)
+        pipeline.serializer = serializers.BinarySerializer()
+        pipeline.zero_copy = True
+        handler = transport.SyslogToZeroMQHandler(pipeline)
+        msg = handler.msg
+
+        self.assertIs(pipeline.serializer, handler.serializer)
+        self.assertTrue(handler.zero_copy)
+        pipeline.bind.assert_called_once_with()
+
+        handler.on_msg_head(self.msg_head)
+        handler.on_msg_part(self.test_message)
+        handler.on_msg_complete(self.msg_length)
+
+        msg_head, body, length = pipeline.submit.call_args[0]
+        self.assertIsNot(self.msg_head, msg_head)
+        self.assertEqual(self.msg_head.as_dict(), msg_head.as_dict())
+        self.assertIs(msg, body)
+        self.assertEqual(self.msg_length, length)
+        self.assertIsNot(msg, handler.msg)
+
+        handler.on_msg_body(
+            memoryview(bytearray(self.test_message)), self.msg_length)
+        body = pipeline.submit.call_args[0][1]
+        self.assertIsInstance(body, bytes)
+
 
 class WhenTestingZeroMqCaster(unittest.TestCase):
 
@@ -103,12 +199,146 @@ class WhenTestingZeroMqCaster(unittest.TestCase):
         with patch('portal.transport.zmq', self.zmq_mock):
             self.caster.bind()
         self.caster.cast(self.msg)
-        self.socket_mock.send.assert_called_once_with(self.msg)
+        self.socket_mock.send.assert_called_once_with(
+            self.msg, transport.zmq.NOBLOCK)
 
         self.caster.close()
         with self.assertRaises(transport.zmq.error.ZMQError):
             self.caster.cast(self.msg)
 
+    def test_connect(self):
+        caster = transport.ZeroMQCaster(
+            'ipc:///tmp/portal.sock', connect=True, io_threads=2)
+        self.assertEqual('ipc:///tmp/portal.sock', caster.bind_host)
+
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        self.zmq_mock.Context.assert_called_once_with(2)
+        self.socket_mock.connect.assert_called_once_with(
+            'ipc:///tmp/portal.sock')
+        self.assertFalse(self.socket_mock.bind.called)
+        self.assertTrue(caster.bound)
+
+    def test_cast_with_body(self):
+        with patch('portal.transport.zmq', self.zmq_mock):
+            self.caster.bind()
+        self.caster.cast(self.msg, 'body')
+        self.socket_mock.send_multipart.assert_called_once_with(
+            (self.msg, 'body'), transport.zmq.NOBLOCK, copy=False)
+
+    def test_cast_batch_with_bodies(self):
+        caster = transport.ZeroMQCaster(self.bind_host_tuple, batch_size=2)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        caster.cast('1', 'a')
+        caster.cast('2', 'b')
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['1', 'a', '2', 'b'], transport.zmq.NOBLOCK, copy=False)
+
+    def test_copy_threshold(self):
+        caster = transport.ZeroMQCaster(
+            self.bind_host_tuple, copy_threshold=1024)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+        self.assertEqual(1024, self.socket_mock.copy_threshold)
+
+    def test_sndhwm(self):
+        caster = transport.ZeroMQCaster(self.bind_host_tuple, sndhwm=10)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+        self.socket_mock.setsockopt.assert_called_once_with(
+            self.zmq_mock.SNDHWM, 10)
+
+    def test_cast_holds_messages_while_full(self):
+        io_loop = MagicMock()
+        on_full = MagicMock()
+        on_drain = MagicMock()
+        caster = transport.ZeroMQCaster(self.bind_host_tuple, io_loop=io_loop)
+        caster.set_full_callback(on_full)
+        caster.set_drain_callback(on_drain)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        options = {transport.zmq.FD: 7, transport.zmq.EVENTS: 0}
+        self.socket_mock.getsockopt.side_effect = options.get
+        self.socket_mock.send.side_effect = transport.zmq.Again()
+        caster.cast('1')
+        caster.cast('2', 'b')
+        self.assertTrue(caster.full)
+        self.assertEqual(1, self.socket_mock.send.call_count)
+        self.assertFalse(self.socket_mock.send_multipart.called)
+        on_full.assert_called_once_with()
+        io_loop.add_handler.assert_called_once_with(
+            7, caster._on_socket_events, transport.IOLoop.READ)
+
+        # Still full
+        caster._on_socket_events()
+        self.assertTrue(caster.full)
+        self.assertFalse(on_drain.called)
+
+        options[transport.zmq.EVENTS] = transport.zmq.POLLOUT
+        caster._on_socket_events(7, transport.IOLoop.READ)
+        self.assertFalse(caster.full)
+        sent = [
+            args for args, _ in self.socket_mock.send_multipart.call_args_list]
+        self.assertEqual(
+            [(('1',), transport.zmq.NOBLOCK),
+             (('2', 'b'), transport.zmq.NOBLOCK)],
+            sent)
+        on_drain.assert_called_once_with()
+        io_loop.remove_handler.assert_called_once_with(7)
+
+    def test_cast_spools_while_full(self):
+        io_loop = MagicMock()
+        on_full = MagicMock()
+        spool = MagicMock()
+        spool.depth = 0
+        caster = transport.ZeroMQCaster(
+            self.bind_host_tuple, io_loop=io_loop, spool=spool)
+        caster.set_full_callback(on_full)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        self.socket_mock.send.side_effect = transport.zmq.Again()
+        caster.cast('1')
+        spool.append.assert_called_once_with(('1',))
+        self.assertFalse(caster.full)
+        self.assertTrue(io_loop.add_handler.called)
+
+        # Later messages follow the spooled ones
+        spool.depth = 1
+        caster.cast('2')
+        self.assertEqual(1, self.socket_mock.send.call_count)
+        self.assertEqual(2, spool.append.call_count)
+
+        # Messages are held once the spool is full
+        spool.append.return_value = False
+        caster.cast('3')
+        caster.cast('4')
+        self.assertEqual(3, spool.append.call_count)
+        self.assertTrue(caster.full)
+        on_full.assert_called_once_with()
+
+        caster.close()
+        spool.close.assert_called_once_with()
+
+    def test_cast_compressed(self):
+        compressor = FrameCompressor()
+        caster = transport.ZeroMQCaster(
+            self.bind_host_tuple, batch_size=2, compressor=compressor)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        caster.cast('1', 'a')
+        caster.cast('2', 'b')
+        self.assertFalse(self.socket_mock.send_multipart.called)
+        frame, flags = self.socket_mock.send.call_args[0]
+        self.assertEqual(transport.zmq.NOBLOCK, flags)
+        self.assertEqual(
+            ['1', 'a', '2', 'b'], compressor.decompress(frame))
+
     def test_close(self):
         with patch('portal.transport.zmq', self.zmq_mock):
             self.caster.bind()
@@ -119,6 +349,284 @@ class WhenTestingZeroMqCaster(unittest.TestCase):
         self.assertIsNone(self.caster.socket)
         self.assertFalse(self.caster.bound)
 
+    def test_cast_batch_by_size(self):
+        caster = transport.ZeroMQCaster(self.bind_host_tuple, batch_size=3)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        caster.cast('1')
+        caster.cast('2')
+        self.assertFalse(self.socket_mock.send_multipart.called)
+
+        caster.cast('3')
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['1', '2', '3'], transport.zmq.NOBLOCK)
+        self.assertFalse(self.socket_mock.send.called)
+
+    def test_cast_batch_by_bytes(self):
+        caster = transport.ZeroMQCaster(
+            self.bind_host_tuple, batch_size=100, batch_bytes=10)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        caster.cast('12345')
+        caster.cast('67890')
+        caster.cast('1')
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['12345', '67890'], transport.zmq.NOBLOCK)
+
+    def test_cast_batch_by_interval(self):
+        io_loop = MagicMock()
+        caster = transport.ZeroMQCaster(
+            self.bind_host_tuple, batch_size=100, batch_interval=50,
+            io_loop=io_loop)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        caster.cast('1')
+        caster.cast('2')
+        io_loop.call_later.assert_called_once_with(
+            0.05, caster._on_flush_timeout)
+
+        caster._on_flush_timeout()
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['1', '2'], transport.zmq.NOBLOCK)
+
+        caster.cast('3')
+        self.assertEqual(2, io_loop.call_later.call_count)
+
+    def test_close_sends_batch(self):
+        io_loop = MagicMock()
+        caster = transport.ZeroMQCaster(
+            self.bind_host_tuple, batch_size=100, batch_interval=50,
+            io_loop=io_loop)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        caster.cast('1')
+        caster.close()
+        self.socket_mock.send.assert_called_once_with(
+            '1', transport.zmq.NOBLOCK)
+        io_loop.remove_timeout.assert_called_once_with(
+            io_loop.call_later.return_value)
+
+
+def mock_caster(port):
+    caster = MagicMock()
+    caster.bind_host = 'tcp://127.0.0.1:{0}'.format(port)
+    caster.bound = False
+    caster.full = False
+    return caster
+
+
+class WhenTestingShardedCaster(unittest.TestCase):
+
+    def setUp(self):
+        self.casters = [mock_caster(port) for port in range(5000, 5004)]
+        self.caster = transport.ShardedCaster(self.casters)
+        self.keys = ['host-{0}'.format(i) for i in range(2000)]
+
+    def routes(self, caster):
+        return dict((key, caster.caster_for(key)) for key in self.keys)
+
+    def test_routes_by_key(self):
+        self.caster.bind()
+        for caster in self.casters:
+            caster.bind.assert_called_once_with()
+
+        self.caster.cast('msg', key='host-1')
+        self.caster.cast('msg2', 'body', key='host-1')
+        target = self.caster.caster_for('host-1')
+        self.assertEqual(2, target.cast.call_count)
+        target.cast.assert_called_with('msg2', 'body')
+
+        # Keys are spread across every caster
+        spread = dict()
+        for caster in self.routes(self.caster).itervalues():
+            spread[caster.bind_host] = spread.get(caster.bind_host, 0) + 1
+        self.assertEqual(4, len(spread))
+        self.assertTrue(all(count > 300 for count in spread.values()))
+
+    def test_adding_a_caster_moves_few_keys(self):
+        before = self.routes(self.caster)
+        added = mock_caster(5004)
+        self.caster.add_caster(added)
+        after = self.routes(self.caster)
+
+        moved = [key for key in self.keys if before[key] is not after[key]]
+        self.assertTrue(all(after[key] is added for key in moved))
+        self.assertLess(len(moved), len(self.keys) * 0.3)
+
+    def test_removing_a_caster_moves_only_its_keys(self):
+        before = self.routes(self.caster)
+        removed = self.casters[1]
+        self.caster.remove_caster(removed)
+        after = self.routes(self.caster)
+
+        for key in self.keys:
+            if before[key] is not removed:
+                self.assertIs(before[key], after[key])
+            else:
+                self.assertIsNot(removed, after[key])
+        removed.close.assert_called_once_with()
+
+    def test_ring_does_not_depend_on_order(self):
+        reordered = transport.ShardedCaster(
+            [mock_caster(port) for port in range(5003, 4999, -1)])
+        self.assertEqual(
+            dict((key, c.bind_host)
+                 for key, c in self.routes(self.caster).iteritems()),
+            dict((key, c.bind_host)
+                 for key, c in self.routes(reordered).iteritems()))
+
+    def test_key_for(self):
+        msg_head = MagicMock()
+        msg_head.hostname = 'host'
+        msg_head.appname = 'app'
+        msg_head.sd = {'meniscus': {'tenant': '95101'}}
+        self.assertEqual('host', self.caster.key_for(msg_head))
+
+        caster = transport.ShardedCaster(self.casters, key='appname')
+        self.assertEqual('app', caster.key_for(msg_head))
+
+        caster = transport.ShardedCaster(
+            self.casters, key='sd:meniscus:tenant')
+        self.assertEqual('95101', caster.key_for(msg_head))
+
+        msg_head.sd = {'origin': {'ip': '127.0.0.1'}}
+        self.assertEqual('host', caster.key_for(msg_head))
+
+        with self.assertRaises(ValueError):
+            transport.ShardedCaster(self.casters, key='timestamp')
+
+        with self.assertRaises(ValueError):
+            transport.ShardedCaster(self.casters, key='sd:meniscus')
+
+    def test_full_and_drain(self):
+        on_full = MagicMock()
+        on_drain = MagicMock()
+        self.caster.set_full_callback(on_full)
+        self.caster.set_drain_callback(on_drain)
+
+        self.caster._on_caster_full()
+        self.caster._on_caster_full()
+        self.assertTrue(self.caster.full)
+        on_full.assert_called_once_with()
+
+        self.caster._on_caster_drain()
+        self.assertFalse(on_drain.called)
+        self.caster._on_caster_drain()
+        self.assertFalse(self.caster.full)
+        on_drain.assert_called_once_with()
+
+        for caster in self.casters:
+            caster.set_full_callback.assert_called_once_with(
+                self.caster._on_caster_full)
+
+    def test_handler_passes_keys(self):
+        self.caster.bind = MagicMock()
+        self.caster.cast = MagicMock()
+        self.caster.key_for = MagicMock(return_value='host')
+        handler = transport.SyslogToZeroMQHandler(self.caster)
+        msg_head = SyslogMessageHead()
+
+        handler.on_msg_head(msg_head)
+        handler.on_msg_body(memoryview('message'), 7)
+        self.caster.key_for.assert_called_once_with(msg_head)
+        self.assertEqual('host', self.caster.cast.call_args[1]['key'])
+
+
+class WhenTestingSendPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.caster = mock_caster(5000)
+        self.pipeline = transport.SendPipeline(
+            self.caster, max_pending=4, io_loop=self.io_loop)
+        self.msg_head = SyslogMessageHead()
+        self.on_full = MagicMock()
+        self.on_drain = MagicMock(side_effect=self.io_loop.stop)
+        self.pipeline.set_full_callback(self.on_full)
+        self.pipeline.set_drain_callback(self.on_drain)
+
+    def run_loop(self):
+        self.io_loop.call_later(5, self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_sends_in_order(self):
+        self.pipeline.bind()
+        self.caster.bind.assert_called_once_with()
+
+        for index in range(3):
+            self.pipeline.submit(self.msg_head, str(index), 1)
+        self.pipeline.close()
+
+        self.assertEqual(
+            ['0', '1', '2'],
+            [simplejson.loads(call[0][0])['message']
+             for call in self.caster.cast.call_args_list])
+        self.caster.close.assert_called_once_with()
+        self.assertFalse(self.pipeline.bound)
+
+        with self.assertRaises(transport.zmq.error.ZMQError):
+            self.pipeline.submit(self.msg_head, 'closed', 1)
+
+    def test_full_while_sender_is_busy(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def cast(msg, body=None):
+            sending.set()
+            release.wait(5)
+
+        self.caster.cast.side_effect = cast
+        self.pipeline.bind()
+
+        # The sender thread is stuck on the first message
+        self.pipeline.submit(self.msg_head, 'first', 1)
+        self.assertTrue(sending.wait(5))
+
+        for index in range(4):
+            self.pipeline.submit(self.msg_head, str(index), 1)
+        self.assertTrue(self.pipeline.full)
+        self.on_full.assert_called_once_with()
+
+        release.set()
+        self.run_loop()
+        self.on_drain.assert_called_once_with()
+        self.assertFalse(self.pipeline.full)
+
+        self.pipeline.close()
+        self.assertEqual(5, self.caster.cast.call_count)
+
+    def test_forwards_caster_full_and_drain(self):
+        self.pipeline.bind()
+        on_caster_full = self.caster.set_full_callback.call_args[0][0]
+        on_caster_drain = self.caster.set_drain_callback.call_args[0][0]
+
+        on_caster_full()
+        self.io_loop.add_callback(on_caster_drain)
+        self.run_loop()
+
+        self.on_full.assert_called_once_with()
+        self.on_drain.assert_called_once_with()
+        self.pipeline.close()
+
+    def test_bind_errors_are_raised(self):
+        self.caster.bind.side_effect = transport.zmq.error.ZMQError()
+
+        with self.assertRaises(transport.zmq.error.ZMQError):
+            self.pipeline.bind()
+        self.assertFalse(self.pipeline.bound)
+
+    def test_max_pending(self):
+        with self.assertRaises(ValueError):
+            transport.SendPipeline(self.caster, max_pending=0)
+
+    def tearDown(self):
+        self.pipeline.close()
+        self.io_loop.close()
+
 
 class WhenTestingZeroMqReceiver(unittest.TestCase):
 
@@ -173,6 +681,43 @@ class WhenTestingZeroMqReceiver(unittest.TestCase):
         with self.assertRaises(transport.zmq.error.ZMQError):
             self.receiver.get()
 
+    def test_get_batch(self):
+        with patch('portal.transport.zmq', self.zmq_mock):
+            self.receiver.connect()
+        self.socket_mock.recv_multipart.return_value = ['1', '2']
+        self.assertEqual(['1', '2'], self.receiver.get_batch())
+
+        self.receiver.close()
+        with self.assertRaises(transport.zmq.error.ZMQError):
+            self.receiver.get_batch()
+
+    def test_get_decoded(self):
+        with patch('portal.transport.zmq', self.zmq_mock):
+            self.receiver.connect()
+        self.socket_mock.recv.return_value = '{"a": 1}'
+        self.socket_mock.recv_multipart.return_value = ['{"b": 2}']
+
+        self.assertEqual({'a': 1}, self.receiver.get(decode=True))
+        self.assertEqual([{'b': 2}], self.receiver.get_batch(decode=True))
+
+    def test_get_zero_copy(self):
+        receiver = transport.ZeroMQReceiver(
+            self.connect_host_tuples, zero_copy=True)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            receiver.connect()
+
+        self.socket_mock.recv_multipart.return_value = ['{"a": 1}', 'x']
+        self.assertEqual(('{"a": 1}', 'x'), receiver.get())
+        self.assertEqual({'a': 1, 'message': 'x'}, receiver.get(decode=True))
+
+        self.socket_mock.recv_multipart.return_value = [
+            '{"a": 1}', 'x', '{"a": 2}', 'y']
+        self.assertEqual(
+            [('{"a": 1}', 'x'), ('{"a": 2}', 'y')], receiver.get_batch())
+        self.assertEqual(
+            [{'a': 1, 'message': 'x'}, {'a': 2, 'message': 'y'}],
+            receiver.get_batch(decode=True))
+
     def test_close(self):
         with patch('portal.transport.zmq', self.zmq_mock):
             self.receiver.connect()
@@ -200,11 +745,17 @@ class WhenIntegrationTestingTransport(unittest.TestCase):
         self.final_message['msg_length'] = self.msg_length
         self.final_message_json = simplejson.dumps(self.final_message)
 
+    def wait_for_receiver(self):
+        # Sends do not block so nothing may be cast before the receiver
+        # has connected
+        self.assertTrue(self.caster.socket.poll(5000, transport.zmq.POLLOUT))
+
     def test_message_transport_over_zmq(self):
         self.caster = transport.ZeroMQCaster(self.host_tuple)
         self.handler = transport.SyslogToZeroMQHandler(self.caster)
         self.receiver = transport.ZeroMQReceiver(self.connect_host_tuples)
         self.receiver.connect()
+        self.wait_for_receiver()
 
         self.handler.on_msg_head(self.msg_head)
         self.handler.on_msg_part(self.test_message)
@@ -213,10 +764,368 @@ class WhenIntegrationTestingTransport(unittest.TestCase):
         rcvd_msg = self.receiver.get()
         self.assertEqual(rcvd_msg, self.final_message_json)
 
+    def test_batched_transport_over_zmq(self):
+        self.caster = transport.ZeroMQCaster(self.host_tuple, batch_size=2)
+        self.handler = transport.SyslogToZeroMQHandler(self.caster)
+        self.receiver = transport.ZeroMQReceiver(self.connect_host_tuples)
+        self.receiver.connect()
+        self.wait_for_receiver()
+
+        for _ in range(2):
+            self.handler.on_msg_head(self.msg_head)
+            self.handler.on_msg_part(self.test_message)
+            self.handler.on_msg_complete(self.msg_length)
+
+        self.assertEqual(
+            [self.final_message_json] * 2,
+            self.receiver.get_batch())
+
+    def test_binary_transport_over_zmq(self):
+        serializer = serializers.BinarySerializer()
+        self.caster = transport.ZeroMQCaster(self.host_tuple, batch_size=2)
+        self.handler = transport.SyslogToZeroMQHandler(
+            self.caster, serializer=serializer)
+        self.receiver = transport.ZeroMQReceiver(
+            self.connect_host_tuples, serializer=serializer)
+        self.receiver.connect()
+        self.wait_for_receiver()
+
+        for _ in range(2):
+            self.handler.on_msg_head(self.msg_head)
+            self.handler.on_msg_part(self.test_message)
+            self.handler.on_msg_complete(self.msg_length)
+
+        self.assertEqual(
+            [self.final_message] * 2,
+            self.receiver.get_batch(decode=True))
+
+    def test_zero_copy_transport_over_zmq(self):
+        serializer = serializers.BinarySerializer()
+        self.caster = transport.ZeroMQCaster(
+            self.host_tuple, batch_size=2, copy_threshold=0)
+        self.handler = transport.SyslogToZeroMQHandler(
+            self.caster, serializer=serializer, zero_copy=True)
+        self.receiver = transport.ZeroMQReceiver(
+            self.connect_host_tuples, serializer=serializer, zero_copy=True)
+        self.receiver.connect()
+        self.wait_for_receiver()
+
+        self.handler.on_msg_head(self.msg_head)
+        self.handler.on_msg_body(
+            memoryview(self.test_message), self.msg_length)
+        self.handler.on_msg_head(self.msg_head)
+        self.handler.on_msg_part(self.test_message)
+        self.handler.on_msg_complete(self.msg_length)
+
+        self.assertEqual(
+            [self.final_message] * 2,
+            self.receiver.get_batch(decode=True))
+
+    def test_full_socket_drains_in_order(self):
+        io_loop = IOLoop()
+        drained = MagicMock(side_effect=io_loop.stop)
+        self.caster = transport.ZeroMQCaster(
+            self.host_tuple, io_loop=io_loop, sndhwm=1)
+        self.caster.set_drain_callback(drained)
+        self.caster.bind()
+
+        # Nothing is connected so the PUSH socket is full from the start
+        for msg in ('1', '2', '3'):
+            self.caster.cast(msg)
+        self.assertTrue(self.caster.full)
+
+        self.receiver = transport.ZeroMQReceiver(self.connect_host_tuples)
+        self.receiver.connect()
+        io_loop.call_later(5, io_loop.stop)
+        io_loop.start()
+        io_loop.close()
+
+        drained.assert_called_once_with()
+        self.assertFalse(self.caster.full)
+        self.assertEqual(
+            ['1', '2', '3'], [self.receiver.get() for _ in range(3)])
+
+    def test_spooled_transport_over_zmq(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        io_loop = IOLoop()
+        on_full = MagicMock()
+        self.caster = transport.ZeroMQCaster(
+            self.host_tuple, io_loop=io_loop, sndhwm=1,
+            spool=Spool(directory, segment_size=4096, max_segments=1))
+        self.caster.set_full_callback(on_full)
+        self.caster.bind()
+
+        # Nothing is connected so every message is spooled
+        msgs = [str(i) for i in range(100)]
+        for msg in msgs:
+            self.caster.cast(msg, 'body')
+        self.assertEqual(100, self.caster.spool.depth)
+        self.assertFalse(on_full.called)
+
+        self.receiver = transport.ZeroMQReceiver(
+            self.connect_host_tuples, zero_copy=True)
+        self.receiver.connect()
+
+        received = list()
+        for _ in range(500):
+            if len(received) == len(msgs):
+                break
+            io_loop.call_later(0.01, io_loop.stop)
+            io_loop.start()
+            while self.receiver.socket.poll(0):
+                received.append(self.receiver.get())
+        io_loop.close()
+
+        self.assertEqual([(msg, 'body') for msg in msgs], received)
+        self.assertEqual(0, self.caster.spool.depth)
+        self.assertEqual(100, self.caster.spool.replayed)
+
+    def test_sharded_transport_over_zmq(self):
+        ports = ('5000', '5001')
+        casters = [transport.ZeroMQCaster((self.host, port)) for port in ports]
+        self.caster = transport.ShardedCaster(casters)
+        self.handler = transport.SyslogToZeroMQHandler(self.caster)
+        receivers = [
+            transport.ZeroMQReceiver([(self.host, port)]) for port in ports]
+        self.receiver = receivers[0]
+        self.addCleanup(receivers[1].close)
+
+        for caster, receiver in zip(casters, receivers):
+            receiver.connect()
+            self.assertTrue(caster.socket.poll(5000, transport.zmq.POLLOUT))
+
+        parser = Parser(self.handler)
+        hosts = ['host-{0}'.format(i) for i in range(20)]
+        for host in hosts * 2:
+            parser.read('<1>1 - {0} - - - - message\n'.format(host))
+
+        for caster, receiver in zip(casters, receivers):
+            received = list()
+            while receiver.socket.poll(100):
+                received.append(receiver.get(decode=True)['hostname'])
+
+            expected = [
+                host for host in hosts * 2
+                if self.caster.caster_for(host) is caster]
+            self.assertTrue(expected)
+            self.assertEqual(expected, received)
+
+    def test_compressed_transport_over_zmq(self):
+        serializer = serializers.BinarySerializer()
+        compressor = FrameCompressor(
+            dictionary=self.final_message_json * 10)
+        self.caster = transport.ZeroMQCaster(
+            self.host_tuple, batch_size=2, compressor=compressor)
+        self.handler = transport.SyslogToZeroMQHandler(
+            self.caster, serializer=serializer, zero_copy=True)
+        self.receiver = transport.ZeroMQReceiver(
+            self.connect_host_tuples, serializer=serializer, zero_copy=True,
+            compressor=FrameCompressor(1, self.final_message_json * 10))
+        self.receiver.connect()
+        self.wait_for_receiver()
+
+        for _ in range(3):
+            self.handler.on_msg_head(self.msg_head)
+            self.handler.on_msg_body(
+                memoryview(self.test_message), self.msg_length)
+        self.caster.flush()
+
+        self.assertEqual(
+            [self.final_message] * 2,
+            self.receiver.get_batch(decode=True))
+        self.assertEqual(self.final_message, self.receiver.get(decode=True))
+
+    def test_pipelined_transport_over_zmq(self):
+        serializer = serializers.BinarySerializer()
+        self.caster = transport.SendPipeline(
+            transport.ZeroMQCaster(self.host_tuple, batch_size=2),
+            serializer=serializer)
+        parser = Parser(transport.SyslogToZeroMQHandler(self.caster))
+
+        # Casts before the receiver connects are held on the sender thread
+        for index in range(4):
+            parser.read(
+                b'<46>1 - host-{0} - - - - message {0}\n'.format(index))
+
+        self.receiver = transport.ZeroMQReceiver(
+            self.connect_host_tuples, serializer=serializer)
+        self.receiver.connect()
+        self.assertTrue(self.receiver.socket.poll(5000))
+
+        batches = [self.receiver.get_batch(decode=True) for _ in range(2)]
+        self.assertEqual(
+            ['host-0', 'host-1', 'host-2', 'host-3'],
+            [msg['hostname'] for batch in batches for msg in batch])
+        self.assertEqual(
+            'message 3\n', batches[1][1]['message'])
+
+    def cast_messages(self, count, **caster_options):
+        self.caster = transport.ZeroMQCaster(self.host_tuple, **caster_options)
+        self.handler = transport.SyslogToZeroMQHandler(self.caster)
+        self.receiver = transport.ZeroMQReceiver(self.connect_host_tuples)
+        self.receiver.connect()
+        self.wait_for_receiver()
+
+        for index in range(count):
+            self.handler.on_msg_head(self.msg_head)
+            self.handler.on_msg_part(str(index))
+            self.handler.on_msg_complete(self.msg_length)
+        self.caster.flush()
+
+        if count:
+            # Wait for every message to be queued on the receiving end
+            self.assertTrue(self.receiver.socket.poll(5000))
+            time.sleep(0.05)
+
+    def test_drain(self):
+        self.cast_messages(7, batch_size=3)
+
+        batch = self.receiver.drain(limit=4, decode=True)
+        self.assertEqual(['0', '1', '2', '3', '4', '5'],
+                         [msg['message'] for msg in batch])
+
+        batch = self.receiver.drain(decode=True)
+        self.assertEqual(['6'], [msg['message'] for msg in batch])
+        self.assertEqual([], self.receiver.drain(timeout=10))
+
+    def test_iter_batches(self):
+        self.cast_messages(5)
+
+        batches = self.receiver.iter_batches(limit=2, timeout=10)
+        self.assertEqual(2, len(next(batches)))
+        self.assertEqual(2, len(next(batches)))
+        self.assertEqual(1, len(next(batches)))
+        self.assertEqual([], next(batches))
+
+        self.receiver.close()
+        self.assertEqual([], list(batches))
+
+    def test_drain_async(self):
+        io_loop = IOLoop()
+        self.cast_messages(0)
+
+        # Nothing is queued yet so the future waits on the IOLoop
+        future = self.receiver.drain_async(decode=True, io_loop=io_loop)
+        self.assertFalse(future.done())
+        with self.assertRaises(transport.zmq.error.ZMQError):
+            self.receiver.drain_async()
+
+        io_loop.call_later(0.05, self.handler.on_msg_head, self.msg_head)
+        io_loop.call_later(0.05, self.handler.on_msg_part, 'async')
+        io_loop.call_later(
+            0.05, self.handler.on_msg_complete, self.msg_length)
+        records = io_loop.run_sync(lambda: future, timeout=5)
+        self.assertEqual(['async'], [msg['message'] for msg in records])
+
+        # A message already queued resolves at once
+        self.handler.on_msg_head(self.msg_head)
+        self.handler.on_msg_part('queued')
+        self.handler.on_msg_complete(self.msg_length)
+        self.assertTrue(self.receiver.socket.poll(5000))
+        future = self.receiver.drain_async(io_loop=io_loop)
+        self.assertTrue(future.done())
+        self.assertEqual(1, len(future.result()))
+
+        future = self.receiver.drain_async(io_loop=io_loop)
+        self.receiver.close()
+        with self.assertRaises(transport.zmq.error.ZMQError):
+            future.result()
+        io_loop.close()
+
     def tearDown(self):
         self.caster.close()
         self.receiver.close()
 
 
+def zero_copy_performance(sizes=(4096, 8192, 16384), batch_size=100,
+                          rounds=50, print_output=True):
+    import time
+
+    from portal.input.syslog import Parser
+
+    host_tuple = ('127.0.0.1', '5000')
+    setups = (
+        ('json', serializers.JsonSerializer(), False, None),
+        ('json zero_copy', serializers.JsonSerializer(), True, None),
+        ('binary', serializers.BinarySerializer(), False, None),
+        ('binary zero_copy', serializers.BinarySerializer(), True, None),
+        ('binary zero_copy copy_threshold=0',
+         serializers.BinarySerializer(), True, 0))
+
+    for size in sizes:
+        message = b'<46>1 - tohru rsyslogd - - - ' + b'x' * size + b'\n'
+        data = message * batch_size
+
+        for name, serializer, zero_copy, copy_threshold in setups:
+            caster = transport.ZeroMQCaster(
+                host_tuple, copy_threshold=copy_threshold)
+            parser = Parser(transport.SyslogToZeroMQHandler(
+                caster, serializer=serializer, zero_copy=zero_copy))
+            receiver = transport.ZeroMQReceiver(
+                [host_tuple], serializer=serializer, zero_copy=zero_copy)
+            receiver.connect()
+            caster.socket.poll(5000, transport.zmq.POLLOUT)
+
+            elapsed = 0
+            for _ in range(rounds):
+                then = time.time()
+                parser.read(data)
+                elapsed += time.time() - then
+
+                for _ in range(batch_size):
+                    receiver.get()
+
+            caster.close()
+            receiver.close()
+
+            if print_output:
+                print('{} byte bodies, {}: {:.0f} messages per second, '
+                      '{:.0f} MB per second.'.format(
+                          size, name, rounds * batch_size / elapsed,
+                          rounds * len(data) / elapsed / 1048576))
+
+
+def consumer_performance(batch_size=100, limit=1000, rounds=50):
+    from portal.input.syslog import Parser
+
+    host_tuple = ('127.0.0.1', '5000')
+    data = (b'<46>1 2003-10-11T22:14:15.003+01:00 tohru rsyslogd 12662 '
+            b'ID47 [origin software="rsyslogd"] start\n') * limit
+
+    for name in ('loads each', 'get_batch', 'drain'):
+        caster = transport.ZeroMQCaster(host_tuple, batch_size=batch_size)
+        parser = Parser(transport.SyslogToZeroMQHandler(caster))
+        receiver = transport.ZeroMQReceiver([host_tuple])
+        receiver.connect()
+        caster.socket.poll(5000, transport.zmq.POLLOUT)
+
+        elapsed = 0
+        for _ in range(rounds):
+            parser.read(data)
+
+            # Only time the consumer once the round has been delivered
+            receiver.socket.poll(5000)
+            time.sleep(0.05)
+
+            then = time.time()
+            received = 0
+            while received < limit:
+                if name == 'loads each':
+                    for msg in receiver.socket.recv_multipart():
+                        receiver.serializer.loads(msg)
+                        received += 1
+                elif name == 'get_batch':
+                    received += len(receiver.get_batch(decode=True))
+                else:
+                    received += len(receiver.drain(limit, decode=True))
+            elapsed += time.time() - then
+
+        caster.close()
+        receiver.close()
+        print('batch_size {0}, {1}: {2:.0f} messages per second'.format(
+            batch_size, name, rounds * limit / elapsed))
+
+
 if __name__ == '__main__':
     unittest.main()
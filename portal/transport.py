@@ -3,32 +3,81 @@ The transport module defines the classes that serve as the transport layer for
 Portal when sending parsed syslog messages downstream.
 """
 
-import simplejson as json
+import bisect
+import hashlib
+import struct
+import sys
+import threading
+
+from collections import deque
+from functools import partial
+
 import zmq
 
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
 from portal.log import get_logger
 from portal.input.syslog import SyslogMessageHandler
+from portal.serializers import JsonSerializer
 
 
 _LOG = get_logger(__name__)
 
+# The most held or spooled messages sent in one pass of the IOLoop
+_DRAIN_LIMIT = 256
+
+# Head fields that ShardedCaster may route messages by
+SHARD_KEYS = ('hostname', 'appname', 'processid', 'messageid')
+_SD_SHARD_KEY = 'sd:'
+_ROUTE_CACHE_SIZE = 65536
+_RING_POINT = struct.Struct('<I')
+
+# The most messages that may wait for a SendPipeline's sender thread
+DEFAULT_MAX_PENDING = 10000
+_PIPELINE_ENDPOINT = 'inproc://portal-send-pipeline-{0}'
+
 
 class SyslogToZeroMQHandler(SyslogMessageHandler):
     """
     SyslogToZeroMQHandler provides callback methods for the Syslog Parser.
-    It builds a dictionary of a parsed syslog message and then sends the
-    message downstream using ZeroMQ.
+    It serializes each parsed syslog message and then sends the message
+    downstream using ZeroMQ.
+
+    With zero_copy set, only the message head is serialized and the raw
+    message body follows it in a frame of its own. Bodies are handed to
+    zmq without being copied, except for bodies read out of writable
+    buffers, which are copied once since the buffer may be reused. Receivers
+    must be created with zero_copy set as well.
+
+    Given a SendPipeline in place of a caster, messages are only queued
+    for the pipeline's sender thread, which serializes and sends them with
+    the pipeline's serializer and zero_copy setting.
     """
 
-    def __init__(self, zmq_caster):
+    def __init__(self, zmq_caster, serializer=None, zero_copy=False):
         """
         Initializes the handler msg, and msg_head.
 
-        :param zmq_caster: An instance of ZeroMQCaster class
+        :param zmq_caster: An instance of ZeroMQCaster, ShardedCaster or
+        SendPipeline
+        :param serializer: The serializer messages are encoded with, see
+        portal.serializers, defaults to JSON
+        :param zero_copy: Whether message bodies are sent in frames of
+        their own without being copied
         """
         self.msg = bytearray()
         self.msg_head = None
         self.caster = zmq_caster
+        self.pipelined = isinstance(zmq_caster, SendPipeline)
+
+        if self.pipelined:
+            serializer = zmq_caster.serializer
+            zero_copy = zmq_caster.zero_copy
+
+        self.serializer = serializer or JsonSerializer()
+        self.zero_copy = zero_copy
+        self.sharded = isinstance(zmq_caster, ShardedCaster)
         self.caster.bind()
 
     def on_msg_head(self, msg_head):
@@ -57,12 +106,58 @@ class SyslogToZeroMQHandler(SyslogMessageHandler):
 
         :param msg_length: The byte count of the syslog message received
         """
-        syslog_msg = self.msg_head.as_dict()
-        syslog_msg['message'] = self.msg.decode('utf-8')
-        syslog_msg['msg_length'] = msg_length
+        if self.pipelined:
+            msg_body = self.msg
+            self.msg = bytearray()
+            self.caster.submit(self.msg_head.copy(), msg_body, msg_length)
+        elif self.zero_copy:
+            # The assembled body is given away rather than copied
+            msg_body = self.msg
+            self.msg = bytearray()
+            self._cast_body(msg_body, msg_length)
+        else:
+            self._cast_msg(self.msg, msg_length)
+            del self.msg[:]
+
+    def on_msg_body(self, msg_body, msg_length):
+        """
+        Callback method for the parser when a complete syslog message body
+        was received in one piece. The body is serialized straight out of
+        the parser's input and sent downstream over ZeroMQ.
+
+        :param msg_body: A memoryview over the complete syslog message body
+        :param msg_length: The byte count of the syslog message received
+        """
+        if self.pipelined or self.zero_copy:
+            if not msg_body.readonly:
+                # Writable input may be refilled once this returns
+                msg_body = msg_body.tobytes()
+
+            if self.pipelined:
+                self.caster.submit(
+                    self.msg_head.copy(), msg_body, msg_length)
+            else:
+                self._cast_body(msg_body, msg_length)
+        else:
+            self._cast_msg(msg_body, msg_length)
+
+    def _cast_msg(self, message, msg_length):
+        msg = self.serializer.dumps(self.msg_head, message, msg_length)
+
+        if self.sharded:
+            self.caster.cast(msg, key=self.caster.key_for(self.msg_head))
+        else:
+            self.caster.cast(msg)
 
-        self.caster.cast(json.dumps(syslog_msg))
-        del self.msg[:]
+    def _cast_body(self, msg_body, msg_length):
+        msg = self.serializer.dumps_head(
+            self.msg_head, len(msg_body), msg_length)
+
+        if self.sharded:
+            self.caster.cast(
+                msg, msg_body, self.caster.key_for(self.msg_head))
+        else:
+            self.caster.cast(msg, msg_body)
 
 
 class ZeroMQCaster(object):
@@ -71,50 +166,323 @@ class ZeroMQCaster(object):
     messages over a zmq socket to downstream clients.  If multiple clients
     connect to this PUSH socket the messages will be load balanced evenly
     across the clients.
+
+    With a batch_size above 1 messages are gathered into batches that are
+    sent as a single multipart zmq message, one frame per syslog message.
+    A batch is sent once it holds batch_size messages, once it holds
+    batch_bytes bytes or batch_interval milliseconds after its first
+    message was cast, whichever comes first.
+
+    Messages may be cast with a body that is sent zero-copy in a frame
+    following the message frame. pyzmq still copies frames smaller than
+    the socket's copy threshold, 64 KB by default, which copy_threshold
+    lowers.
+
+    Sends never block. Once the socket reaches its send high-water mark,
+    sndhwm messages queued for downstream clients, messages are kept in
+    order until the socket drains. The full callback is run when the socket
+    first refuses a message and the drain callback once every held message
+    has been sent, which lets the listeners stop reading until then.
+
+    With a spool, messages the socket refuses are appended to the spool
+    instead and replayed from it as the socket drains. Messages are only
+    held in memory, and the full callback run, once the spool is full.
+
+    With a compressor, see portal.compression, every message or batch is
+    sent as one compressed frame. Receivers must be given a matching
+    compressor.
     """
 
-    def __init__(self, bind_host_tuple):
+    def __init__(self, bind_host_tuple, batch_size=1, batch_bytes=None,
+                 batch_interval=None, io_loop=None, copy_threshold=None,
+                 sndhwm=None, spool=None, compressor=None, io_threads=1,
+                 connect=False):
         """
         Creates an instance of the ZeroMQCaster.  A zmq PUSH socket is
         created and is bound to the specified host:port.
 
         :param bind_host_tuple: (host, port), for example ('127.0.0.1', '5000')
+        or a zmq endpoint, for example 'ipc:///var/run/portal.sock'
+        :param batch_size: The most messages sent in one batch, 1 sends
+        every message on its own
+        :param batch_bytes: Optional byte count at which a batch is sent
+        :param batch_interval: Optional number of milliseconds a batch may
+        wait before being sent
+        :param io_loop: The IOLoop to time batches and wait for the socket
+        on, defaults to the current IOLoop
+        :param copy_threshold: Optional byte count under which frames are
+        copied rather than sent zero-copy
+        :param sndhwm: Optional number of messages the socket may queue
+        before it is full, zmq defaults to 1000
+        :param spool: Optional portal.spool.Spool to keep messages in while
+        the socket is full
+        :param compressor: Optional portal.compression.FrameCompressor to
+        compress messages and batches with
+        :param io_threads: The number of zmq I/O threads the socket's
+        context runs
+        :param connect: Whether the socket connects to the endpoint, for
+        example a portal.processes.FanIn, rather than binding it
         """
 
         self.socket_type = zmq.PUSH
-        self.bind_host = 'tcp://{0}:{1}'.format(*bind_host_tuple)
+        if isinstance(bind_host_tuple, basestring):
+            self.bind_host = bind_host_tuple
+        else:
+            self.bind_host = 'tcp://{0}:{1}'.format(*bind_host_tuple)
+
+        self.connect = connect
         self.context = None
         self.socket = None
         self.bound = False
 
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        self.io_loop = io_loop
+        self.copy_threshold = copy_threshold
+        self.sndhwm = sndhwm
+        self.spool = spool
+        self.compressor = compressor
+        self.io_threads = io_threads
+        self._batch = list()
+        self._batch_count = 0
+        self._batch_length = 0
+        self._batch_copy = True
+        self._flush_timeout = None
+
+        self._held = deque()
+        self._watching = False
+        self._full_callback = None
+        self._drain_callback = None
+
+    @property
+    def full(self):
+        """
+        True while messages are held back waiting for the socket to drain
+        """
+        return bool(self._held)
+
+    def set_full_callback(self, callback):
+        """
+        Sets a callback to run when the socket fills up
+        """
+        self._full_callback = callback
+
+    def set_drain_callback(self, callback):
+        """
+        Sets a callback to run when the socket has drained after filling up
+        """
+        self._drain_callback = callback
+
     def bind(self):
         """
         Bind the ZeroMQCaster to a host:port to push out messages.
         Create a zmq.Context and a zmq.PUSH socket, and bind the
         socket to the specified host:port
         """
-        self.context = zmq.Context()
+        self.context = zmq.Context(self.io_threads)
         self.socket = self.context.socket(self.socket_type)
-        self.socket.bind(self.bind_host)
+
+        if self.copy_threshold is not None:
+            self.socket.copy_threshold = self.copy_threshold
+
+        if self.sndhwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+
+        if self.connect:
+            self.socket.connect(self.bind_host)
+            _LOG.info('zmq caster connected to {0}'.format(self.bind_host))
+        else:
+            self.socket.bind(self.bind_host)
+            _LOG.info('zmq caster bound to {0}'.format(
+                self.socket.getsockopt(zmq.LAST_ENDPOINT)))
         self.bound = True
 
-    def cast(self, msg):
+        if self.spool is not None and self.spool.depth:
+            # Replay what an earlier run left in the spool
+            self._watch()
+
+    def cast(self, msg, body=None):
         """
-        Sends a message over the zmq PUSH socket
+        Sends a message over the zmq PUSH socket, or adds it to the current
+        batch when batching. A body, when given, is sent zero-copy in a
+        frame of its own right after the message and must not be modified
+        afterwards.
         """
         if not self.bound:
             raise zmq.error.ZMQError(
                 "ZeroMQCaster is not bound to a socket")
+
+        if self.batch_size <= 1:
+            if body is None:
+                self._send((msg,), True)
+            else:
+                self._send((msg, body), False)
+            return
+
+        self._batch.append(msg)
+        self._batch_count += 1
+        self._batch_length += len(msg)
+
+        if body is not None:
+            self._batch.append(body)
+            self._batch_length += len(body)
+            self._batch_copy = False
+
+        if self._batch_count >= self.batch_size or (
+                self.batch_bytes and self._batch_length >= self.batch_bytes):
+            self.flush()
+        elif self.batch_interval and self._flush_timeout is None:
+            if self.io_loop is None:
+                self.io_loop = IOLoop.current()
+
+            self._flush_timeout = self.io_loop.call_later(
+                self.batch_interval / 1000.0, self._on_flush_timeout)
+
+    def flush(self):
+        """
+        Sends the current batch, if there is one, as a multipart message
+        """
+        if self._flush_timeout is not None:
+            self.io_loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+
+        if not self._batch:
+            return
+
+        batch = self._batch
+        copy = self._batch_copy
+        self._batch = list()
+        self._batch_count = 0
+        self._batch_length = 0
+        self._batch_copy = True
+
+        self._send(batch, copy)
+
+    def _send(self, frames, copy):
+        """
+        Sends frames as one message without blocking. The frames are held
+        back when the socket is full or while earlier messages are held.
+        """
+        if self.compressor is not None:
+            frames = (self.compressor.compress(frames),)
+            copy = True
+
+        if self._held or (self.spool is not None and self.spool.depth):
+            self._hold(frames, copy)
+            return
+
         try:
-            self.socket.send(msg)
+            if len(frames) == 1:
+                self.socket.send(frames[0], zmq.NOBLOCK)
+            elif copy:
+                self.socket.send_multipart(frames, zmq.NOBLOCK)
+            else:
+                self.socket.send_multipart(frames, zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            self._hold(frames, copy)
         except Exception as ex:
             _LOG.exception(ex)
 
+    def _hold(self, frames, copy):
+        if not self._held and self.spool is not None:
+            if self.spool.append(frames):
+                self._watch()
+                return
+
+        self._held.append((frames, copy))
+
+        if len(self._held) == 1:
+            self._watch()
+
+            if self._full_callback is not None:
+                self._full_callback()
+
+    def _watch(self):
+        if self._watching:
+            return
+
+        if self.io_loop is None:
+            self.io_loop = IOLoop.current()
+
+        # The zmq descriptor only signals that the socket's events may
+        # have changed, so they are checked once now as well
+        self._watching = True
+        self.io_loop.add_handler(
+            self.socket.getsockopt(zmq.FD), self._on_socket_events,
+            IOLoop.READ)
+        self.io_loop.add_callback(self._on_socket_events)
+
+    def _unwatch(self):
+        if self._watching:
+            self._watching = False
+            self.io_loop.remove_handler(self.socket.getsockopt(zmq.FD))
+
+    def _on_socket_events(self, fd=None, events=None):
+        if not self._watching:
+            return
+
+        spool = self.spool
+
+        # Spooled messages are older than any held in memory
+        for _ in xrange(_DRAIN_LIMIT):
+            if spool is not None and spool.depth:
+                frames = spool.peek()
+                copy = True
+            elif self._held:
+                frames, copy = self._held[0]
+            else:
+                break
+
+            if not self.socket.getsockopt(zmq.EVENTS) & zmq.POLLOUT:
+                return
+
+            try:
+                self.socket.send_multipart(frames, zmq.NOBLOCK, copy=copy)
+            except zmq.Again:
+                return
+            except Exception as ex:
+                _LOG.exception(ex)
+
+            if spool is not None and spool.depth:
+                spool.pop()
+            else:
+                self._held.popleft()
+
+                if not self._held and self._drain_callback is not None:
+                    self._drain_callback()
+        else:
+            # Let the IOLoop run before sending more
+            self.io_loop.add_callback(self._on_socket_events)
+            return
+
+        self._unwatch()
+
+    def _on_flush_timeout(self):
+        self._flush_timeout = None
+
+        if self.bound:
+            self.flush()
+
     def close(self):
         """
-        Close the zmq socket
+        Send any batched messages and close the zmq socket. Messages still
+        held back for a full socket are dropped.
         """
         if self.bound:
+            self.flush()
+
+            if self._held:
+                _LOG.warning(
+                    'Dropping {0} messages held for a full socket'.format(
+                        len(self._held)))
+                self._held.clear()
+
+            if self.spool is not None:
+                self.spool.close()
+
+            self._unwatch()
+
             self.socket.close()
             self.context.destroy()
             self.socket = None
@@ -122,27 +490,513 @@ class ZeroMQCaster(object):
             self.bound = False
 
 
+def _ring_point(value):
+    return _RING_POINT.unpack_from(hashlib.md5(value).digest())[0]
+
+
+class ShardedCaster(object):
+    """
+    ShardedCaster routes each message to one of several ZeroMQCasters, each
+    bound to its own endpoint, by a consistent hash of a key read from the
+    message head. Messages sharing a key always reach the same endpoint and
+    so the same downstream client. Every caster is placed on a hash ring
+    replicas times so adding or removing one only moves the keys on its
+    share of the ring.
+
+    The key is one of the head fields in SHARD_KEYS or an SDATA value named
+    as 'sd:<SD-ID>:<PARAM-NAME>', for example 'sd:meniscus:tenant'. Messages
+    without that SDATA value are routed by their hostname.
+    """
+
+    def __init__(self, casters, key='hostname', replicas=160):
+        """
+        :param casters: The ZeroMQCasters to route messages across
+        :param key: The head field or SDATA value messages are routed by
+        :param replicas: The number of points each caster has on the ring
+        """
+        if key.startswith(_SD_SHARD_KEY):
+            try:
+                element, field = key[len(_SD_SHARD_KEY):].rsplit(':', 1)
+            except ValueError:
+                raise ValueError('Malformed shard key: {0}'.format(key))
+            self._sd_key = (element, field)
+        elif key in SHARD_KEYS:
+            self._sd_key = None
+        else:
+            raise ValueError('Unknown shard key: {0}'.format(key))
+
+        if replicas < 1:
+            raise ValueError('replicas must be at least 1')
+
+        self.key = key
+        self.replicas = replicas
+        self.casters = list()
+        self.bound = False
+
+        self._points = list()
+        self._ring = list()
+        self._routes = dict()
+        self._full_shards = 0
+        self._full_callback = None
+        self._drain_callback = None
+
+        for caster in casters:
+            self.add_caster(caster)
+
+    @property
+    def full(self):
+        """
+        True while any caster holds messages back for a full socket
+        """
+        return self._full_shards > 0
+
+    def set_full_callback(self, callback):
+        """
+        Sets a callback to run when the first of the casters fills up
+        """
+        self._full_callback = callback
+
+    def set_drain_callback(self, callback):
+        """
+        Sets a callback to run when every caster has drained
+        """
+        self._drain_callback = callback
+
+    def key_for(self, msg_head):
+        """
+        Returns the key the given message head is routed by
+        """
+        if self._sd_key is None:
+            return getattr(msg_head, self.key)
+
+        element, field = self._sd_key
+        fields = msg_head.sd.get(element)
+
+        if fields:
+            value = fields.get(field)
+
+            if value is not None:
+                return value
+        return msg_head.hostname
+
+    def caster_for(self, key):
+        """
+        Returns the caster messages with the given key are sent to
+        """
+        caster = self._routes.get(key)
+
+        if caster is None:
+            if not self._ring:
+                raise zmq.error.ZMQError('ShardedCaster has no casters')
+
+            index = bisect.bisect(self._points, _ring_point(key))
+            caster = self._ring[index % len(self._ring)]
+
+            if len(self._routes) >= _ROUTE_CACHE_SIZE:
+                self._routes.clear()
+            self._routes[key] = caster
+        return caster
+
+    def add_caster(self, caster):
+        """
+        Adds a caster to the ring, binding it when this caster is bound
+        """
+        self.casters.append(caster)
+        caster.set_full_callback(self._on_caster_full)
+        caster.set_drain_callback(self._on_caster_drain)
+
+        if self.bound and not caster.bound:
+            caster.bind()
+
+        self._build_ring()
+
+    def remove_caster(self, caster):
+        """
+        Takes a caster off the ring and closes it
+        """
+        self.casters.remove(caster)
+        self._build_ring()
+
+        if caster.full:
+            self._on_caster_drain()
+        caster.close()
+
+    def _build_ring(self):
+        points = list()
+
+        for caster in self.casters:
+            for replica in xrange(self.replicas):
+                points.append((
+                    _ring_point('{0}#{1}'.format(caster.bind_host, replica)),
+                    caster.bind_host,
+                    caster))
+
+        points.sort(key=lambda point: point[:2])
+        self._points = [point[0] for point in points]
+        self._ring = [point[2] for point in points]
+        self._routes.clear()
+
+    def _on_caster_full(self):
+        self._full_shards += 1
+
+        if self._full_shards == 1 and self._full_callback is not None:
+            self._full_callback()
+
+    def _on_caster_drain(self):
+        self._full_shards -= 1
+
+        if self._full_shards == 0 and self._drain_callback is not None:
+            self._drain_callback()
+
+    def bind(self):
+        """
+        Binds every caster
+        """
+        for caster in self.casters:
+            if not caster.bound:
+                caster.bind()
+        self.bound = True
+
+    def cast(self, msg, body=None, key=None):
+        """
+        Sends a message through the caster its key hashes to, see
+        ZeroMQCaster.cast. Messages without a key are routed as if their
+        key were empty.
+        """
+        self.caster_for(key or b'').cast(msg, body)
+
+    def flush(self):
+        """
+        Sends the current batch of every caster
+        """
+        for caster in self.casters:
+            caster.flush()
+
+    def close(self):
+        """
+        Closes every caster
+        """
+        for caster in self.casters:
+            caster.close()
+        self.bound = False
+
+
+class SendPipeline(object):
+    """
+    SendPipeline takes serialization and sending off the IOLoop. Parsed
+    messages are queued as they are for a sender thread, which serializes
+    them and casts them through a ZeroMQCaster or ShardedCaster that only
+    it uses. The IOLoop only parses, queues and wakes the sender thread
+    over an inproc PAIR socket, so a slow send no longer holds up reading
+    from every syslog connection.
+
+    The sender thread runs an IOLoop of its own, which the caster's batch
+    timers and full socket handling run on, and so the caster must not be
+    given an io_loop. At most max_pending messages wait for the sender
+    thread. The full callback is run on the IOLoop once that many wait, or
+    once the caster fills up, and the drain callback once both have caught
+    up again.
+
+    Python code in the two threads still takes turns holding the GIL. The
+    pipeline decouples the IOLoop from send stalls rather than adding CPU.
+    """
+
+    def __init__(self, caster, serializer=None, zero_copy=False,
+                 max_pending=DEFAULT_MAX_PENDING, io_loop=None):
+        """
+        :param caster: The ZeroMQCaster or ShardedCaster to send messages
+        through, bound by the sender thread
+        :param serializer: The serializer messages are encoded with, see
+        portal.serializers, defaults to JSON
+        :param zero_copy: Whether message bodies are sent in frames of
+        their own, see SyslogToZeroMQHandler
+        :param max_pending: The most messages that may wait for the sender
+        thread before the pipeline is full
+        :param io_loop: The IOLoop messages are submitted and callbacks
+        run on, defaults to the current IOLoop
+        """
+        if max_pending < 1:
+            raise ValueError('max_pending must be at least 1')
+
+        self.caster = caster
+        self.serializer = serializer or JsonSerializer()
+        self.zero_copy = zero_copy
+        self.max_pending = max_pending
+        self.io_loop = io_loop
+        self.context = None
+        self.bound = False
+
+        self._queue = deque()
+        self._signal = None
+        self._signalled = False
+        self._closing = False
+        self._thread = None
+        self._sender_loop = None
+        self._sender_error = None
+        self._handler = None
+        self._wake = None
+
+        self._queue_full = False
+        self._caster_full = False
+        self._drain_requested = False
+        self._full_callback = None
+        self._drain_callback = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def full(self):
+        """
+        True while too many messages wait for the sender thread or the
+        caster holds messages back for a full socket
+        """
+        return self._queue_full or self._caster_full
+
+    def set_full_callback(self, callback):
+        """
+        Sets a callback to run on the IOLoop when the pipeline fills up
+        """
+        self._full_callback = callback
+
+    def set_drain_callback(self, callback):
+        """
+        Sets a callback to run on the IOLoop when the pipeline has drained
+        after filling up
+        """
+        self._drain_callback = callback
+
+    def bind(self):
+        """
+        Starts the sender thread, which binds the caster. Errors binding
+        the caster are raised here.
+        """
+        if self.io_loop is None:
+            self.io_loop = IOLoop.current()
+
+        # inproc sockets need no I/O threads
+        self.context = zmq.Context(0)
+        endpoint = _PIPELINE_ENDPOINT.format(id(self))
+        wake = self.context.socket(zmq.PAIR)
+        wake.bind(endpoint)
+        self._signal = self.context.socket(zmq.PAIR)
+        self._signal.connect(endpoint)
+
+        self.caster.set_full_callback(
+            partial(self.io_loop.add_callback, self._on_caster_full))
+        self.caster.set_drain_callback(
+            partial(self.io_loop.add_callback, self._on_caster_drain))
+
+        ready = threading.Event()
+        self._closing = False
+        self._thread = threading.Thread(
+            target=self._run, args=(wake, ready), name='portal-sender')
+        self._thread.daemon = True
+        self._thread.start()
+        ready.wait()
+
+        if self._sender_error is not None:
+            error = self._sender_error
+            self._sender_error = None
+            self._thread.join()
+            self._close_signal()
+            raise error
+
+        self.bound = True
+
+    def submit(self, msg_head, msg_body, msg_length):
+        """
+        Queues a parsed message for the sender thread. The message head
+        and body must not be modified afterwards.
+
+        :param msg_head: An instance of the SyslogMessageHead class that
+        the parser does not reuse
+        :param msg_body: The syslog message body
+        :param msg_length: The byte count of the syslog message received
+        """
+        if not self.bound:
+            raise zmq.error.ZMQError("SendPipeline is not bound")
+
+        self._queue.append((msg_head, msg_body, msg_length))
+
+        # The sender thread clears the flag before it empties the queue so
+        # either it sees this message or it is woken again
+        if not self._signalled:
+            self._signalled = True
+            self._wake_sender()
+
+        if not self._queue_full and len(self._queue) >= self.max_pending:
+            self._set_full(queue_full=True)
+
+    def close(self):
+        """
+        Sends every queued message, closes the caster and stops the sender
+        thread
+        """
+        if not self.bound:
+            return
+
+        self._closing = True
+        self._wake_sender()
+        self._thread.join()
+        self._thread = None
+        self._close_signal()
+        self.bound = False
+
+    def _close_signal(self):
+        self._signal.close()
+        self.context.term()
+        self._signal = None
+        self.context = None
+
+    def _wake_sender(self):
+        try:
+            self._signal.send(b'', zmq.NOBLOCK)
+        except zmq.Again:
+            # Wakes already wait for the sender thread
+            pass
+
+    def _set_full(self, queue_full=None, caster_full=None):
+        was_full = self.full
+
+        if queue_full is not None:
+            self._queue_full = queue_full
+
+        if caster_full is not None:
+            self._caster_full = caster_full
+
+        if self.full and not was_full:
+            if self._full_callback is not None:
+                self._full_callback()
+        elif was_full and not self.full:
+            if self._drain_callback is not None:
+                self._drain_callback()
+
+    def _on_caster_full(self):
+        self._set_full(caster_full=True)
+
+    def _on_caster_drain(self):
+        self._set_full(caster_full=False)
+
+    def _on_queue_drain(self):
+        self._drain_requested = False
+
+        if self._queue_full and len(self._queue) <= self.max_pending // 2:
+            self._set_full(queue_full=False)
+
+    # Everything below runs on the sender thread
+
+    def _run(self, wake, ready):
+        loop = IOLoop()
+        loop.make_current()
+        self._sender_loop = loop
+
+        try:
+            self._handler = SyslogToZeroMQHandler(
+                self.caster, self.serializer, self.zero_copy)
+        except Exception as ex:
+            self._sender_error = ex
+            wake.close()
+            loop.close()
+            ready.set()
+            return
+
+        self._wake = wake
+        loop.add_handler(wake.getsockopt(zmq.FD), self._on_wake, IOLoop.READ)
+        ready.set()
+
+        try:
+            loop.start()
+        finally:
+            loop.remove_handler(wake.getsockopt(zmq.FD))
+            wake.close()
+            loop.close()
+            self._sender_loop = None
+            self._handler = None
+            self._wake = None
+
+    def _on_wake(self, fd=None, events=None):
+        # Reading the socket's events also rearms its descriptor
+        while self._wake.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self._wake.recv(zmq.NOBLOCK)
+
+        self._signalled = False
+        self._cast_pending()
+
+    def _cast_pending(self):
+        queue = self._queue
+        handler = self._handler
+
+        for _ in xrange(_DRAIN_LIMIT):
+            if not queue:
+                break
+
+            msg_head, msg_body, msg_length = queue.popleft()
+            handler.msg_head = msg_head
+
+            try:
+                if self.zero_copy:
+                    handler._cast_body(msg_body, msg_length)
+                else:
+                    handler._cast_msg(msg_body, msg_length)
+            except Exception as ex:
+                _LOG.exception(ex)
+        else:
+            # Let the caster's timers and socket events run before more
+            self._sender_loop.add_callback(self._cast_pending)
+
+        handler.msg_head = None
+
+        if (self._queue_full and not self._drain_requested
+                and len(queue) <= self.max_pending // 2):
+            self._drain_requested = True
+            self.io_loop.add_callback(self._on_queue_drain)
+
+        if self._closing and not queue:
+            self.caster.close()
+            self._sender_loop.stop()
+
+
 class ZeroMQReceiver(object):
     """
     ZeroMQReceiver allows for messages to be received by pulling
     messages over a zmq socket from an upstream host.  This client may
     connect to multiple upstream hosts.
+
+    Messages are returned as they were sent unless decode is requested, in
+    which case they are decoded with the receiver's serializer. The
+    serializer must match the one used by the sending handler, and so must
+    zero_copy. Messages sent with zero_copy are returned as (head, body)
+    pairs when they are not decoded. Compressed messages are decompressed
+    by the receiver's compressor, which must match the sender's.
     """
 
-    def __init__(self, connect_host_tuples):
+    def __init__(self, connect_host_tuples, serializer=None,
+                 zero_copy=False, compressor=None):
         """
         Creates an instance of the ZeroMQReceiver.
 
         :param connect_host_tuples: [(host, port), (host, port)],
         for example [('127.0.0.1', '5000'), ('127.0.0.1', '5001')]
+        :param serializer: The serializer messages are decoded with, see
+        portal.serializers, defaults to JSON
+        :param zero_copy: Whether messages were sent with their bodies in
+        frames of their own
+        :param compressor: Optional portal.compression.FrameCompressor that
+        messages were compressed with
         """
         self.upstream_hosts = [
             "tcp://{}:{}".format(*host_tuple)
             for host_tuple in connect_host_tuples]
         self.socket_type = zmq.PULL
+        self.serializer = serializer or JsonSerializer()
+        self.zero_copy = zero_copy
+        self.compressor = compressor
         self.context = None
         self.socket = None
         self.connected = False
+        self._drain_future = None
+        self._drain_loop = None
 
     def connect(self):
         """
@@ -158,20 +1012,166 @@ class ZeroMQReceiver(object):
 
         self.connected = True
 
-    def get(self):
+    def get(self, decode=False):
         """
-        Read a message form the zmq socket and return
+        Read a message form the zmq socket and return it, decoded into a
+        dictionary if decode is True
         """
         if not self.connected:
             raise zmq.error.ZMQError(
                 "ZeroMQReceiver is not connected to a socket")
-        return self.socket.recv()
+
+        if self.zero_copy:
+            head, body = self._recv_multipart()
+
+            if decode:
+                return self.serializer.loads(head, body)
+            return head, body
+
+        if self.compressor is None:
+            msg = self.socket.recv()
+        else:
+            msg, = self._recv_multipart()
+        return self.serializer.loads(msg) if decode else msg
+
+    def get_batch(self, decode=False):
+        """
+        Read a batch of messages sent by a batching ZeroMQCaster from the
+        zmq socket and return them as a list. A message that was not
+        batched is returned as a list of one. Each message is decoded into
+        a dictionary if decode is True.
+        """
+        if not self.connected:
+            raise zmq.error.ZMQError(
+                "ZeroMQReceiver is not connected to a socket")
+
+        batch = self._records(self._recv_multipart())
+        return self._decode(batch) if decode else batch
+
+    def drain(self, limit=1000, decode=False, timeout=None):
+        """
+        Waits for a message and then receives every message already queued
+        on the zmq socket, without blocking again, and returns them as one
+        list. Batches sent by a batching ZeroMQCaster are flattened into
+        the list. Receiving stops once the list holds limit messages or
+        more, so a list may overshoot limit by part of one batch. Messages
+        are decoded together if decode is True.
+
+        :param limit: The number of messages after which receiving stops
+        :param decode: Whether to decode the messages into dictionaries
+        :param timeout: Optional milliseconds to wait for a message, after
+        which an empty list is returned
+        """
+        if not self.connected:
+            raise zmq.error.ZMQError(
+                "ZeroMQReceiver is not connected to a socket")
+
+        if timeout is not None and not self.socket.poll(timeout):
+            return list()
+
+        records = self._records(self._recv_multipart())
+        return self._drain_available(records, limit, decode)
+
+    def iter_batches(self, limit=1000, decode=False, timeout=None):
+        """
+        Yields the lists of messages returned by drain for as long as the
+        receiver is connected
+        """
+        while self.connected:
+            yield self.drain(limit, decode, timeout)
+
+    def drain_async(self, limit=1000, decode=False, io_loop=None):
+        """
+        Returns a Future that resolves to the list of messages drain would
+        return once a message is available, waiting on the zmq socket's
+        descriptor with the IOLoop rather than blocking. The Future may be
+        yielded from tornado coroutines or awaited. Only one Future may be
+        pending at a time.
+
+        :param io_loop: The IOLoop to wait on, defaults to the current
+        IOLoop
+        """
+        if not self.connected:
+            raise zmq.error.ZMQError(
+                "ZeroMQReceiver is not connected to a socket")
+
+        if self._drain_future is not None:
+            raise zmq.error.ZMQError(
+                "ZeroMQReceiver is already waiting to drain")
+
+        future = Future()
+
+        if self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self._resolve_drain(future, limit, decode)
+            return future
+
+        self._drain_future = future
+        self._drain_loop = io_loop or IOLoop.current()
+
+        def on_events(fd, events):
+            if self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                self._stop_waiting()
+                self._resolve_drain(future, limit, decode)
+
+        self._drain_loop.add_handler(
+            self.socket.getsockopt(zmq.FD), on_events, IOLoop.READ)
+        return future
+
+    def _resolve_drain(self, future, limit, decode):
+        try:
+            future.set_result(self._drain_available(list(), limit, decode))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+
+    def _stop_waiting(self):
+        future = self._drain_future
+
+        if future is not None:
+            self._drain_future = None
+            self._drain_loop.remove_handler(self.socket.getsockopt(zmq.FD))
+        return future
+
+    def _drain_available(self, records, limit, decode):
+        while len(records) < limit:
+            try:
+                frames = self._recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+            records.extend(self._records(frames))
+
+        return self._decode(records) if decode else records
+
+    def _records(self, frames):
+        if self.zero_copy:
+            return zip(frames[::2], frames[1::2])
+        return frames
+
+    def _decode(self, records):
+        if not records:
+            return list()
+
+        if self.zero_copy:
+            heads, bodies = zip(*records)
+            return self.serializer.loads_many(heads, bodies)
+        return self.serializer.loads_many(records)
+
+    def _recv_multipart(self, flags=0):
+        if self.compressor is None:
+            return self.socket.recv_multipart(flags)
+        return self.compressor.decompress(self.socket.recv(flags))
 
     def close(self):
         """
         Close the zmq socket
         """
         if self.connected:
+            future = self._stop_waiting()
+
+            if future is not None:
+                future.set_exception(zmq.error.ZMQError(
+                    "ZeroMQReceiver was closed"))
+
             self.socket.close()
             self.context.destroy()
             self.socket = None
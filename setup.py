@@ -58,7 +58,9 @@ def package_c():
         include_dirs=['include/'],
         sources=[
             'include/syslog.c',
+            'include/batch.c',
             'include/cstr.c',
+            'include/timestamp.c',
             'portal/input/syslog/usyslog.c'
         ],
         extra_compile_args=COMPILER_ARGS))